@@ -0,0 +1,30 @@
+"""Add username and displayname indexes
+
+Revision ID: a112c466bd8a
+Revises: ccae30e19c05
+Create Date: 2021-01-16 14:21:09.330857
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a112c466bd8a'
+down_revision = 'ccae30e19c05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index("ix_puppet_username_lower", "puppet", [sa.text("lower(username)")])
+    op.create_index("ix_puppet_displayname", "puppet", ["displayname"])
+    op.create_index("ix_user_tg_username_lower", "user", [sa.text("lower(tg_username)")])
+    op.create_index("ix_portal_username_lower", "portal", [sa.text("lower(username)")])
+
+
+def downgrade():
+    op.drop_index("ix_portal_username_lower", table_name="portal")
+    op.drop_index("ix_user_tg_username_lower", table_name="user")
+    op.drop_index("ix_puppet_displayname", table_name="puppet")
+    op.drop_index("ix_puppet_username_lower", table_name="puppet")
@@ -0,0 +1,26 @@
+"""Add last activity field to users
+
+Revision ID: e0b0a4e5d8f1
+Revises: a112c466bd8a
+Create Date: 2021-02-03 19:42:11.204593
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e0b0a4e5d8f1"
+down_revision = "a112c466bd8a"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("user", sa.Column("last_activity", sa.Integer(), nullable=False,
+                                    server_default="0"))
+
+
+def downgrade():
+    with op.batch_alter_table("user") as batch_op:
+        batch_op.drop_column("last_activity")
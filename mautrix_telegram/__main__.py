@@ -14,6 +14,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from typing import Optional
+from time import time
+import asyncio
 
 from alchemysession import AlchemySessionContainer
 
@@ -28,7 +30,8 @@ from .abstract_user import init as init_abstract_user
 from .bot import Bot, init as init_bot
 from .config import Config
 from .context import Context
-from .db import init as init_db
+from .db import init as init_db, Portal as DBPortal
+from .db.telethon_session import CachedSession
 from .formatter import init as init_formatter
 from .matrix import MatrixHandler
 from .portal import Portal, init as init_portal
@@ -58,6 +61,13 @@ class TelegramBridge(Bridge):
     session_container: AlchemySessionContainer
     bot: Bot
     manhole: Optional[ManholeState]
+    start_ts: float
+    first_message_bridged: bool
+
+    def prepare(self) -> None:
+        self.start_ts = time()
+        self.first_message_bridged = False
+        super().prepare()
 
     def prepare_db(self) -> None:
         super().prepare_db()
@@ -65,6 +75,8 @@ class TelegramBridge(Bridge):
         self.session_container = AlchemySessionContainer(
             engine=self.db, table_base=Base, session=False,
             table_prefix="telethon_", manage_tables=False)
+        if self.config["telegram.cache_session"]:
+            self.session_container.alchemy_session_class = CachedSession
 
     def _prepare_website(self, context: Context) -> None:
         if self.config["appservice.public.enabled"]:
@@ -90,23 +102,117 @@ class TelegramBridge(Bridge):
         init_portal(context)
         self.add_startup_actions(init_puppet(context))
         self.add_startup_actions(init_user(context))
+        if self.config["bridge.warm_up_caches"]:
+            self.warm_up_caches()
         if self.bot:
             self.add_startup_actions(self.bot.start())
-        if self.config["bridge.resend_bridge_info"]:
-            self.add_startup_actions(self.resend_bridge_info())
+
+    def warm_up_caches(self) -> None:
+        start_ts = time()
+        portal_count = Portal.preload_all()
+        user_count = User.preload_all()
+        puppet_count = Puppet.preload_ids()
+        self.log.info(f"Loaded {portal_count} portals, {user_count} users and {puppet_count} "
+                      f"puppet IDs into cache in {round(time() - start_ts, 2)} seconds")
+
+    def log_first_bridged_message(self, direction: str) -> None:
+        if self.first_message_bridged:
+            return
+        self.first_message_bridged = True
+        self.log.info(f"First message bridged ({direction}) "
+                      f"{round(time() - self.start_ts, 2)} seconds after startup")
 
     async def resend_bridge_info(self) -> None:
+        # The portals are gone through in primary key order one page at a time, and the progress
+        # is saved in the config every few pages, so that an interrupted run continues from there.
+        # Re-sending the info is idempotent, so it doesn't matter if a few pages are done twice.
+        after = self.config["bridge.resend_bridge_info_progress"]
+        after = tuple(after) if after else None
+        if after:
+            self.log.info(f"Continuing re-sending bridge info state event after portal {after}")
+        else:
+            self.log.info("Re-sending bridge info state event to all portals")
+        start_ts = time()
+        semaphore = asyncio.Semaphore(self.config["bridge.resend_bridge_info_concurrency"])
+        sent = failed = pages = 0
+        while True:
+            page = DBPortal.get_page_with_mxid(after, limit=100)
+            if not page:
+                break
+            results = await asyncio.gather(*[self._resend_bridge_info(db_portal, semaphore)
+                                             for db_portal in page])
+            sent += results.count(True)
+            failed += results.count(False)
+            after = (page[-1].tgid, page[-1].tg_receiver)
+            pages += 1
+            if pages % 10 == 0:
+                self.config["bridge.resend_bridge_info_progress"] = list(after)
+                self.config.save()
+                self.log.info(f"Re-sent bridge info to {sent} portals ({failed} failed) "
+                              f"in {round(time() - start_ts)} seconds")
         self.config["bridge.resend_bridge_info"] = False
+        self.config["bridge.resend_bridge_info_progress"] = None
         self.config.save()
-        self.log.info("Re-sending bridge info state event to all portals")
-        for portal in Portal.all():
-            await portal.update_bridge_info()
-        self.log.info("Finished re-sending bridge info state events")
+        self.log.info(f"Finished re-sending bridge info state events to {sent} portals "
+                      f"({failed} failed)")
+
+    async def _resend_bridge_info(self, db_portal: DBPortal, semaphore: asyncio.Semaphore,
+                                  attempts: int = 3) -> bool:
+        async with semaphore:
+            with Portal.borrow_from_db(db_portal) as portal:
+                for attempt in range(1, attempts + 1):
+                    try:
+                        await portal.send_bridge_info()
+                        return True
+                    except Exception:
+                        if attempt == attempts:
+                            portal.log.warning("Failed to re-send bridge info", exc_info=True)
+                            return False
+                        await asyncio.sleep(2 ** attempt)
+
+    async def start(self) -> None:
+        await super().start()
+        # The initial syncs of users can take a long time, so they're waited for in the background
+        # and User.startup_complete is set when they're done.
+        asyncio.ensure_future(User.finish_startup())
+        asyncio.ensure_future(self._evict_caches_loop())
+        if self.config["bridge.resend_bridge_info"]:
+            # This can take a long time with lots of portals, so don't block startup with it.
+            asyncio.ensure_future(self.resend_bridge_info())
+
+    async def _evict_caches_loop(self) -> None:
+        while True:
+            await asyncio.sleep(60)
+            try:
+                self.evict_caches()
+            except Exception:
+                self.log.exception("Failed to evict inactive instances from caches")
+
+    def evict_caches(self) -> None:
+        # Things that were used in the last 10 minutes are kept even if the caches are full, as
+        # they may still be referenced by running handlers.
+        min_idle = 10 * 60
+        max_portals = self.config["bridge.max_cached_portals"]
+        max_puppets = self.config["bridge.max_cached_puppets"]
+        User.evict_inactive(self.config["bridge.max_cached_users"], min_idle)
+        portal_ids = set()
+        puppet_ids = set()
+        if max_portals > 0 or max_puppets > 0:
+            for user in User.by_mxid.values():
+                portal_ids.update(user.portals.keys())
+                puppet_ids.update(puppet.id for puppet in user.contacts if puppet)
+                if user.tgid:
+                    puppet_ids.add(user.tgid)
+        Portal.evict_inactive(max_portals, min_idle, portal_ids)
+        Puppet.evict_inactive(max_puppets, min_idle, puppet_ids)
 
     def prepare_stop(self) -> None:
         for puppet in Puppet.by_custom_mxid.values():
             puppet.stop()
-        self.shutdown_actions = (user.stop() for user in User.by_tgid.values())
+        self.shutdown_actions = [user.stop() for user in User.by_tgid.values()]
+        if self.bot:
+            # Disconnecting the client also flushes its cached session to the database.
+            self.shutdown_actions.append(self.bot.stop())
         if self.manhole:
             self.manhole.close()
             self.manhole = None
@@ -114,6 +220,8 @@ class TelegramBridge(Bridge):
     async def get_user(self, user_id: UserID, create: bool = True) -> User:
         user = User.get_by_mxid(user_id, create=create)
         if user:
+            if user.tgid:
+                user.mark_active()
             await user.ensure_started()
         return user
 
@@ -13,8 +13,9 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Tuple, Optional, Union, Dict, Type, Any, TYPE_CHECKING
+from typing import Tuple, Optional, Union, Dict, List, Type, Any, TYPE_CHECKING
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 import asyncio
 import logging
 import platform
@@ -31,16 +32,16 @@ from telethon.tl.types import (
     UpdateEditChannelMessage, UpdateEditMessage, UpdateNewChannelMessage, UpdateReadHistoryOutbox,
     UpdateShortChatMessage, UpdateShortMessage, UpdateUserName, UpdateUserPhoto, UpdateUserStatus,
     UpdateUserTyping, User, UserStatusOffline, UserStatusOnline, UpdateReadHistoryInbox,
-    UpdateReadChannelInbox, MessageEmpty)
+    UpdateReadChannelInbox, MessageEmpty, UserProfilePhoto)
 
-from mautrix.types import UserID, PresenceState
+from mautrix.types import UserID, RoomID, PresenceState
 from mautrix.errors import MatrixError
 from mautrix.appservice import AppService
 from mautrix.util.logging import TraceLogger
 from mautrix.util.opt_prometheus import Histogram, Counter
 from alchemysession import AlchemySessionContainer
 
-from . import portal as po, puppet as pu, __version__
+from . import portal as po, puppet as pu, util, __version__
 from .db import Message as DBMessage
 from .types import TelegramID
 from .tgclient import MautrixTelegramClient
@@ -51,6 +52,7 @@ if TYPE_CHECKING:
     from .bot import Bot
 
 config: Optional['Config'] = None
+log: TraceLogger = logging.getLogger("mau.user")
 # Value updated from config in init()
 MAX_DELETIONS: int = 10
 
@@ -63,6 +65,11 @@ UPDATE_TIME = Histogram("bridge_telegram_update", "Time spent processing Telegra
 UPDATE_ERRORS = Counter("bridge_telegram_update_error",
                         "Number of fatal errors while handling Telegram updates", ("update_type",))
 
+# (room ID, Telegram ID space, reader) -> Telegram message IDs
+ReadReceiptBatch = Dict[Tuple[RoomID, TelegramID, TelegramID], List[TelegramID]]
+# (puppet ID, source user ID if the puppet is their contact)
+EntityFingerprintKey = Tuple[TelegramID, Optional[TelegramID]]
+
 
 class AbstractUser(ABC):
     session_container: AlchemySessionContainer = None
@@ -71,6 +78,15 @@ class AbstractUser(ABC):
     az: AppService
     relaybot: Optional['Bot']
     ignore_incoming_bot_events: bool = True
+    read_receipt_batcher: util.WindowBatcher = None
+    presence_coalescer: util.StateCoalescer = None
+    entity_update_queue: 'asyncio.Queue[Tuple[AbstractUser, EntityFingerprintKey, User]]' = None
+    entity_update_workers: List[asyncio.Future] = []
+    entity_update_concurrency: int = 4
+    # The user info that was last handled for each puppet, and when it stops being valid.
+    entity_fingerprints: 'OrderedDict[EntityFingerprintKey, Tuple[Tuple, float]]' = OrderedDict()
+    entity_fingerprint_ttl: int = 60 * 60
+    max_entity_fingerprints: int = 10000
 
     client: Optional[MautrixTelegramClient]
     mxid: Optional[UserID]
@@ -229,14 +245,16 @@ class AbstractUser(ABC):
         return self
 
     async def stop(self) -> None:
+        # Users that were never started or have been hibernated don't have a client.
+        if not self.client:
+            return
         await self.client.disconnect()
         self.client = None
 
     # region Telegram update handling
 
     async def _update(self, update: TypeUpdate) -> None:
-        asyncio.ensure_future(self._handle_entity_updates(getattr(update, "_entities", {})),
-                              loop=self.loop)
+        self._queue_entity_updates(getattr(update, "_entities", {}))
         if isinstance(update, (UpdateShortChatMessage, UpdateShortMessage, UpdateNewChannelMessage,
                                UpdateNewMessage, UpdateEditMessage, UpdateEditChannelMessage)):
             await self.update_message(update)
@@ -289,12 +307,8 @@ class AbstractUser(ABC):
             return
 
         # We check that these are user read receipts, so tg_space is always the user ID.
-        message = DBMessage.get_one_by_tgid(TelegramID(update.max_id), self.tgid, edit_index=-1)
-        if not message:
-            return
-
-        puppet = pu.Puppet.get(TelegramID(update.peer.user_id))
-        await puppet.intent.mark_read(portal.mxid, message.mxid)
+        self.read_receipt_batcher.add((portal.mxid, self.tgid, TelegramID(update.peer.user_id)),
+                                      TelegramID(update.max_id))
 
     async def update_own_read_receipt(self, update: Union[UpdateReadHistoryInbox,
                                                           UpdateReadChannelInbox]) -> None:
@@ -316,11 +330,28 @@ class AbstractUser(ABC):
             return
 
         tg_space = portal.tgid if portal.peer_type == "channel" else self.tgid
-        message = DBMessage.get_one_by_tgid(TelegramID(update.max_id), tg_space, edit_index=-1)
-        if not message:
-            return
+        self.read_receipt_batcher.add((portal.mxid, tg_space, self.tgid),
+                                      TelegramID(update.max_id))
 
-        await puppet.intent.mark_read(portal.mxid, message.mxid)
+    @staticmethod
+    async def _flush_read_receipts(receipts: ReadReceiptBatch) -> None:
+        # Telegram sends read receipts in bursts (e.g. one per message while scrolling through a
+        # chat), so only the newest message per room and reader is marked as read on Matrix.
+        # That message may not have been bridged (e.g. service messages), in which case the
+        # newest bridged message before it is marked instead.
+        async def mark_read(room_id: RoomID, tg_space: TelegramID, reader: TelegramID,
+                            max_id: TelegramID) -> None:
+            message = DBMessage.find_last_up_to(room_id, tg_space, max_id)
+            if message:
+                puppet = pu.Puppet.get(reader)
+                await puppet.intent.mark_read(room_id, message.mxid)
+
+        results = await asyncio.gather(*[mark_read(*key, max(max_ids))
+                                         for key, max_ids in receipts.items()],
+                                       return_exceptions=True)
+        for key, result in zip(receipts.keys(), results):
+            if isinstance(result, Exception):
+                log.warning(f"Failed to bridge read receipt {key}: {result}")
 
     async def update_admin(self, update: UpdateChatParticipantAdmin) -> None:
         # TODO duplication not checked
@@ -342,15 +373,58 @@ class AbstractUser(ABC):
         sender = pu.Puppet.get(TelegramID(update.user_id))
         await portal.handle_telegram_typing(sender, update)
 
-    async def _handle_entity_updates(self, entities: Dict[int, Union[User, Chat, Channel]]
-                                     ) -> None:
-        try:
-            users = (entity for entity in entities.values() if isinstance(entity, User))
-            puppets = ((pu.Puppet.get(TelegramID(user.id)), user) for user in users)
-            await asyncio.gather(*[puppet.try_update_info(self, info)
-                                   for puppet, info in puppets if puppet])
-        except Exception:
-            self.log.exception("Failed to handle entity updates")
+    @staticmethod
+    def _entity_fingerprint(info: User) -> Tuple:
+        photo_id = info.photo.photo_id if isinstance(info.photo, UserProfilePhoto) else None
+        return (info.username, info.first_name, info.last_name, info.phone, photo_id,
+                info.contact, info.deleted, info.bot)
+
+    def _queue_entity_updates(self, entities: Dict[int, Union[User, Chat, Channel]]) -> None:
+        # Almost every update includes the info of its sender, so the info is only handled when it
+        # has changed since the last time (or the fingerprint has expired).
+        now = time.monotonic()
+        for info in entities.values():
+            if not isinstance(info, User):
+                continue
+            # The names of contacts depend on who the contact belongs to, so contact info is
+            # tracked separately for each source user.
+            key = (TelegramID(info.id), self.tgid if info.contact else None)
+            fingerprint = self._entity_fingerprint(info)
+            try:
+                prev_fingerprint, expires_at = self.entity_fingerprints[key]
+                if prev_fingerprint == fingerprint and expires_at > now:
+                    self.entity_fingerprints.move_to_end(key)
+                    continue
+            except KeyError:
+                pass
+            try:
+                self.entity_update_queue.put_nowait((self, key, info))
+            except asyncio.QueueFull:
+                self.log.debug(f"Entity update queue is full, dropping info of {info.id}")
+                continue
+            self.entity_fingerprints[key] = (fingerprint, now + self.entity_fingerprint_ttl)
+            self.entity_fingerprints.move_to_end(key)
+            if len(self.entity_fingerprints) > self.max_entity_fingerprints:
+                self.entity_fingerprints.popitem(last=False)
+        if not self.entity_update_workers and not self.entity_update_queue.empty():
+            AbstractUser.entity_update_workers = [
+                asyncio.ensure_future(self._entity_update_worker(), loop=self.loop)
+                for _ in range(self.entity_update_concurrency)]
+
+    @classmethod
+    async def _entity_update_worker(cls) -> None:
+        while True:
+            source, key, info = await cls.entity_update_queue.get()
+            try:
+                puppet = pu.Puppet.get(TelegramID(info.id))
+                if puppet:
+                    await puppet.update_info(source, info)
+            except Exception:
+                source.log.exception(f"Failed to update info of {info.id}")
+                # Make sure the update is retried next time the info is received.
+                cls.entity_fingerprints.pop(key, None)
+            finally:
+                cls.entity_update_queue.task_done()
 
     async def update_others_info(self, update: Union[UpdateUserName, UpdateUserPhoto]) -> None:
         # TODO duplication not checked
@@ -366,14 +440,19 @@ class AbstractUser(ABC):
             self.log.warning(f"Unexpected other user info update: {type(update)}")
 
     async def update_status(self, update: UpdateUserStatus) -> None:
-        puppet = pu.Puppet.get(TelegramID(update.user_id))
         if isinstance(update.status, UserStatusOnline):
-            await puppet.default_mxid_intent.set_presence(PresenceState.ONLINE)
+            presence = PresenceState.ONLINE
         elif isinstance(update.status, UserStatusOffline):
-            await puppet.default_mxid_intent.set_presence(PresenceState.OFFLINE)
+            presence = PresenceState.OFFLINE
         else:
             self.log.warning(f"Unexpected user status update: type({update})")
-        return
+            return
+        # Every logged in user receives status updates for all their contacts, so the same
+        # transitions arrive many times. The coalescer drops the repeats and sends the rest in the
+        # background with limited parallelism.
+        puppet = pu.Puppet.get(TelegramID(update.user_id))
+        self.presence_coalescer.submit(puppet.tgid, presence,
+                                       puppet.default_mxid_intent.set_presence)
 
     def get_message_details(self, update: UpdateMessage) -> Tuple[UpdateMessageContent,
                                                                   Optional[pu.Puppet],
@@ -406,6 +485,7 @@ class AbstractUser(ABC):
 
     @staticmethod
     async def _try_redact(message: DBMessage) -> None:
+        util.remove_recent_event(message.mxid)
         portal = po.Portal.get_by_mxid(message.mx_room)
         if not portal:
             return
@@ -488,4 +568,12 @@ def init(context: 'Context') -> None:
     AbstractUser.az, config, AbstractUser.loop, AbstractUser.relaybot = context.core
     AbstractUser.ignore_incoming_bot_events = config["bridge.relaybot.ignore_own_incoming_events"]
     AbstractUser.session_container = context.session_container
+    AbstractUser.read_receipt_batcher = util.WindowBatcher(
+        window=1, flush=AbstractUser._flush_read_receipts)
+    AbstractUser.presence_coalescer = util.StateCoalescer(
+        "telegram_presence", min_interval=config["bridge.presence_min_interval"],
+        refresh_interval=config["bridge.presence_refresh_interval"],
+        max_concurrency=config["bridge.presence_concurrency"])
+    AbstractUser.entity_update_queue = asyncio.Queue(config["bridge.entity_update_queue_size"])
+    AbstractUser.entity_update_concurrency = max(config["bridge.entity_update_concurrency"], 1)
     MAX_DELETIONS = config.get("bridge.max_telegram_delete", 10)
@@ -156,7 +156,7 @@ async def confirm_bridge(evt: CommandEvent) -> Optional[EventID]:
                                "`$cmdprefix+sp cancel` to cancel.")
 
     evt.sender.command_status = None
-    async with portal._room_create_lock:
+    async with portal.room_create_lock:
         await _locked_confirm_bridge(evt, portal=portal, room_id=bridge_to_mxid,
                                      is_logged_in=is_logged_in)
 
@@ -186,6 +186,7 @@ async def _locked_confirm_bridge(evt: CommandEvent, portal: 'po.Portal', room_id
      portal.encrypted) = await get_initial_state(evt.az.intent, evt.room_id)
     portal.photo_id = ""
     await portal.save()
+    portal.reset_participant_pages()
 
     asyncio.ensure_future(portal.update_matrix_room(user, entity, direct=False, levels=levels),
                           loop=evt.loop)
@@ -61,6 +61,7 @@ async def sync_full(evt: CommandEvent) -> EventID:
     except (ValueError, RPCError):
         return await evt.reply("Failed to get portal info from Telegram.")
 
+    portal.reset_participant_pages()
     await portal.update_matrix_room(src, res.full_chat)
     return await evt.reply("Portal synced successfully.")
 
@@ -86,11 +86,23 @@ class Config(BaseBridgeConfig):
         copy("bridge.displayname_preference")
         copy("bridge.displayname_max_length")
         copy("bridge.allow_avatar_remove")
+        copy("bridge.max_parallel_avatar_transfers")
 
         copy("bridge.max_initial_member_sync")
         copy("bridge.sync_channel_members")
         copy("bridge.skip_deleted_members")
+        copy("bridge.member_sync_concurrency")
         copy("bridge.startup_sync")
+        copy("bridge.startup_concurrency")
+        copy("bridge.startup_delay")
+        copy("bridge.startup_idle_days")
+        copy("bridge.hibernate_idle_hours")
+        copy("bridge.matrix_event_room_queue_size")
+        copy("bridge.matrix_event_max_pending")
+        copy("bridge.warm_up_caches")
+        copy("bridge.max_cached_portals")
+        copy("bridge.max_cached_puppets")
+        copy("bridge.max_cached_users")
         if "bridge.sync_dialog_limit" in self:
             base["bridge.sync_create_limit"] = self["bridge.sync_dialog_limit"]
             base["bridge.sync_update_limit"] = self["bridge.sync_dialog_limit"]
@@ -99,6 +111,11 @@ class Config(BaseBridgeConfig):
             copy("bridge.sync_create_limit")
         copy("bridge.sync_direct_chats")
         copy("bridge.max_telegram_delete")
+        copy("bridge.presence_min_interval")
+        copy("bridge.presence_refresh_interval")
+        copy("bridge.presence_concurrency")
+        copy("bridge.entity_update_concurrency")
+        copy("bridge.entity_update_queue_size")
         copy("bridge.sync_matrix_state")
         copy("bridge.allow_matrix_login")
         copy("bridge.plaintext_highlights")
@@ -132,6 +149,8 @@ class Config(BaseBridgeConfig):
         copy("bridge.delivery_receipts")
         copy("bridge.delivery_error_reports")
         copy("bridge.resend_bridge_info")
+        copy("bridge.resend_bridge_info_concurrency")
+        copy("bridge.resend_bridge_info_progress")
         copy("bridge.backfill.invite_own_puppet")
         copy("bridge.backfill.takeout_limit")
         copy("bridge.backfill.initial_limit")
@@ -197,6 +216,7 @@ class Config(BaseBridgeConfig):
         copy("telegram.api_id")
         copy("telegram.api_hash")
         copy("telegram.bot_token")
+        copy("telegram.cache_session")
 
         copy("telegram.connection.timeout")
         copy("telegram.connection.retries")
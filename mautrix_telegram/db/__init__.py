@@ -19,6 +19,7 @@ from mautrix.client.state_store.sqlalchemy import UserProfile, RoomState
 
 from .bot_chat import BotChat
 from .message import Message
+from .participants import PortalParticipants
 from .portal import Portal
 from .puppet import Puppet
 from .telegram_file import TelegramFile
@@ -27,5 +28,5 @@ from .user import User, UserPortal, Contact
 
 def init(db_engine: Engine) -> None:
     for table in (Portal, Message, User, Contact, UserPortal, Puppet, TelegramFile, UserProfile,
-                  RoomState, BotChat):
+                  RoomState, BotChat, PortalParticipants):
         table.bind(db_engine)
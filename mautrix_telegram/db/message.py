@@ -75,6 +75,14 @@ class Message(Base):
             cls._make_simple_select(cls.c.mx_room == mx_room, cls.c.tg_space == tg_space)
                 .order_by(desc(cls.c.tgid)).limit(1)))
 
+    @classmethod
+    def find_last_up_to(cls, mx_room: RoomID, tg_space: TelegramID, max_tgid: TelegramID
+                        ) -> Optional['Message']:
+        return cls._one_or_none(cls.db.execute(
+            cls._make_simple_select(cls.c.mx_room == mx_room, cls.c.tg_space == tg_space,
+                                    cls.c.tgid <= max_tgid)
+                .order_by(desc(cls.c.tgid), desc(cls.c.edit_index)).limit(1)))
+
     @classmethod
     def delete_all(cls, mx_room: RoomID) -> None:
         cls.db.execute(cls.t.delete().where(cls.c.mx_room == mx_room))
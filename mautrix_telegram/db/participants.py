@@ -0,0 +1,70 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, List, Tuple
+
+from sqlalchemy import Column, Integer, BigInteger, Text, ForeignKeyConstraint
+
+from mautrix.util.db import Base
+
+from ..types import TelegramID
+
+
+# The participant list of a channel as of the last sync, split into the pages it was requested
+# in. The hash of each page is sent back to Telegram on the next sync so that unchanged pages
+# don't have to be downloaded and processed again.
+class PortalParticipants(Base):
+    __tablename__ = "portal_participants"
+
+    portal: TelegramID = Column(Integer, primary_key=True)
+    portal_receiver: TelegramID = Column(Integer, primary_key=True)
+    page: int = Column(Integer, primary_key=True)
+    hash: int = Column(BigInteger, nullable=False)
+    user_ids: str = Column(Text, nullable=False)
+
+    __table_args__ = (ForeignKeyConstraint(("portal", "portal_receiver"),
+                                           ("portal.tgid", "portal.tg_receiver"),
+                                           onupdate="CASCADE", ondelete="CASCADE"),)
+
+    @classmethod
+    def get_pages(cls, tgid: TelegramID, tg_receiver: TelegramID
+                  ) -> Dict[int, Tuple[int, List[TelegramID]]]:
+        rows = cls.db.execute(cls.t.select().where((cls.c.portal == tgid)
+                                                   & (cls.c.portal_receiver == tg_receiver)))
+        return {row[cls.c.page]: (row[cls.c.hash],
+                                  [TelegramID(int(user_id))
+                                   for user_id in row[cls.c.user_ids].split(",") if user_id])
+                for row in rows}
+
+    @classmethod
+    def set_pages(cls, tgid: TelegramID, tg_receiver: TelegramID,
+                  pages: Dict[int, Tuple[int, List[TelegramID]]]) -> None:
+        with cls.db.begin() as conn:
+            conn.execute(cls.t.delete().where((cls.c.portal == tgid)
+                                              & (cls.c.portal_receiver == tg_receiver)))
+            if pages:
+                conn.execute(cls.t.insert(), [{
+                    "portal": tgid,
+                    "portal_receiver": tg_receiver,
+                    "page": page,
+                    "hash": page_hash,
+                    "user_ids": ",".join(str(user_id) for user_id in user_ids),
+                } for page, (page_hash, user_ids) in pages.items()])
+
+    @classmethod
+    def delete_all(cls, tgid: TelegramID, tg_receiver: TelegramID) -> None:
+        with cls.db.begin() as conn:
+            conn.execute(cls.t.delete().where((cls.c.portal == tgid)
+                                              & (cls.c.portal_receiver == tg_receiver)))
@@ -13,9 +13,9 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, Iterable
+from typing import Optional, Iterable, List, Tuple
 
-from sqlalchemy import Column, Integer, String, Boolean, Text, func, sql
+from sqlalchemy import Column, Integer, String, Boolean, Text, Index, and_, func, or_, sql
 
 from mautrix.types import RoomID, ContentURI
 from mautrix.util.db import Base
@@ -64,3 +64,19 @@ class Portal(Base):
     @classmethod
     def all(cls) -> Iterable['Portal']:
         yield from cls._select_all()
+
+    @classmethod
+    def get_page_with_mxid(cls, after: Optional[Tuple[TelegramID, TelegramID]], limit: int
+                           ) -> List['Portal']:
+        # Keyset pagination over the primary key, so that each page is equally fast to fetch and
+        # rows inserted while paging don't shift the pages.
+        query = cls._make_simple_select(cls.c.mxid != None)
+        if after:
+            tgid, tg_receiver = after
+            query = query.where(or_(cls.c.tgid > tgid,
+                                    and_(cls.c.tgid == tgid, cls.c.tg_receiver > tg_receiver)))
+        query = query.order_by(cls.c.tgid, cls.c.tg_receiver).limit(limit)
+        return list(cls._all(cls.db.execute(query)))
+
+
+Index("ix_portal_username_lower", func.lower(Portal.__table__.c.username))
@@ -13,9 +13,9 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, Iterable
+from typing import Optional, Iterable, List
 
-from sqlalchemy import Column, Integer, String, Text, Boolean
+from sqlalchemy import Column, Integer, String, Text, Boolean, Index, sql
 from sqlalchemy.sql import expression, func
 
 from mautrix.types import UserID, SyncToken
@@ -49,6 +49,24 @@ class Puppet(Base):
     def get_by_tgid(cls, tgid: TelegramID) -> Optional['Puppet']:
         return cls._select_one_or_none(cls.c.id == tgid)
 
+    @classmethod
+    def all_ids(cls) -> Iterable[TelegramID]:
+        for row in cls.db.execute(sql.select([cls.c.id])):
+            yield row[0]
+
+    @classmethod
+    def get_many_by_tgid(cls, tgids: List[TelegramID]) -> Iterable['Puppet']:
+        # Chunked to stay below the SQLite bound parameter limit
+        for i in range(0, len(tgids), 500):
+            yield from cls._select_all(cls.c.id.in_(tgids[i:i + 500]))
+
+    @classmethod
+    def bulk_insert(cls, puppets: Iterable['Puppet']) -> None:
+        values = [puppet._insert_values for puppet in puppets]
+        if values:
+            with cls.db.begin() as conn:
+                conn.execute(cls.t.insert(), values)
+
     @classmethod
     def get_by_custom_mxid(cls, mxid: UserID) -> Optional['Puppet']:
         return cls._select_one_or_none(cls.c.custom_mxid == mxid)
@@ -60,3 +78,8 @@ class Puppet(Base):
     @classmethod
     def get_by_displayname(cls, displayname: str) -> Optional['Puppet']:
         return cls._select_one_or_none(cls.c.displayname == displayname)
+
+
+# Functional index so that case-insensitive username lookups don't need a full table scan
+Index("ix_puppet_username_lower", func.lower(Puppet.__table__.c.username))
+Index("ix_puppet_displayname", Puppet.__table__.c.displayname)
@@ -0,0 +1,245 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
+import datetime
+import logging
+
+from sqlalchemy import Table, and_, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine.base import Connection
+
+from telethon.sessions.memory import _SentFileType
+from telethon.tl.types import InputPhoto, InputDocument, PeerUser, PeerChat, PeerChannel, updates
+from telethon import utils
+from alchemysession.core import AlchemyCoreSession
+
+log: logging.Logger = logging.getLogger("mau.db.session")
+
+# (id, hash, username, phone, name)
+EntityRow = Tuple[int, int, Optional[str], Optional[str], Optional[str]]
+# (md5 digest, file size, file type)
+SentFileKey = Tuple[bytes, int, int]
+
+
+# A Telethon session that keeps the entities, update states and sent files of the session in
+# memory and only writes changes to the database when Telethon saves the session (about once a
+# minute) or the client disconnects. The session and auth key are still written immediately, and
+# the tables are the same as with the normal session, so switching between them (or migrating
+# the database) works as usual.
+class CachedSession(AlchemyCoreSession):
+    _loaded: bool
+    _entity_rows: Dict[int, EntityRow]
+    _ids_by_username: Dict[str, int]
+    _ids_by_phone: Dict[str, int]
+    _ids_by_name: Dict[str, int]
+    _sent_files: Dict[SentFileKey, Tuple[int, int]]
+    _update_state_rows: Dict[int, updates.State]
+    _dirty_entities: Set[int]
+    _dirty_files: Set[SentFileKey]
+    _dirty_update_states: Set[int]
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._loaded = False
+        self._entity_rows = {}
+        self._ids_by_username = {}
+        self._ids_by_phone = {}
+        self._ids_by_name = {}
+        self._sent_files = {}
+        self._update_state_rows = {}
+        self._dirty_entities = set()
+        self._dirty_files = set()
+        self._dirty_update_states = set()
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        t = self.Entity.__table__
+        rows = self.engine.execute(select([t.c.id, t.c.hash, t.c.username, t.c.phone, t.c.name])
+                                   .where(t.c.session_id == self.session_id))
+        for entity_id, entity_hash, username, phone, name in rows:
+            # Phone numbers are stored as integers, but Telethon looks them up as strings.
+            phone = str(phone) if phone else None
+            self._set_entity_row((entity_id, entity_hash, username, phone, name))
+        t = self.SentFile.__table__
+        rows = self.engine.execute(select([t.c.md5_digest, t.c.file_size, t.c.type, t.c.id,
+                                           t.c.hash]).where(t.c.session_id == self.session_id))
+        for md5_digest, file_size, file_type, file_id, file_hash in rows:
+            self._sent_files[(md5_digest, file_size, file_type)] = (file_id, file_hash)
+        t = self.UpdateState.__table__
+        rows = self.engine.execute(select([t.c.entity_id, t.c.pts, t.c.qts, t.c.date, t.c.seq,
+                                           t.c.unread_count])
+                                   .where(t.c.session_id == self.session_id))
+        for entity_id, pts, qts, date, seq, unread_count in rows:
+            date = datetime.datetime.utcfromtimestamp(date)
+            self._update_state_rows[entity_id] = updates.State(pts, qts, date, seq, unread_count)
+
+    def _set_entity_row(self, row: EntityRow) -> bool:
+        entity_id, _, username, phone, name = row
+        if self._entity_rows.get(entity_id) == row:
+            return False
+        self._entity_rows[entity_id] = row
+        if username:
+            self._ids_by_username[username] = entity_id
+        if phone:
+            self._ids_by_phone[phone] = entity_id
+        if name:
+            self._ids_by_name[name] = entity_id
+        return True
+
+    def get_input_user_hashes(self, user_ids: Iterable[int]) -> Dict[int, int]:
+        self._ensure_loaded()
+        hashes = {}
+        for user_id in user_ids:
+            try:
+                hashes[user_id] = self._entity_rows[user_id][1]
+            except KeyError:
+                pass
+        return hashes
+
+    def process_entities(self, tlo: Any) -> None:
+        rows = self._entities_to_rows(tlo)
+        if not rows:
+            return
+        self._ensure_loaded()
+        for row in rows:
+            if self._set_entity_row(row):
+                self._dirty_entities.add(row[0])
+
+    def _get_entity_row_by_index(self, index: Dict[Any, int], key: Any, field: int
+                                 ) -> Optional[Tuple[int, int]]:
+        self._ensure_loaded()
+        try:
+            row = self._entity_rows[index[key]]
+        except KeyError:
+            return None
+        # The index isn't cleaned up when an entity changes, so make sure it's still valid.
+        return (row[0], row[1]) if row[field] == key else None
+
+    def get_entity_rows_by_username(self, key: str) -> Optional[Tuple[int, int]]:
+        return self._get_entity_row_by_index(self._ids_by_username, key, 2)
+
+    def get_entity_rows_by_phone(self, key: str) -> Optional[Tuple[int, int]]:
+        return self._get_entity_row_by_index(self._ids_by_phone, key, 3)
+
+    def get_entity_rows_by_name(self, key: str) -> Optional[Tuple[int, int]]:
+        return self._get_entity_row_by_index(self._ids_by_name, key, 4)
+
+    def get_entity_rows_by_id(self, key: int, exact: bool = True) -> Optional[Tuple[int, int]]:
+        self._ensure_loaded()
+        if exact:
+            ids = (key,)
+        else:
+            ids = (utils.get_peer_id(PeerUser(key)),
+                   utils.get_peer_id(PeerChat(key)),
+                   utils.get_peer_id(PeerChannel(key)))
+        for entity_id in ids:
+            try:
+                row = self._entity_rows[entity_id]
+            except KeyError:
+                continue
+            return row[0], row[1]
+        return None
+
+    def get_update_state(self, entity_id: int) -> Optional[updates.State]:
+        self._ensure_loaded()
+        return self._update_state_rows.get(entity_id)
+
+    def set_update_state(self, entity_id: int, row: Any) -> None:
+        if not row:
+            return
+        self._ensure_loaded()
+        self._update_state_rows[entity_id] = row
+        self._dirty_update_states.add(entity_id)
+
+    def get_file(self, md5_digest: bytes, file_size: int, cls: Any
+                 ) -> Optional[Tuple[int, int]]:
+        self._ensure_loaded()
+        return self._sent_files.get((md5_digest, file_size, _SentFileType.from_type(cls).value))
+
+    def cache_file(self, md5_digest: bytes, file_size: int,
+                   instance: Union[InputDocument, InputPhoto]) -> None:
+        if not isinstance(instance, (InputDocument, InputPhoto)):
+            raise TypeError("Cannot cache {} instance".format(type(instance)))
+        self._ensure_loaded()
+        key = (md5_digest, file_size, _SentFileType.from_type(type(instance)).value)
+        self._sent_files[key] = (instance.id, instance.access_hash)
+        self._dirty_files.add(key)
+
+    def _upsert(self, conn: Connection, table: Table, rows: List[Dict[str, Any]]) -> None:
+        dialect = self.engine.dialect.name
+        if dialect == "postgresql":
+            ins = pg_insert(table)
+            conn.execute(ins.on_conflict_do_update(
+                constraint=table.primary_key,
+                set_={col.name: ins.excluded[col.name] for col in table.columns
+                      if not col.primary_key}), rows)
+        elif dialect == "sqlite":
+            conn.execute(table.insert().prefix_with("OR REPLACE"), rows)
+        else:
+            for row in rows:
+                conn.execute(table.delete().where(and_(*[col == row[col.name]
+                                                         for col in table.primary_key])))
+            conn.execute(table.insert(), rows)
+
+    def save(self) -> None:
+        if not self._dirty_entities and not self._dirty_files and not self._dirty_update_states:
+            return
+        entities, self._dirty_entities = self._dirty_entities, set()
+        files, self._dirty_files = self._dirty_files, set()
+        states, self._dirty_update_states = self._dirty_update_states, set()
+        try:
+            with self.engine.begin() as conn:
+                if entities:
+                    self._upsert(conn, self.Entity.__table__, [
+                        dict(session_id=self.session_id, id=row[0], hash=row[1],
+                             username=row[2], phone=row[3], name=row[4])
+                        for row in (self._entity_rows[entity_id] for entity_id in entities)])
+                if files:
+                    self._upsert(conn, self.SentFile.__table__, [
+                        dict(session_id=self.session_id, md5_digest=key[0], file_size=key[1],
+                             type=key[2], id=self._sent_files[key][0],
+                             hash=self._sent_files[key][1])
+                        for key in files])
+                if states:
+                    self._upsert(conn, self.UpdateState.__table__, [
+                        dict(session_id=self.session_id, entity_id=entity_id, pts=state.pts,
+                             qts=state.qts, date=state.date.timestamp(), seq=state.seq,
+                             unread_count=state.unread_count)
+                        for entity_id, state in ((entity_id, self._update_state_rows[entity_id])
+                                                 for entity_id in states)])
+        except Exception:
+            log.exception(f"Failed to save session {self.session_id}")
+            # Try again on the next save
+            self._dirty_entities |= entities
+            self._dirty_files |= files
+            self._dirty_update_states |= states
+
+    def close(self) -> None:
+        self.save()
+
+    def delete(self) -> None:
+        self._dirty_entities.clear()
+        self._dirty_files.clear()
+        self._dirty_update_states.clear()
+        self._entity_rows.clear()
+        self._ids_by_username.clear()
+        self._ids_by_phone.clear()
+        self._ids_by_name.clear()
+        self._sent_files.clear()
+        self._update_state_rows.clear()
+        super().delete()
@@ -13,9 +13,12 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, Iterable, Tuple
+from typing import Optional, Iterable, Tuple, List, Dict, Any, Collection
 
-from sqlalchemy import Column, ForeignKey, ForeignKeyConstraint, Integer, String, func
+from sqlalchemy import (Column, ForeignKey, ForeignKeyConstraint, Integer, String, Index, Table,
+                        func, and_, or_)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine.base import Connection
 
 from mautrix.types import UserID
 from mautrix.util.db import Base
@@ -31,15 +34,39 @@ class User(Base):
     tg_username: str = Column(String, nullable=True)
     tg_phone: str = Column(String, nullable=True)
     saved_contacts: int = Column(Integer, default=0, nullable=False)
+    last_activity: int = Column(Integer, default=0, server_default="0", nullable=False)
+
+    @classmethod
+    def all(cls) -> Iterable['User']:
+        return cls._select_all()
 
     @classmethod
     def all_with_tgid(cls) -> Iterable['User']:
         return cls._select_all(cls.c.tgid != None)
 
+    @classmethod
+    def all_contacts(cls) -> Dict[TelegramID, List[TelegramID]]:
+        contacts = {}
+        for user, contact in cls.db.execute(Contact.t.select()):
+            contacts.setdefault(user, []).append(contact)
+        return contacts
+
+    @classmethod
+    def all_portals(cls) -> Dict[TelegramID, List[Tuple[TelegramID, TelegramID]]]:
+        portals = {}
+        for user, portal, portal_receiver in cls.db.execute(UserPortal.t.select()):
+            portals.setdefault(user, []).append((portal, portal_receiver))
+        return portals
+
     @classmethod
     def get_by_tgid(cls, tgid: TelegramID) -> Optional['User']:
         return cls._select_one_or_none(cls.c.tgid == tgid)
 
+    @classmethod
+    def get_many_by_tgid(cls, tgids: List[TelegramID]) -> Iterable['User']:
+        for i in range(0, len(tgids), 500):
+            yield from cls._select_all(cls.c.tgid.in_(tgids[i:i + 500]))
+
     @classmethod
     def get_by_mxid(cls, mxid: UserID) -> Optional['User']:
         return cls._select_one_or_none(cls.c.mxid == mxid)
@@ -63,6 +90,17 @@ class User(Base):
             if insert_puppets:
                 conn.execute(Contact.t.insert(), insert_puppets)
 
+    def update_contacts(self, add: Collection[TelegramID], remove: Collection[TelegramID]
+                        ) -> None:
+        with self.db.begin() as conn:
+            remove = list(remove)
+            for i in range(0, len(remove), 500):
+                conn.execute(Contact.t.delete().where((Contact.c.user == self.tgid)
+                                                      & Contact.c.contact.in_(remove[i:i + 500])))
+            if add:
+                self._insert_ignore(conn, Contact.t, [{"user": self.tgid, "contact": tgid}
+                                                      for tgid in add])
+
     @property
     def portals(self) -> Iterable[Tuple[TelegramID, TelegramID]]:
         rows = self.db.execute(UserPortal.t.select().where(UserPortal.c.user == self.tgid))
@@ -82,6 +120,32 @@ class User(Base):
             if insert_portals:
                 conn.execute(UserPortal.t.insert(), insert_portals)
 
+    def update_portals(self, add: Collection[Tuple[TelegramID, TelegramID]],
+                       remove: Collection[Tuple[TelegramID, TelegramID]]) -> None:
+        with self.db.begin() as conn:
+            remove = list(remove)
+            for i in range(0, len(remove), 100):
+                conn.execute(UserPortal.t.delete().where(
+                    (UserPortal.c.user == self.tgid)
+                    & or_(*[and_(UserPortal.c.portal == tgid,
+                                 UserPortal.c.portal_receiver == tg_receiver)
+                            for tgid, tg_receiver in remove[i:i + 100]])))
+            if add:
+                self._insert_ignore(conn, UserPortal.t, [{
+                    "user": self.tgid,
+                    "portal": tgid,
+                    "portal_receiver": tg_receiver,
+                } for tgid, tg_receiver in add])
+
+    def _insert_ignore(self, conn: Connection, table: Table, rows: List[Dict[str, Any]]) -> None:
+        # Rows that already exist are skipped, in case the database has changed under us.
+        if self.db.dialect.name == "postgresql":
+            conn.execute(pg_insert(table).on_conflict_do_nothing(), rows)
+        elif self.db.dialect.name == "sqlite":
+            conn.execute(table.insert().prefix_with("OR IGNORE"), rows)
+        else:
+            conn.execute(table.insert(), rows)
+
     def delete(self) -> None:
         super().delete()
         self.portals = []
@@ -106,3 +170,6 @@ class Contact(Base):
 
     user: TelegramID = Column(Integer, ForeignKey("user.tgid"), primary_key=True)
     contact: TelegramID = Column(Integer, ForeignKey("puppet.id"), primary_key=True)
+
+
+Index("ix_user_tg_username_lower", func.lower(User.__table__.c.tg_username))
@@ -20,13 +20,13 @@ import logging
 from telethon.tl.types import (MessageEntityMention, MessageEntityMentionName, MessageEntityItalic,
                                TypeMessageEntity, InputMessageEntityMentionName)
 from telethon.helpers import add_surrogate, del_surrogate
-from telethon import TelegramClient
 
 from mautrix.types import RoomID, MessageEventContent
 from mautrix.util.logging import TraceLogger
 
 from ... import puppet as pu
 from ...types import TelegramID
+from ...tgclient import MautrixTelegramClient
 from ...db import Message as DBMessage
 from .parser import ParsedMessage, parse_html
 
@@ -77,7 +77,7 @@ def matrix_reply_to_telegram(content: MessageEventContent, tg_space: TelegramID,
     return None
 
 
-async def matrix_to_telegram(client: TelegramClient, *, text: Optional[str] = None,
+async def matrix_to_telegram(client: MautrixTelegramClient, *, text: Optional[str] = None,
                              html: Optional[str] = None) -> ParsedMessage:
     if html is not None:
         text, entities = _matrix_html_to_telegram(html)
@@ -89,11 +89,23 @@ async def matrix_to_telegram(client: TelegramClient, *, text: Optional[str] = No
     return text, entities
 
 
+def _is_plain_text(text: str) -> bool:
+    # Messages that can't match any of the prefix regexes and don't contain any markup don't need
+    # to go through the regexes or the HTML parser at all.
+    return not should_bridge_plaintext_highlights and not text.startswith(("!", "\\"))
+
+
 def _matrix_html_to_telegram(html: str) -> ParsedMessage:
     try:
-        html = command_regex.sub(r"<command>\1</command>", html)
+        if _is_plain_text(html) and "<" not in html and "&" not in html:
+            text = html.replace("\t", " " * 4).replace("\n", "").strip()
+            return _cut_long_message(text, [])
+
+        if html.startswith("!"):
+            html = command_regex.sub(r"<command>\1</command>", html)
         html = html.replace("\t", " " * 4)
-        html = not_command_regex.sub(r"\1", html)
+        if html.startswith("\\"):
+            html = not_command_regex.sub(r"\1", html)
         if should_bridge_plaintext_highlights:
             html = plain_mention_regex.sub(_plain_mention_to_html, html)
 
@@ -107,9 +119,14 @@ def _matrix_html_to_telegram(html: str) -> ParsedMessage:
 
 
 def _matrix_text_to_telegram(text: str) -> ParsedMessage:
-    text = command_regex.sub(r"/\1", text)
+    if _is_plain_text(text):
+        return text.replace("\t", " " * 4), []
+
+    if text.startswith("!"):
+        text = command_regex.sub(r"/\1", text)
     text = text.replace("\t", " " * 4)
-    text = not_command_regex.sub(r"\1", text)
+    if text.startswith("\\"):
+        text = not_command_regex.sub(r"\1", text)
     if should_bridge_plaintext_highlights:
         entities, pmr_replacer = _plain_mention_to_text()
         text = plain_mention_regex.sub(pmr_replacer, text)
@@ -118,14 +135,20 @@ def _matrix_text_to_telegram(text: str) -> ParsedMessage:
     return text, entities
 
 
-async def _fix_name_mentions(client: TelegramClient, entities: List[TypeMessageEntity]) -> None:
+async def _fix_name_mentions(client: MautrixTelegramClient, entities: List[TypeMessageEntity]
+                             ) -> None:
+    mention_types = (MessageEntityMentionName, InputMessageEntityMentionName)
+    user_ids = {entity.user_id for entity in entities if isinstance(entity, mention_types)}
+    if not user_ids:
+        return
+    input_users = await client.get_input_users(user_ids)
     for index in reversed(range(len(entities))):
         entity = entities[index]
-        if isinstance(entity, (MessageEntityMentionName, InputMessageEntityMentionName)):
+        if isinstance(entity, mention_types):
             try:
-                user = await client.get_input_entity(entity.user_id)
-            except (ValueError, TypeError) as e:
-                log.trace(f"Dropping mention of {entity.user_id}: {e}")
+                user = input_users[entity.user_id]
+            except KeyError:
+                log.trace(f"Dropping mention of {entity.user_id}: input entity not found")
                 del entities[index]
             else:
                 entities[index] = InputMessageEntityMentionName(entity.offset, entity.length, user)
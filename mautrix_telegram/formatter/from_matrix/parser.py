@@ -13,11 +13,12 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import List, Tuple, Optional
+from typing import Dict, List, Tuple, Optional
+from html.parser import HTMLParser
 
 from telethon.tl.types import TypeMessageEntity
 
-from mautrix.types import UserID, RoomID
+from mautrix.types import UserID, RoomID, RoomAlias
 from mautrix.util.formatter import MatrixParser as BaseMatrixParser, RecursionContext
 from mautrix.util.formatter.html_reader_htmlparser import read_html, HTMLNode
 
@@ -29,7 +30,10 @@ ParsedMessage = Tuple[str, List[TypeMessageEntity]]
 
 
 def parse_html(input_html: str) -> ParsedMessage:
-    msg = MatrixParser.parse(input_html)
+    try:
+        msg = StreamingMatrixParser.parse(input_html)
+    except UnsupportedHTML:
+        msg = MatrixParser.parse(input_html)
     return msg.text, msg.telegram_entities
 
 
@@ -41,8 +45,8 @@ class MatrixParser(BaseMatrixParser[TelegramMessage]):
     @classmethod
     def custom_node_to_fstring(cls, node: HTMLNode, ctx: RecursionContext
                                ) -> Optional[TelegramMessage]:
-        msg = cls.tag_aware_parse_node(node, ctx)
         if node.tag == "command":
+            msg = cls.tag_aware_parse_node(node, ctx)
             msg.format(TelegramEntityType.COMMAND)
         return None
 
@@ -87,3 +91,107 @@ class MatrixParser(BaseMatrixParser[TelegramMessage]):
         children = msg.trim().split("\n")
         children = [child.prepend("> ") for child in children]
         return TelegramMessage.join(children, "\n")
+
+
+class UnsupportedHTML(Exception):
+    pass
+
+
+# A single-pass converter for HTML that only contains inline formatting. It produces exactly the
+# same output as MatrixParser, but builds the message while reading the HTML instead of building
+# a DOM first and walking it afterwards. Anything that needs the full tree (block elements, lists,
+# preformatted blocks, etc.) raises UnsupportedHTML, and parse_html falls back to MatrixParser.
+class StreamingMatrixParser(HTMLParser):
+    format_tags: Dict[str, TelegramEntityType] = {
+        "b": TelegramEntityType.BOLD, "strong": TelegramEntityType.BOLD,
+        "i": TelegramEntityType.ITALIC, "em": TelegramEntityType.ITALIC,
+        "s": TelegramEntityType.STRIKETHROUGH, "del": TelegramEntityType.STRIKETHROUGH,
+        "u": TelegramEntityType.UNDERLINE, "ins": TelegramEntityType.UNDERLINE,
+    }
+    inline_tags: Tuple[str, ...] = ("a", "code", "span", "font", "command", "body")
+
+    stack: List[Tuple[str, Dict[str, str], TelegramMessage]]
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.stack = [("html", {}, TelegramMessage())]
+
+    @classmethod
+    def parse(cls, data: str) -> TelegramMessage:
+        parser = cls()
+        # Like the DOM reader, only feed the data without calling close(), so that incomplete
+        # trailing markup is ignored the same way.
+        parser.feed(f"<body>{data}</body>")
+        while len(parser.stack) > 1:
+            parser._close_tag()
+        return parser.stack[0][2].trim()
+
+    def _close_tag(self) -> None:
+        tag, attrib, msg = self.stack.pop()
+        if tag == "code":
+            msg.format(TelegramEntityType.INLINE_CODE)
+        else:
+            msg.trim()
+            if tag in self.format_tags:
+                msg.format(self.format_tags[tag])
+            elif tag == "a":
+                msg = self._link_to_fstring(msg, attrib)
+        self.stack[-1][2].append(msg)
+
+    @staticmethod
+    def _link_to_fstring(msg: TelegramMessage, attrib: Dict[str, str]) -> TelegramMessage:
+        href = attrib.get("href", "")
+        if not href:
+            return msg
+
+        if href.startswith("mailto:"):
+            return TelegramMessage(href[len("mailto:"):]).format(TelegramEntityType.EMAIL)
+
+        mention = MatrixParser.mention_regex.match(href)
+        if mention:
+            new_msg = MatrixParser.user_pill_to_fstring(msg, UserID(mention.group(1)))
+            if new_msg:
+                return new_msg
+
+        room = MatrixParser.room_regex.match(href)
+        if room:
+            new_msg = MatrixParser.room_pill_to_fstring(msg, RoomAlias(room.group(1)))
+            if new_msg:
+                return new_msg
+
+        if (MatrixParser.ignore_less_relevant_links
+                and attrib.get(MatrixParser.less_relevant_link_attrib, False)):
+            return msg
+
+        return MatrixParser.url_to_fstring(msg, href)
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, str]]) -> None:
+        # The DOM-based parser joins the children of code elements with spaces,
+        # so only plain text is supported inside them.
+        if self.stack[-1][0] == "code":
+            raise UnsupportedHTML()
+        elif tag == "br":
+            self.stack[-1][2].append("\n")
+        elif tag in self.format_tags or tag in self.inline_tags:
+            self.stack.append((tag, dict(attrs), TelegramMessage()))
+        else:
+            raise UnsupportedHTML()
+
+    def handle_startendtag(self, tag: str, attrs: List[Tuple[str, str]]) -> None:
+        self.handle_starttag(tag, attrs)
+        if tag != "br":
+            self._close_tag()
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag == self.stack[-1][0]:
+            if len(self.stack) == 1:
+                raise UnsupportedHTML()
+            self._close_tag()
+
+    def handle_data(self, data: str) -> None:
+        if self.stack[-1][0] != "code":
+            data = data.replace("\n", "")
+        self.stack[-1][2].append(data)
+
+    def error(self, message: str) -> None:
+        pass
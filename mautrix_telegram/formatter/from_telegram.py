@@ -13,9 +13,11 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import List, Optional, TYPE_CHECKING
+from typing import List, Optional, Tuple, Union, TYPE_CHECKING
+from collections import OrderedDict
 from html import escape
 import logging
+import time
 import re
 
 from telethon.tl.types import (MessageEntityMention, MessageEntityMentionName, MessageEntityUrl,
@@ -28,6 +30,7 @@ from telethon.tl.types import (MessageEntityMention, MessageEntityMentionName, M
 from telethon.tl.custom import Message
 from telethon.errors import RPCError
 from telethon.helpers import add_surrogate, del_surrogate
+from telethon.utils import get_peer_id
 
 from mautrix.errors import MatrixRequestError
 from mautrix.appservice import IntentAPI
@@ -36,6 +39,7 @@ from mautrix.types import (TextMessageEventContent, RelatesTo, RelationType, For
 
 from .. import user as u, puppet as pu, portal as po
 from ..types import TelegramID
+from ..util import get_recent_event
 from ..db import Message as DBMessage
 
 if TYPE_CHECKING:
@@ -43,6 +47,14 @@ if TYPE_CHECKING:
 
 log: logging.Logger = logging.getLogger("mau.fmt.tg")
 
+# Names of forward sources that had to be fetched from Telegram, keyed by the source user and the
+# peer ID. Failed lookups are cached too, but for a shorter time.
+forward_source_cache: 'OrderedDict[Tuple[TelegramID, int], Tuple[float, Optional[str]]]' = (
+    OrderedDict())
+FORWARD_SOURCE_CACHE_SIZE = 1000
+FORWARD_SOURCE_TTL = 60 * 60
+FORWARD_SOURCE_NEGATIVE_TTL = 5 * 60
+
 
 def telegram_reply_to_matrix(evt: Message, source: 'AbstractUser') -> Optional[RelatesTo]:
     if evt.reply_to:
@@ -55,6 +67,33 @@ def telegram_reply_to_matrix(evt: Message, source: 'AbstractUser') -> Optional[R
     return None
 
 
+async def _get_forward_source_name(source: 'AbstractUser',
+                                   peer: Union[PeerUser, PeerChat, PeerChannel]) -> Optional[str]:
+    key = (source.tgid, get_peer_id(peer))
+    try:
+        expiry, name = forward_source_cache[key]
+    except KeyError:
+        pass
+    else:
+        if expiry > time.monotonic():
+            return name
+    try:
+        entity = await source.client.get_entity(peer)
+    except (ValueError, RPCError):
+        entity = None
+    if not entity:
+        name, ttl = None, FORWARD_SOURCE_NEGATIVE_TTL
+    elif isinstance(peer, PeerUser):
+        name, ttl = pu.Puppet.get_displayname(entity, False), FORWARD_SOURCE_TTL
+    else:
+        name, ttl = entity.title, FORWARD_SOURCE_TTL
+    forward_source_cache[key] = (time.monotonic() + ttl, name)
+    forward_source_cache.move_to_end(key)
+    if len(forward_source_cache) > FORWARD_SOURCE_CACHE_SIZE:
+        forward_source_cache.popitem(last=False)
+    return name
+
+
 async def _add_forward_header(source: 'AbstractUser', content: TextMessageEventContent,
                               fwd_from: MessageFwdHeader) -> None:
     if not content.formatted_body or content.format != Format.HTML:
@@ -76,12 +115,11 @@ async def _add_forward_header(source: 'AbstractUser', content: TextMessageEventC
                                  f"{escape(fwd_from_text)}</a>")
 
         if not fwd_from_text:
-            try:
-                user = await source.client.get_entity(fwd_from.from_id)
-                if user:
-                    fwd_from_text = pu.Puppet.get_displayname(user, False)
-                    fwd_from_html = f"<b>{escape(fwd_from_text)}</b>"
-            except (ValueError, RPCError):
+            name = await _get_forward_source_name(source, fwd_from.from_id)
+            if name:
+                fwd_from_text = name
+                fwd_from_html = f"<b>{escape(fwd_from_text)}</b>"
+            else:
                 fwd_from_text = fwd_from_html = "unknown user"
     elif isinstance(fwd_from.from_id, (PeerChannel, PeerChat)):
         from_id = (fwd_from.from_id.chat_id if isinstance(fwd_from.from_id, PeerChat)
@@ -95,12 +133,11 @@ async def _add_forward_header(source: 'AbstractUser', content: TextMessageEventC
             else:
                 fwd_from_html = f"channel <b>{escape(fwd_from_text)}</b>"
         else:
-            try:
-                channel = await source.client.get_entity(fwd_from.from_id)
-                if channel:
-                    fwd_from_text = f"channel {channel.title}"
-                    fwd_from_html = f"channel <b>{escape(channel.title)}</b>"
-            except (ValueError, RPCError):
+            title = await _get_forward_source_name(source, fwd_from.from_id)
+            if title:
+                fwd_from_text = f"channel {title}"
+                fwd_from_html = f"channel <b>{escape(title)}</b>"
+            else:
                 fwd_from_text = fwd_from_html = "unknown channel"
     elif fwd_from.from_name:
         fwd_from_text = fwd_from.from_name
@@ -129,9 +166,11 @@ async def _add_reply_header(source: 'AbstractUser', content: TextMessageEventCon
     content.relates_to = RelatesTo(rel_type=RelationType.REPLY, event_id=msg.mxid)
 
     try:
-        event: MessageEvent = await main_intent.get_event(msg.mx_room, msg.mxid)
-        if isinstance(event.content, TextMessageEventContent):
-            event.content.trim_reply_fallback()
+        event = get_recent_event(msg.mxid)
+        if not event:
+            event: MessageEvent = await main_intent.get_event(msg.mx_room, msg.mxid)
+            if isinstance(event.content, TextMessageEventContent):
+                event.content.trim_reply_fallback()
         puppet = await pu.Puppet.get_by_mxid(event.sender, create=False)
         content.set_reply(event, displayname=puppet.displayname if puppet else event.sender)
     except MatrixRequestError:
@@ -192,66 +231,94 @@ def _telegram_entities_to_matrix_catch(text: str, entities: List[TypeMessageEnti
     return "[failed conversion in _telegram_entities_to_matrix]"
 
 
-def _telegram_entities_to_matrix(text: str, entities: List[TypeMessageEntity],
-                                 offset: int = 0, length: int = None) -> str:
+def _telegram_entities_to_matrix(text: str, entities: List[TypeMessageEntity]) -> str:
     if not entities:
         return escape(text)
-    if length is None:
-        length = len(text)
-    html = []
-    last_offset = 0
-    for i, entity in enumerate(entities):
-        if entity.offset > offset + length:
+    # Single pass over the entities sorted by offset. Each open entity is a frame on the stack
+    # that remembers where its content starts in the html list. When the frame is closed, its
+    # content is joined and wrapped in the entity's tags. Entities are clipped to the end of the
+    # entity they're nested in, and entities that start inside already emitted text are ignored.
+    # If an entity turns out to be skipped (e.g. a mention of an unknown user), its content is
+    # thrown away and the entities after it are handled again as if it didn't exist, so that
+    # they aren't clipped to its end.
+    entities = sorted(entities, key=lambda ent: ent.offset)
+    html: List[str] = []
+    # (index in entities, end offset, start index in html, start offset)
+    stack: List[Tuple[int, int, int, int]] = []
+    pos = 0
+    index = 0
+    count = len(entities)
+    while index < count or stack:
+        entity = entities[index] if index < count else None
+        if entity and entity.offset > len(text):
+            entity = None
+            count = index
+        if stack and (not entity or stack[-1][1] <= entity.offset):
+            frame_index, end, html_start, start = stack.pop()
+            if end > pos:
+                html.append(escape(text[pos:end]))
+                pos = end
+            entity_text = "".join(html[html_start:])
+            del html[html_start:]
+            if _entity_to_html(html, entities[frame_index], entity_text):
+                pos = start
+                index = frame_index + 1
+            continue
+        elif not entity:
             break
-        relative_offset = entity.offset - offset
-        if relative_offset > last_offset:
-            html.append(escape(text[last_offset:relative_offset]))
-        elif relative_offset < last_offset:
+        index += 1
+        start = entity.offset
+        if start < pos:
             continue
-
-        skip_entity = False
-        entity_text = _telegram_entities_to_matrix(
-            text=text[relative_offset:relative_offset + entity.length],
-            entities=entities[i + 1:], offset=entity.offset, length=entity.length)
-        entity_type = type(entity)
-
-        if entity_type == MessageEntityBold:
-            html.append(f"<strong>{entity_text}</strong>")
-        elif entity_type == MessageEntityItalic:
-            html.append(f"<em>{entity_text}</em>")
-        elif entity_type == MessageEntityUnderline:
-            html.append(f"<u>{entity_text}</u>")
-        elif entity_type == MessageEntityStrike:
-            html.append(f"<del>{entity_text}</del>")
-        elif entity_type == MessageEntityBlockquote:
-            html.append(f"<blockquote>{entity_text}</blockquote>")
-        elif entity_type == MessageEntityCode:
-            html.append(f"<pre><code>{entity_text}</code></pre>"
-                        if "\n" in entity_text
-                        else f"<code>{entity_text}</code>")
-        elif entity_type == MessageEntityPre:
-            skip_entity = _parse_pre(html, entity_text, entity.language)
-        elif entity_type == MessageEntityMention:
-            skip_entity = _parse_mention(html, entity_text)
-        elif entity_type == MessageEntityMentionName:
-            skip_entity = _parse_name_mention(html, entity_text, TelegramID(entity.user_id))
-        elif entity_type == MessageEntityEmail:
-            html.append(f"<a href='mailto:{entity_text}'>{entity_text}</a>")
-        elif entity_type in (MessageEntityTextUrl, MessageEntityUrl):
-            skip_entity = _parse_url(html, entity_text,
-                                     entity.url if entity_type == MessageEntityTextUrl else None)
-        elif entity_type == MessageEntityBotCommand:
-            html.append(f"<font color='blue'>!{entity_text[1:]}</font>")
-        elif entity_type in (MessageEntityHashtag, MessageEntityCashtag, MessageEntityPhone):
-            html.append(f"<font color='blue'>{entity_text}</font>")
-        else:
-            skip_entity = True
-        last_offset = relative_offset + (0 if skip_entity else entity.length)
-    html.append(escape(text[last_offset:]))
+        if start > pos:
+            html.append(escape(text[pos:start]))
+            pos = start
+        end = start + entity.length
+        if stack:
+            end = min(end, stack[-1][1])
+        stack.append((index - 1, end, len(html), start))
+    html.append(escape(text[pos:]))
 
     return "".join(html)
 
 
+def _entity_to_html(html: List[str], entity: TypeMessageEntity, entity_text: str) -> bool:
+    entity_type = type(entity)
+
+    if entity_type == MessageEntityBold:
+        html.append(f"<strong>{entity_text}</strong>")
+    elif entity_type == MessageEntityItalic:
+        html.append(f"<em>{entity_text}</em>")
+    elif entity_type == MessageEntityUnderline:
+        html.append(f"<u>{entity_text}</u>")
+    elif entity_type == MessageEntityStrike:
+        html.append(f"<del>{entity_text}</del>")
+    elif entity_type == MessageEntityBlockquote:
+        html.append(f"<blockquote>{entity_text}</blockquote>")
+    elif entity_type == MessageEntityCode:
+        html.append(f"<pre><code>{entity_text}</code></pre>"
+                    if "\n" in entity_text
+                    else f"<code>{entity_text}</code>")
+    elif entity_type == MessageEntityPre:
+        return _parse_pre(html, entity_text, entity.language)
+    elif entity_type == MessageEntityMention:
+        return _parse_mention(html, entity_text)
+    elif entity_type == MessageEntityMentionName:
+        return _parse_name_mention(html, entity_text, TelegramID(entity.user_id))
+    elif entity_type == MessageEntityEmail:
+        html.append(f"<a href='mailto:{entity_text}'>{entity_text}</a>")
+    elif entity_type in (MessageEntityTextUrl, MessageEntityUrl):
+        return _parse_url(html, entity_text,
+                          entity.url if entity_type == MessageEntityTextUrl else None)
+    elif entity_type == MessageEntityBotCommand:
+        html.append(f"<font color='blue'>!{entity_text[1:]}</font>")
+    elif entity_type in (MessageEntityHashtag, MessageEntityCashtag, MessageEntityPhone):
+        html.append(f"<font color='blue'>{entity_text}</font>")
+    else:
+        return True
+    return False
+
+
 def _parse_pre(html: List[str], entity_text: str, language: str) -> bool:
     if language:
         html.append("<pre>"
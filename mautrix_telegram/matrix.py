@@ -13,7 +13,9 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Dict, Set, Tuple, Union, Iterable, TYPE_CHECKING
+from typing import Any, Dict, List, Optional, Set, Tuple, Union, Iterable, TYPE_CHECKING
+from functools import partial
+import asyncio
 
 from mautrix.bridge import BaseMatrixHandler
 from mautrix.types import (Event, EventType, RoomID, UserID, EventID, ReceiptEvent, ReceiptType,
@@ -25,6 +27,7 @@ from mautrix.types import (Event, EventType, RoomID, UserID, EventID, ReceiptEve
 from mautrix.errors import MatrixError
 
 from . import user as u, portal as po, puppet as pu, commands as com
+from .util import StateCoalescer, WindowBatcher, OrderedDispatcher
 
 if TYPE_CHECKING:
     from .context import Context
@@ -38,6 +41,10 @@ class MatrixHandler(BaseMatrixHandler):
     bot: 'Bot'
     commands: 'com.CommandProcessor'
     previously_typing: Dict[RoomID, Set[UserID]]
+    typing_coalescer: StateCoalescer[Tuple[UserID, RoomID], bool]
+    presence_coalescer: StateCoalescer[UserID, bool]
+    read_receipt_batcher: WindowBatcher[Tuple[RoomID, UserID], EventID]
+    event_dispatcher: OrderedDispatcher[RoomID, Event]
 
     def __init__(self, context: 'Context') -> None:
         prefix, suffix = context.config["bridge.username_template"].format(userid=":").split(":")
@@ -49,6 +56,49 @@ class MatrixHandler(BaseMatrixHandler):
 
         self.bot = context.bot
         self.previously_typing = {}
+        # Typing and presence changes are sent to Telegram in the background, at most once every
+        # couple of seconds per user (and per chat for typing), and repeats are dropped.
+        self.typing_coalescer = StateCoalescer("matrix_typing", min_interval=2,
+                                               refresh_interval=5)
+        self.presence_coalescer = StateCoalescer("matrix_presence", min_interval=5,
+                                                 refresh_interval=60)
+        # Read receipts are collected for a second and then sent as one read request per user
+        # and chat, for the newest message the user has read.
+        self.read_receipt_batcher = WindowBatcher(window=1, flush=self._flush_read_receipts)
+
+        # The appservice handles each event in a separate task, so events in the same room could
+        # be handled out of order and there's no limit to how many are handled at once. Instead,
+        # events are queued per room so that they're handled in order within the room and in
+        # parallel across rooms, and transactions aren't acknowledged while too many events are
+        # queued, which makes the homeserver slow down.
+        self.event_dispatcher = OrderedDispatcher(
+            "matrix_event", self.int_handle_event,
+            max_queue_size=context.config["bridge.matrix_event_room_queue_size"],
+            max_pending=context.config["bridge.matrix_event_max_pending"])
+        handlers = self.az.event_handlers
+        handlers[handlers.index(self.int_handle_event)] = self.dispatch_event
+        self._handle_transaction = self.az.handle_transaction
+        self.az.handle_transaction = self.handle_transaction
+
+    async def dispatch_event(self, evt: Event) -> None:
+        room_id: Optional[RoomID] = getattr(evt, "room_id", None)
+        # Typing notifications don't need to be ordered with other events, and they shouldn't
+        # wait behind slow events like encrypted messages whose keys haven't arrived yet.
+        # Read receipts are still queued, as they refer to messages earlier in the room.
+        if not room_id or evt.type == EventType.TYPING:
+            await self.int_handle_event(evt)
+            return
+        await self.event_dispatcher.dispatch(room_id, evt)
+
+    async def handle_transaction(self, txn_id: str, *args: Any, **kwargs: Any) -> None:
+        await self._handle_transaction(txn_id, *args, **kwargs)
+        # The appservice only remembers the transaction ID after this returns, so if the
+        # homeserver retried the transaction while waiting for capacity below, the events would
+        # be bridged twice.
+        self.az.transactions.add(txn_id)
+        # Let the dispatch tasks queue the events before checking the queue size.
+        await asyncio.sleep(0)
+        await self.event_dispatcher.wait_for_capacity()
 
     async def handle_puppet_invite(self, room_id: RoomID, puppet: pu.Puppet, inviter: u.User,
                                    event_id: EventID) -> None:
@@ -317,9 +367,8 @@ class MatrixHandler(BaseMatrixHandler):
                 for event_id, receipts in content.items()
                 for user_id in receipts.get(ReceiptType.READ, {}))
 
-    @staticmethod
-    async def handle_read_receipts(room_id: RoomID, receipts: Iterable[Tuple[UserID, EventID]]
-                                   ) -> None:
+    async def handle_read_receipts(self, room_id: RoomID,
+                                   receipts: Iterable[Tuple[UserID, EventID]]) -> None:
         portal = po.Portal.get_by_mxid(room_id)
         if not portal:
             return
@@ -327,13 +376,26 @@ class MatrixHandler(BaseMatrixHandler):
         for user_id, event_id in receipts:
             user = u.User.get_by_mxid(user_id, check_db=False, create=False)
             if user and await user.is_logged_in():
-                await portal.mark_read(user, event_id)
+                self.read_receipt_batcher.add((room_id, user_id), event_id)
 
     @staticmethod
-    async def handle_presence(user_id: UserID, presence: PresenceState) -> None:
+    async def _flush_read_receipts(receipts: Dict[Tuple[RoomID, UserID], List[EventID]]
+                                   ) -> None:
+        by_portal: Dict[RoomID, Dict[u.User, List[EventID]]] = {}
+        for (room_id, user_id), event_ids in receipts.items():
+            user = u.User.get_by_mxid(user_id, check_db=False, create=False)
+            if user and await user.is_logged_in():
+                by_portal.setdefault(room_id, {})[user] = event_ids
+        portals = ((po.Portal.get_by_mxid(room_id), user_receipts)
+                   for room_id, user_receipts in by_portal.items())
+        await asyncio.gather(*[portal.mark_read(user_receipts)
+                               for portal, user_receipts in portals if portal])
+
+    async def handle_presence(self, user_id: UserID, presence: PresenceState) -> None:
         user = u.User.get_by_mxid(user_id, check_db=False, create=False)
         if user and await user.is_logged_in():
-            await user.set_presence(presence == PresenceState.ONLINE)
+            self.presence_coalescer.submit(user.mxid, presence == PresenceState.ONLINE,
+                                           user.set_presence)
 
     async def handle_typing(self, room_id: RoomID, now_typing: Set[UserID]) -> None:
         portal = po.Portal.get_by_mxid(room_id)
@@ -350,7 +412,8 @@ class MatrixHandler(BaseMatrixHandler):
 
             user = u.User.get_by_mxid(user_id, check_db=False, create=False)
             if user and await user.is_logged_in():
-                await portal.set_typing(user, is_typing)
+                self.typing_coalescer.submit((user.mxid, portal.mxid), is_typing,
+                                             partial(portal.set_typing, user))
 
         self.previously_typing[room_id] = now_typing
 
@@ -13,11 +13,14 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Awaitable, Dict, List, Optional, Tuple, Union, Any, Set, Iterable, TYPE_CHECKING
+from typing import (Awaitable, Dict, List, Optional, Tuple, Union, Any, Set, Iterable,
+                    Iterator, TYPE_CHECKING)
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 import asyncio
 import logging
 import json
+import time
 
 from telethon.tl.functions.messages import ExportChatInviteRequest
 from telethon.tl.types import (Channel, ChannelFull, Chat, ChatFull, ChatInviteEmpty, InputChannel,
@@ -39,7 +42,8 @@ from mautrix.bridge import BasePortal as MautrixBasePortal
 
 from ..types import TelegramID
 from ..context import Context
-from ..db import Portal as DBPortal, Message as DBMessage
+from ..db import (Portal as DBPortal, Message as DBMessage,
+                  PortalParticipants as DBPortalParticipants)
 from .. import puppet as p, user as u, util
 from .deduplication import PortalDedup
 from .send_lock import PortalSendLock
@@ -49,6 +53,7 @@ if TYPE_CHECKING:
     from ..abstract_user import AbstractUser
     from ..config import Config
     from ..matrix import MatrixHandler
+    from ..__main__ import TelegramBridge
     from . import Portal
 
 TypeParticipant = Union[TypeChatParticipant, TypeChannelParticipant]
@@ -64,6 +69,7 @@ class BasePortal(MautrixBasePortal, ABC):
     bot: 'Bot' = None
     loop: asyncio.AbstractEventLoop = None
     matrix: 'MatrixHandler' = None
+    bridge: 'TelegramBridge'
 
     # Config cache
     filter_mode: str = None
@@ -81,12 +87,16 @@ class BasePortal(MautrixBasePortal, ABC):
     # Instance cache
     by_mxid: Dict[RoomID, 'Portal'] = {}
     by_tgid: Dict[Tuple[TelegramID, TelegramID], 'Portal'] = {}
+    # Whether all portals in the database are loaded into the caches above
+    all_loaded: bool = False
+    # Lowercased username -> portal, kept up to date by the username property setter
+    by_username: Dict[str, 'Portal'] = {}
 
     mxid: Optional[RoomID]
     tgid: TelegramID
     tg_receiver: TelegramID
     peer_type: str
-    username: str
+    _username: Optional[str]
     megagroup: bool
     title: Optional[str]
     about: Optional[str]
@@ -95,20 +105,25 @@ class BasePortal(MautrixBasePortal, ABC):
     avatar_url: Optional[ContentURI]
     encrypted: bool
     deleted: bool
-    backfill_lock: SimpleLock
-    backfill_method_lock: asyncio.Lock
     backfill_leave: Optional[Set[IntentAPI]]
-    log: TraceLogger
+    log: TraceLogger = util.ChildLogger(base_log, lambda portal: (portal.tgid_log if portal.tgid
+                                                                  else portal.mxid))
 
     alias: Optional[RoomAlias]
 
-    dedup: PortalDedup
-    send_lock: PortalSendLock
-    _pin_lock: asyncio.Lock
+    # Most portals are dormant most of the time, so the locks, the deduplication state and the
+    # logger are only created when they're first needed.
+    _log: Optional[TraceLogger]
+    _backfill_lock: Optional[SimpleLock]
+    _backfill_method_lock: Optional[asyncio.Lock]
+    _dedup: Optional[PortalDedup]
+    _send_lock: Optional[PortalSendLock]
+    _pin_lock: Optional[asyncio.Lock]
 
     _db_instance: DBPortal
     _main_intent: Optional[IntentAPI]
-    _room_create_lock: asyncio.Lock
+    _room_create_lock: Optional[asyncio.Lock]
+    _last_used: float
 
     def __init__(self, tgid: TelegramID, peer_type: str, tg_receiver: Optional[TelegramID] = None,
                  mxid: Optional[RoomID] = None, username: Optional[str] = None,
@@ -120,6 +135,7 @@ class BasePortal(MautrixBasePortal, ABC):
         self.tgid = tgid
         self.tg_receiver = tg_receiver or tgid
         self.peer_type = peer_type
+        self._username = None
         self.username = username
         self.megagroup = megagroup
         self.title = title
@@ -131,15 +147,16 @@ class BasePortal(MautrixBasePortal, ABC):
         self._db_instance = db_instance
         self._main_intent = None
         self.deleted = False
-        self.log = self.base_log.getChild(self.tgid_log if self.tgid else self.mxid)
-        self.backfill_lock = SimpleLock("Waiting for backfilling to finish before handling %s",
-                                        log=self.log)
-        self.backfill_method_lock = asyncio.Lock()
         self.backfill_leave = None
 
-        self.dedup = PortalDedup(self)
-        self.send_lock = PortalSendLock()
-        self._pin_lock = asyncio.Lock()
+        self._log = None
+        self._backfill_lock = None
+        self._backfill_method_lock = None
+        self._dedup = None
+        self._send_lock = None
+        self._pin_lock = None
+        self._room_create_lock = None
+        self._last_used = time.monotonic()
 
         if tgid:
             self.by_tgid[self.tgid_full] = self
@@ -162,6 +179,64 @@ class BasePortal(MautrixBasePortal, ABC):
     def name(self) -> str:
         return self.title
 
+    @property
+    def username(self) -> Optional[str]:
+        return self._username
+
+    @username.setter
+    def username(self, value: Optional[str]) -> None:
+        if self._username and self.by_username.get(self._username.lower()) is self:
+            del self.by_username[self._username.lower()]
+        self._username = value
+        if value:
+            self.by_username[value.lower()] = self
+
+    @property
+    def backfill_lock(self) -> SimpleLock:
+        if not self._backfill_lock:
+            self._backfill_lock = SimpleLock(
+                "Waiting for backfilling to finish before handling %s", log=self.log)
+        return self._backfill_lock
+
+    @property
+    def backfill_method_lock(self) -> asyncio.Lock:
+        if not self._backfill_method_lock:
+            self._backfill_method_lock = asyncio.Lock()
+        return self._backfill_method_lock
+
+    @property
+    def dedup(self) -> PortalDedup:
+        if not self._dedup:
+            self._dedup = PortalDedup(self)
+        return self._dedup
+
+    @property
+    def send_lock(self) -> PortalSendLock:
+        if not self._send_lock:
+            self._send_lock = PortalSendLock()
+        return self._send_lock
+
+    @property
+    def pin_lock(self) -> asyncio.Lock:
+        if not self._pin_lock:
+            self._pin_lock = asyncio.Lock()
+        return self._pin_lock
+
+    @property
+    def room_create_lock(self) -> asyncio.Lock:
+        if not self._room_create_lock:
+            self._room_create_lock = asyncio.Lock()
+        return self._room_create_lock
+
+    @property
+    def in_use(self) -> bool:
+        return bool(self.backfill_leave is not None
+                    or (self._backfill_lock and self._backfill_lock.locked)
+                    or (self._backfill_method_lock and self._backfill_method_lock.locked())
+                    or (self._room_create_lock and self._room_create_lock.locked())
+                    or (self._pin_lock and self._pin_lock.locked())
+                    or (self._send_lock and self._send_lock.locked))
+
     @property
     def alias(self) -> Optional[RoomAlias]:
         if not self.username:
@@ -280,6 +355,13 @@ class BasePortal(MautrixBasePortal, ABC):
             raise ValueError("Failed to get invite link.")
         return link.link
 
+    async def _send_message(self, intent: IntentAPI, content: MessageEventContent,
+                            event_type: EventType = EventType.ROOM_MESSAGE, **kwargs) -> EventID:
+        event_id = await super()._send_message(intent, content, event_type, **kwargs)
+        if event_type == EventType.ROOM_MESSAGE:
+            util.add_recent_event(self.mxid, event_id, intent.mxid, content)
+        return event_id
+
     # endregion
     # region Matrix room cleanup
 
@@ -309,6 +391,8 @@ class BasePortal(MautrixBasePortal, ABC):
         await self.cleanup_room(self.main_intent, self.mxid, message, puppets_only)
         if delete:
             await self.delete()
+        else:
+            self.reset_participant_pages()
 
     # endregion
     # region Database conversion
@@ -335,20 +419,28 @@ class BasePortal(MautrixBasePortal, ABC):
     async def delete(self) -> None:
         self.delete_sync()
 
-    def delete_sync(self) -> None:
-        try:
+    def remove_from_cache(self) -> None:
+        if self.by_tgid.get(self.tgid_full) is self:
             del self.by_tgid[self.tgid_full]
-        except KeyError:
-            pass
-        try:
+        if self.mxid and self.by_mxid.get(self.mxid) is self:
             del self.by_mxid[self.mxid]
-        except KeyError:
-            pass
+        if self._username and self.by_username.get(self._username.lower()) is self:
+            del self.by_username[self._username.lower()]
+
+    def delete_sync(self) -> None:
+        self.remove_from_cache()
         if self._db_instance:
             self._db_instance.delete()
         DBMessage.delete_all(self.mxid)
+        self.reset_participant_pages()
         self.deleted = True
 
+    # The stored participant page hashes describe what has been synced to the current Matrix
+    # room, so they must be reset whenever the room changes, or the next member sync would be
+    # skipped as not modified.
+    def reset_participant_pages(self) -> None:
+        DBPortalParticipants.delete_all(self.tgid, self.tg_receiver)
+
     @classmethod
     def from_db(cls, db_portal: DBPortal) -> 'Portal':
         return cls(tgid=db_portal.tgid, tg_receiver=db_portal.tg_receiver,
@@ -361,24 +453,75 @@ class BasePortal(MautrixBasePortal, ABC):
     # endregion
     # region Class instance lookup
 
+    @classmethod
+    def preload_all(cls) -> int:
+        count = 0
+        for db_portal in DBPortal.all():
+            if (db_portal.tgid, db_portal.tg_receiver) not in cls.by_tgid:
+                cls.from_db(db_portal)
+            count += 1
+        cls.all_loaded = True
+        return count
+
     @classmethod
     def all(cls) -> Iterable['Portal']:
+        if cls.all_loaded:
+            yield from list(cls.by_tgid.values())
+            return
         for db_portal in DBPortal.all():
             try:
                 yield cls.by_tgid[(db_portal.tgid, db_portal.tg_receiver)]
             except KeyError:
                 yield cls.from_db(db_portal)
 
+    @classmethod
+    def evict_inactive(cls, max_size: int, min_idle: float,
+                       referenced: Set[Tuple[TelegramID, TelegramID]]) -> int:
+        # Portals that are referenced elsewhere (e.g. in the portal lists of users) are kept, so
+        # that there's never more than one instance of the same portal.
+        count = util.evict_lru("portal", list(cls.by_tgid.values()), max_size, min_idle,
+                               lambda portal: portal.in_use or portal.tgid_full in referenced,
+                               lambda portal: portal.remove_from_cache())
+        if count:
+            cls.all_loaded = False
+        return count
+
+    @classmethod
+    @contextmanager
+    def borrow_from_db(cls, db_portal: DBPortal) -> Iterator['Portal']:
+        # Yields the cached instance of the portal, or loads one that's removed from the cache
+        # again afterwards, unless something else started using it in the meantime. This is meant
+        # for going through lots of portals without keeping all of them in memory.
+        try:
+            portal = cls.by_tgid[(db_portal.tgid, db_portal.tg_receiver)]
+        except KeyError:
+            pass
+        else:
+            yield portal
+            return
+        portal = cls.from_db(db_portal)
+        loaded_at = portal._last_used
+        try:
+            yield portal
+        finally:
+            if portal._last_used == loaded_at and not portal.in_use:
+                portal.remove_from_cache()
+                cls.all_loaded = False
+
     @classmethod
     def get_by_mxid(cls, mxid: RoomID) -> Optional['Portal']:
         try:
-            return cls.by_mxid[mxid]
+            portal = cls.by_mxid[mxid]
         except KeyError:
             pass
+        else:
+            portal._last_used = time.monotonic()
+            return portal
 
-        portal = DBPortal.get_by_mxid(mxid)
-        if portal:
-            return cls.from_db(portal)
+        if not cls.all_loaded:
+            portal = DBPortal.get_by_mxid(mxid)
+            if portal:
+                return cls.from_db(portal)
 
         return None
 
@@ -393,13 +536,16 @@ class BasePortal(MautrixBasePortal, ABC):
 
         username = username.lower()
 
-        for _, portal in cls.by_tgid.items():
-            if portal.username and portal.username.lower() == username:
-                return portal
+        try:
+            return cls.by_username[username]
+        except KeyError:
+            pass
 
-        dbportal = DBPortal.get_by_username(username)
-        if dbportal:
-            return cls.from_db(dbportal)
+        if not cls.all_loaded:
+            dbportal = DBPortal.get_by_username(username)
+            if dbportal:
+                return (cls.by_tgid.get((dbportal.tgid, dbportal.tg_receiver))
+                        or cls.from_db(dbportal))
 
         return None
 
@@ -410,17 +556,24 @@ class BasePortal(MautrixBasePortal, ABC):
             raise ValueError("tg_receiver is required when peer_type is \"user\"")
         tg_receiver = tg_receiver or tgid
         tgid_full = (tgid, tg_receiver)
+        # This must stay synchronous: with no await between the cache miss, the database query
+        # and the constructor adding the portal to the cache, concurrent callers can't load or
+        # insert the same portal twice.
         try:
-            return cls.by_tgid[tgid_full]
+            portal = cls.by_tgid[tgid_full]
         except KeyError:
             pass
+        else:
+            portal._last_used = time.monotonic()
+            return portal
 
-        db_portal = DBPortal.get_by_tgid(tgid, tg_receiver)
-        if db_portal:
-            return cls.from_db(db_portal)
+        if not cls.all_loaded:
+            db_portal = DBPortal.get_by_tgid(tgid, tg_receiver)
+            if db_portal:
+                return cls.from_db(db_portal)
 
         if peer_type:
-            cls.log.info(f"Creating portal for {peer_type} {tgid} (receiver {tg_receiver})")
+            cls.base_log.info(f"Creating portal for {peer_type} {tgid} (receiver {tg_receiver})")
             # TODO enable this for non-release builds
             #      (or add better wrong peer type error handling)
             # if peer_type == "chat":
@@ -34,6 +34,8 @@ DedupMXID = Tuple[EventID, TelegramID]
 
 
 class PortalDedup:
+    __slots__ = ("_dedup", "_dedup_mxid", "_dedup_action", "_portal")
+
     pre_db_check: bool = False
     cache_queue_length: int = 20
 
@@ -13,10 +13,11 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Awaitable, Dict, Optional, Union, Any, TYPE_CHECKING
+from typing import Awaitable, Dict, List, Optional, Union, Any, TYPE_CHECKING
 from html import escape as escape_html
 from string import Template
 from abc import ABC
+import asyncio
 
 import magic
 
@@ -106,15 +107,31 @@ class PortalMatrix(BasePortal, ABC):
         return user.client(SetTypingRequest(
             self.peer, action() if typing else SendMessageCancelAction()))
 
-    async def mark_read(self, user: 'u.User', event_id: EventID) -> None:
-        if user.is_bot:
-            return
-        space = self.tgid if self.peer_type == "channel" else user.tgid
-        message = DBMessage.get_by_mxid(event_id, self.mxid, space)
-        if not message:
-            return
-        await user.client.send_read_acknowledge(self.peer, max_id=message.tgid,
-                                                clear_mentions=True)
+    async def mark_read(self, receipts: Dict['u.User', List[EventID]]) -> None:
+        # Receipts of all users that share a Telegram ID space are resolved with one query, and
+        # each user only marks the newest of their receipted messages as read.
+        users_by_space: Dict[TelegramID, List['u.User']] = {}
+        for user in receipts.keys():
+            if not user.is_bot:
+                space = self.tgid if self.peer_type == "channel" else user.tgid
+                users_by_space.setdefault(space, []).append(user)
+        requests = []
+        for space, users in users_by_space.items():
+            event_ids = list({event_id for user in users for event_id in receipts[user]})
+            tgids: Dict[EventID, TelegramID] = {}
+            for message in DBMessage.get_by_mxids(event_ids, self.mxid, space):
+                tgids[message.mxid] = max(message.tgid, tgids.get(message.mxid, 0))
+            for user in users:
+                max_id = max((tgids[event_id] for event_id in receipts[user]
+                              if event_id in tgids), default=None)
+                if max_id:
+                    requests.append((user, user.client.send_read_acknowledge(
+                        self.peer, max_id=max_id, clear_mentions=True)))
+        results = await asyncio.gather(*[request for _, request in requests],
+                                       return_exceptions=True)
+        for (user, _), result in zip(requests, results):
+            if isinstance(result, Exception):
+                self.log.warning(f"Failed to mark messages as read for {user.mxid}: {result}")
 
     async def _preproc_kick_ban(self, user: Union['u.User', 'p.Puppet'], source: 'u.User'
                                 ) -> Optional['AbstractUser']:
@@ -249,6 +266,10 @@ class PortalMatrix(BasePortal, ABC):
         if config["bridge.parallel_file_transfer"] and content.url:
             file_handle, file_size = await parallel_transfer_to_telegram(client, self.main_intent,
                                                                          content.url, sender_id)
+        elif config["bridge.parallel_file_transfer"] and content.file and decrypt_attachment:
+            file_handle, file_size = await parallel_transfer_to_telegram(
+                client, self.main_intent, content.file.url, sender_id,
+                decryption_info=content.file)
         else:
             if content.file:
                 if not decrypt_attachment:
@@ -339,6 +360,7 @@ class PortalMatrix(BasePortal, ABC):
     def _add_telegram_message_to_db(self, event_id: EventID, space: TelegramID,
                                     edit_index: int, response: TypeMessage) -> None:
         self.log.trace("Handled Matrix message: %s", response)
+        self.bridge.log_first_bridged_message("Matrix -> Telegram")
         self.dedup.check(response, (event_id, space), force_hash=edit_index != 0)
         if edit_index < 0:
             prev_edit = DBMessage.get_one_by_tgid(TelegramID(response.id), space, -1)
@@ -377,6 +399,9 @@ class PortalMatrix(BasePortal, ABC):
         space = (self.tgid if self.peer_type == "channel"  # Channels have their own ID space
                  else (sender.tgid if logged_in else self.bot.tgid))
         reply_to = formatter.matrix_reply_to_telegram(content, space, room_id=self.mxid)
+        # The reply fallback was already trimmed by matrix_reply_to_telegram
+        util.add_recent_event(self.mxid, event_id, sender.mxid, content,
+                              trim_reply_fallback=False)
 
         media = (MessageType.STICKER, MessageType.IMAGE, MessageType.FILE, MessageType.AUDIO,
                  MessageType.VIDEO)
@@ -433,6 +458,7 @@ class PortalMatrix(BasePortal, ABC):
                                      redaction_event_id: EventID) -> None:
         real_deleter = deleter if not await deleter.needs_relaybot(self) else self.bot
         space = self.tgid if self.peer_type == "channel" else real_deleter.tgid
+        util.remove_recent_event(event_id)
         message = DBMessage.get_by_mxid(event_id, self.mxid, space)
         if not message:
             self.log.trace(f"Ignoring Matrix redaction of unknown event {event_id}")
@@ -571,6 +597,7 @@ class PortalMatrix(BasePortal, ABC):
         self.mxid = new_id
         self.db_instance.edit(mxid=self.mxid)
         self.by_mxid[self.mxid] = self
+        self.reset_participant_pages()
 
     async def enable_dm_encryption(self) -> bool:
         ok = await super().enable_dm_encryption()
@@ -13,7 +13,7 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import List, Optional, Iterable, Union, Dict, Any, TYPE_CHECKING
+from typing import List, Optional, Iterable, Union, Dict, Set, Tuple, Any, TYPE_CHECKING
 from abc import ABC
 import asyncio
 
@@ -22,8 +22,11 @@ from telethon.tl.functions.messages import (AddChatUserRequest, CreateChatReques
 from telethon.tl.functions.channels import (CreateChannelRequest, GetParticipantsRequest,
                                             InviteToChannelRequest, UpdateUsernameRequest)
 from telethon.errors import ChatAdminRequiredError
+from telethon.utils import get_input_peer
+from telethon.tl.types.channels import ChannelParticipantsNotModified
 from telethon.tl.types import (
     Channel, ChatBannedRights, ChannelParticipantsRecent, ChannelParticipantsSearch, ChatPhoto,
+    ChannelParticipantsAdmins, ChannelParticipant,
     PhotoEmpty, InputChannel, InputUser, ChatPhotoEmpty, PeerUser, Photo, TypeChat, TypeInputPeer,
     TypeUser, User, InputPeerPhotoFileLocation, ChatParticipantAdmin, ChannelParticipantAdmin,
     ChatParticipantCreator, ChannelParticipantCreator, UserProfilePhoto, UserProfilePhotoEmpty)
@@ -36,6 +39,7 @@ from mautrix.types import (RoomID, UserID, RoomCreatePreset, EventType, Membersh
 
 from ..types import TelegramID
 from ..context import Context
+from ..db import PortalParticipants as DBPortalParticipants
 from .. import puppet as p, user as u, util
 from .base import BasePortal, InviteList, TypeParticipant, TypeChatPhoto
 
@@ -48,14 +52,10 @@ config: Optional['Config'] = None
 StateBridge = EventType.find("m.bridge", EventType.Class.STATE)
 StateHalfShotBridge = EventType.find("uk.half-shot.bridge", EventType.Class.STATE)
 
+PageHashes = Dict[int, Tuple[int, List[TelegramID]]]
 
-class PortalMetadata(BasePortal, ABC):
-    _room_create_lock: asyncio.Lock
-
-    def __init__(self, *args, **kwargs) -> None:
-        super().__init__(*args, **kwargs)
-        self._room_create_lock = asyncio.Lock()
 
+class PortalMetadata(BasePortal, ABC):
     # region Matrix -> Telegram
 
     async def _get_telegram_users_in_matrix_room(self) -> List[Union[InputUser, PeerUser]]:
@@ -199,10 +199,29 @@ class PortalMetadata(BasePortal, ABC):
                                   users: List[User] = None) -> None:
         if not direct:
             await self.update_info(user, entity)
+            unchanged = set()
+            pages = None
             if not users:
-                users = await self._get_users(user, entity)
-            await self._sync_telegram_users(user, users)
-            await self.update_power_levels(users, levels)
+                users, unchanged, pages = await self._get_changed_users(user, entity)
+            failed = set()
+            if users or not unchanged:
+                failed = await self._sync_telegram_users(user, users, unchanged)
+            else:
+                self.log.debug("Participant list not modified, skipping member sync")
+            participants = users
+            if unchanged:
+                participants = users + await self._get_unchanged_participants(user, entity,
+                                                                              unchanged)
+            await self.update_power_levels(participants, levels)
+            # Only remember the page hashes once the members have been synced, so that a failed
+            # sync is retried instead of being skipped as not modified next time. Pages with
+            # members that failed to sync are left out, so that they're fetched again.
+            if pages is not None:
+                if failed:
+                    pages = {page: (page_hash, user_ids)
+                             for page, (page_hash, user_ids) in pages.items()
+                             if failed.isdisjoint(user_ids)}
+                DBPortalParticipants.set_pages(self.tgid, self.tg_receiver, pages)
         else:
             if not puppet:
                 puppet = p.Puppet.get(self.tgid)
@@ -244,7 +263,7 @@ class PortalMetadata(BasePortal, ABC):
                 self.loop.create_task(update)
                 await self.invite_to_matrix(invites or [])
             return self.mxid
-        async with self._room_create_lock:
+        async with self.room_create_lock:
             try:
                 return await self._create_matrix_room(user, entity, invites)
             except Exception:
@@ -285,14 +304,18 @@ class PortalMetadata(BasePortal, ABC):
             return
         try:
             self.log.debug("Updating bridge info...")
-            await self.main_intent.send_state_event(self.mxid, StateBridge,
-                                                    self.bridge_info, self.bridge_info_state_key)
-            # TODO remove this once https://github.com/matrix-org/matrix-doc/pull/2346 is in spec
-            await self.main_intent.send_state_event(self.mxid, StateHalfShotBridge,
-                                                    self.bridge_info, self.bridge_info_state_key)
+            await self.send_bridge_info()
         except Exception:
             self.log.warning("Failed to update bridge info", exc_info=True)
 
+    async def send_bridge_info(self) -> None:
+        bridge_info = self.bridge_info
+        await self.main_intent.send_state_event(self.mxid, StateBridge,
+                                                bridge_info, self.bridge_info_state_key)
+        # TODO remove this once https://github.com/matrix-org/matrix-doc/pull/2346 is in spec
+        await self.main_intent.send_state_event(self.mxid, StateHalfShotBridge,
+                                                bridge_info, self.bridge_info_state_key)
+
     async def _create_matrix_room(self, user: 'AbstractUser', entity: Union[TypeChat, User],
                                   invites: InviteList) -> Optional[RoomID]:
         if self.mxid:
@@ -539,31 +562,87 @@ class PortalMetadata(BasePortal, ABC):
         if user and user.is_bot:
             await user.register_portal(self)
 
-    async def _sync_telegram_users(self, source: 'AbstractUser', users: List[User]) -> None:
-        allowed_tgids = set()
-        skip_deleted = config["bridge.skip_deleted_members"]
+    async def _prefetch_member_avatars(self, source: 'AbstractUser', users: List[User],
+                                       puppets: Dict[TelegramID, 'p.Puppet']) -> None:
+        avatars = []
         for entity in users:
-            puppet = p.Puppet.get(TelegramID(entity.id))
-            if entity.bot:
-                await self._add_bot_chat(entity)
-            allowed_tgids.add(entity.id)
-
-            await puppet.update_info(source, entity)
-            if skip_deleted and entity.deleted:
+            if not isinstance(entity.photo, UserProfilePhoto):
+                continue
+            photo_id = str(entity.photo.photo_id)
+            puppet = puppets[TelegramID(entity.id)]
+            if puppet.disable_updates or puppet.photo_id == photo_id:
                 continue
+            try:
+                peer = get_input_peer(entity)
+            except TypeError:
+                continue
+            avatars.append((photo_id, InputPeerPhotoFileLocation(
+                peer=peer, local_id=entity.photo.photo_big.local_id,
+                volume_id=entity.photo.photo_big.volume_id, big=True)))
+        await util.prefetch_avatars(source.client, self.main_intent, avatars)
+
+    async def _sync_telegram_user(self, source: 'AbstractUser', entity: User,
+                                  puppet: 'p.Puppet', user: Optional['u.User'],
+                                  joined: Set[UserID]) -> None:
+        if entity.bot:
+            await self._add_bot_chat(entity)
+
+        await puppet.update_info(source, entity)
+        if config["bridge.skip_deleted_members"] and entity.deleted:
+            return
 
-            await puppet.intent_for(self).ensure_joined(self.mxid)
+        intent = puppet.intent_for(self)
+        if intent.mxid not in joined:
+            await intent.ensure_joined(self.mxid)
 
-            user = u.User.get_by_tgid(TelegramID(entity.id))
-            if user:
-                await self.invite_to_matrix(user.mxid)
+        if user and user.mxid not in joined:
+            await self.invite_to_matrix(user.mxid)
 
-                puppet = await p.Puppet.get_by_custom_mxid(user.mxid)
-                if puppet:
-                    try:
-                        await puppet.intent.ensure_joined(self.mxid)
-                    except Exception:
-                        self.log.exception("Failed to ensure %s is joined to portal", user.mxid)
+            puppet = await p.Puppet.get_by_custom_mxid(user.mxid)
+            if puppet:
+                try:
+                    await puppet.intent.ensure_joined(self.mxid)
+                except Exception:
+                    self.log.exception("Failed to ensure %s is joined to portal", user.mxid)
+
+    async def _sync_telegram_users(self, source: 'AbstractUser', users: List[User],
+                                   unchanged_members: Iterable[TelegramID] = ()
+                                   ) -> Set[TelegramID]:
+        # Returns the IDs of the members that failed to sync.
+        allowed_tgids = {TelegramID(entity.id) for entity in users}
+        # Load everything needed for the sync in bulk instead of hitting the database separately
+        # for every member, and compute the current member list once so that already joined
+        # members can be skipped.
+        puppets = p.Puppet.get_many(allowed_tgids)
+        mx_users = u.User.get_many_by_tgid(allowed_tgids)
+        allowed_tgids.update(unchanged_members)
+        joined = set(await self.main_intent.get_room_members(self.mxid))
+
+        await self._prefetch_member_avatars(source, users, puppets)
+
+        total = len(users)
+        done = 0
+        progress_interval = max(total // 10, 50)
+        sema = asyncio.Semaphore(config["bridge.member_sync_concurrency"])
+        failed: Set[TelegramID] = set()
+
+        async def sync_member(entity: User) -> None:
+            nonlocal done
+            tgid = TelegramID(entity.id)
+            async with sema:
+                try:
+                    await self._sync_telegram_user(source, entity, puppets[tgid],
+                                                   mx_users.get(tgid), joined)
+                except Exception:
+                    self.log.exception(f"Failed to sync Telegram member {tgid}")
+                    failed.add(tgid)
+            done += 1
+            if done % progress_interval == 0 and done < total:
+                self.log.debug(f"Synced {done}/{total} members")
+
+        await asyncio.gather(*[sync_member(entity) for entity in users])
+        if total > progress_interval:
+            self.log.debug(f"Finished syncing {total} members")
 
         # We can't trust the member list if any of the following cases is true:
         #  * There are close to 10 000 users, because Telegram might not be sending all members.
@@ -574,9 +653,9 @@ class PortalMetadata(BasePortal, ABC):
                               else len(allowed_tgids) < self.max_initial_member_sync - 10)
                              and (self.megagroup or self.peer_type != "channel"))
         if not trust_member_list:
-            return
+            return failed
 
-        for user_mxid in await self.main_intent.get_room_members(self.mxid):
+        for user_mxid in joined:
             if user_mxid == self.az.bot_mxid:
                 continue
 
@@ -605,6 +684,7 @@ class PortalMetadata(BasePortal, ABC):
                                                          "You had left this Telegram chat.")
                     except MForbidden:
                         pass
+        return failed
 
     async def _add_telegram_user(self, user_id: TelegramID, source: Optional['AbstractUser'] = None
                                  ) -> None:
@@ -761,12 +841,13 @@ class PortalMetadata(BasePortal, ABC):
                 if save:
                     await self.save()
                 return True
-            file = await util.transfer_file_to_matrix(user.client, self.main_intent, loc)
-            if file:
+            mxc = await util.transfer_avatar_to_matrix(user.client, self.main_intent,
+                                                       str(photo_id), loc)
+            if mxc:
                 await self._try_set_state(sender, EventType.ROOM_AVATAR,
-                                          RoomAvatarStateEventContent(url=file.mxc))
+                                          RoomAvatarStateEventContent(url=mxc))
                 self.photo_id = photo_id
-                self.avatar_url = file.mxc
+                self.avatar_url = mxc
                 if save:
                     await self.save()
                 return True
@@ -784,51 +865,93 @@ class PortalMetadata(BasePortal, ABC):
             else:
                 yield user
 
-    async def _get_channel_users(self, user: 'AbstractUser', entity: InputChannel, limit: int
-                                 ) -> List[TypeUser]:
-        if 0 < limit <= 200:
+    @staticmethod
+    def _participants_hash(user_ids: List[TelegramID]) -> int:
+        acc = 0
+        for user_id in user_ids:
+            acc = (acc * 20261 + 0x80000000 + user_id) % 0x80000000
+        return acc
+
+    async def _get_channel_users(self, user: 'AbstractUser', entity: InputChannel, limit: int,
+                                 incremental: bool = False
+                                 ) -> Tuple[List[TypeUser], Set[TelegramID], Optional[PageHashes]]:
+        # When syncing incrementally, the hash of each page from the previous sync is sent to
+        # Telegram, which then only returns the pages that have changed. Members on unchanged
+        # pages are returned as a set of IDs instead of full user objects. The new page hashes
+        # are returned rather than stored, as they should only be stored after a successful sync,
+        # and they're None if nothing changed.
+        old_pages = (DBPortalParticipants.get_pages(self.tgid, self.tg_receiver)
+                     if incremental else {})
+        new_pages: PageHashes = {}
+        users: List[TypeUser] = []
+        unchanged: Set[TelegramID] = set()
+        page = 0
+        offset = 0
+        remaining_quota = limit if limit > 0 else 1000000
+        query = (ChannelParticipantsSearch("") if limit == -1
+                 else ChannelParticipantsRecent())
+        while remaining_quota > 0:
+            old_hash, old_user_ids = old_pages.get(page, (0, []))
             response = await user.client(GetParticipantsRequest(
-                entity, ChannelParticipantsRecent(), offset=0, limit=limit, hash=0))
-            return list(self._filter_participants(response.users, response.participants))
-        elif limit > 200 or limit == -1:
-            users: List[TypeUser] = []
-            offset = 0
-            remaining_quota = limit if limit > 0 else 1000000
-            query = (ChannelParticipantsSearch("") if limit == -1
-                     else ChannelParticipantsRecent())
-            while True:
-                if remaining_quota <= 0:
-                    break
-                response = await user.client(GetParticipantsRequest(
-                    entity, query, offset=offset, limit=min(remaining_quota, 200), hash=0))
-                if not response.users:
-                    break
+                entity, query, offset=offset, limit=min(remaining_quota, 200), hash=old_hash))
+            if isinstance(response, ChannelParticipantsNotModified):
+                new_pages[page] = (old_hash, old_user_ids)
+                unchanged.update(old_user_ids)
+                count = len(old_user_ids)
+            else:
+                user_ids = [TelegramID(part.user_id) for part in response.participants]
+                new_pages[page] = (self._participants_hash(user_ids), user_ids)
                 users += self._filter_participants(response.users, response.participants)
-                offset += len(response.participants)
-                remaining_quota -= len(response.participants)
-            return users
+                count = len(user_ids)
+            if count == 0 or 0 < limit <= 200:
+                break
+            offset += count
+            remaining_quota -= count
+            page += 1
+        return users, unchanged, (new_pages if new_pages != old_pages else None)
+
+    async def _get_unchanged_participants(self, user: 'AbstractUser', entity: InputChannel,
+                                          unchanged: Set[TelegramID]) -> List[TypeParticipant]:
+        # The page hashes only cover user IDs, so promoting or demoting a member doesn't change
+        # them. The admin list is fetched separately to get the current power levels of members
+        # on unchanged pages, and everyone else on those pages is a regular member.
+        try:
+            response = await user.client(GetParticipantsRequest(
+                entity, ChannelParticipantsAdmins(), offset=0, limit=200, hash=0))
+        except ChatAdminRequiredError:
+            return []
+        admins = {TelegramID(part.user_id): part for part in response.participants}
+        return [admins.get(user_id) or ChannelParticipant(user_id=user_id, date=None)
+                for user_id in unchanged]
 
     async def _get_users(self, user: 'AbstractUser',
                          entity: Union[TypeInputPeer, InputUser, TypeChat, TypeUser, InputChannel]
                          ) -> List[TypeUser]:
+        users, _, _ = await self._get_changed_users(user, entity, incremental=False)
+        return users
+
+    async def _get_changed_users(self, user: 'AbstractUser',
+                                 entity: Union[TypeInputPeer, InputUser, TypeChat, TypeUser,
+                                               InputChannel], incremental: bool = True
+                                 ) -> Tuple[List[TypeUser], Set[TelegramID], Optional[PageHashes]]:
         if self.peer_type == "chat":
             chat = await user.client(GetFullChatRequest(chat_id=self.tgid))
-            return list(self._filter_participants(chat.users,
-                                                  chat.full_chat.participants.participants))
+            return list(self._filter_participants(
+                chat.users, chat.full_chat.participants.participants)), set(), None
         elif self.peer_type == "channel":
             if not self.megagroup and not self.sync_channel_members:
-                return []
+                return [], set(), None
 
             limit = self.max_initial_member_sync
             if limit == 0:
-                return []
+                return [], set(), None
 
             try:
-                return await self._get_channel_users(user, entity, limit)
+                return await self._get_channel_users(user, entity, limit, incremental)
             except ChatAdminRequiredError:
-                return []
+                return [], set(), None
         elif self.peer_type == "user":
-            return [entity]
+            return [entity], set(), None
         else:
             raise RuntimeError(f"Unexpected peer type {self.peer_type}")
 
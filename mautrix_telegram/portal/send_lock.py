@@ -28,12 +28,18 @@ class FakeLock:
 
 
 class PortalSendLock:
+    __slots__ = ("_send_locks",)
+
     _send_locks: Dict[int, Lock]
     _noop_lock: Lock = FakeLock()
 
     def __init__(self) -> None:
         self._send_locks = {}
 
+    @property
+    def locked(self) -> bool:
+        return any(lock.locked() for lock in self._send_locks.values())
+
     def __call__(self, user_id: TelegramID, required: bool = True) -> Lock:
         if user_id is None and required:
             raise ValueError("Required send lock for none id")
@@ -21,6 +21,7 @@ import codecs
 import unicodedata
 import base64
 import asyncio
+import time
 
 from sqlalchemy.exc import IntegrityError
 
@@ -37,9 +38,9 @@ from telethon.tl.types import (
     MessageEntityPre, ChatPhotoEmpty, DocumentAttributeImageSize)
 
 from mautrix.appservice import IntentAPI
-from mautrix.types import (EventID, UserID, ImageInfo, ThumbnailInfo, RelatesTo, MessageType,
-                           EventType, MediaMessageEventContent, TextMessageEventContent,
-                           LocationMessageEventContent, Format)
+from mautrix.types import (EventID, UserID, RoomID, ImageInfo, ThumbnailInfo, RelatesTo,
+                           MessageType, EventType, MediaMessageEventContent,
+                           TextMessageEventContent, LocationMessageEventContent, Format)
 from mautrix.bridge import NotificationDisabler
 
 from ..types import TelegramID
@@ -63,8 +64,23 @@ config: Optional['Config'] = None
 
 
 class PortalTelegram(BasePortal, ABC):
+    # The time a typing notification was last bridged for each room and Telegram user.
+    # Telegram repeats typing updates every few seconds, and every logged in user in a group
+    # receives them, so repeats within the TTL are dropped before doing any work.
+    _typing_bridged: Dict[Tuple[RoomID, TelegramID], float] = {}
+    typing_ttl: float = 4
+
     async def handle_telegram_typing(self, user: p.Puppet,
                                      _: Union[UpdateUserTyping, UpdateChatUserTyping]) -> None:
+        now = time.monotonic()
+        key = (self.mxid, user.tgid)
+        if now - self._typing_bridged.get(key, 0) < self.typing_ttl:
+            return
+        if len(self._typing_bridged) > 10000:
+            PortalTelegram._typing_bridged = {
+                typing_key: bridged_at for typing_key, bridged_at in self._typing_bridged.items()
+                if now - bridged_at < self.typing_ttl}
+        self._typing_bridged[key] = now
         await user.intent_for(self).set_typing(self.mxid, is_typing=True)
 
     def _get_external_url(self, evt: Message) -> Optional[str]:
@@ -639,6 +655,7 @@ class PortalTelegram(BasePortal, ABC):
             return
 
         self.log.debug("Handled telegram message %d -> %s", evt.id, event_id)
+        self.bridge.log_first_bridged_message("Telegram -> Matrix")
         try:
             DBMessage(tgid=TelegramID(evt.id), mx_room=self.mxid, mxid=event_id,
                       tg_space=tg_space, edit_index=0).insert()
@@ -713,7 +730,7 @@ class PortalTelegram(BasePortal, ABC):
 
     async def receive_telegram_pin_ids(self, msg_ids: List[TelegramID], receiver: TelegramID,
                                        remove: bool) -> None:
-        async with self._pin_lock:
+        async with self.pin_lock:
             tg_space = receiver if self.peer_type != "channel" else self.tgid
             previously_pinned = await self.main_intent.get_pinned_messages(self.mxid)
             currently_pinned_dict = {event_id: True for event_id in previously_pinned}
@@ -13,11 +13,12 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Awaitable, Any, Dict, Iterable, Optional, Union, TYPE_CHECKING
+from typing import Awaitable, Any, Dict, Iterable, Optional, Set, Union, TYPE_CHECKING
 from difflib import SequenceMatcher
 import unicodedata
 import asyncio
 import logging
+import time
 
 from telethon.tl.types import (UserProfilePhoto, User, UpdateUserName, PeerUser, TypeInputPeer,
                                InputPeerPhotoFileLocation, UserProfilePhotoEmpty, TypeInputUser)
@@ -44,7 +45,8 @@ config: Optional['Config'] = None
 
 
 class Puppet(BasePuppet):
-    log: TraceLogger = logging.getLogger("mau.puppet")
+    base_log: TraceLogger = logging.getLogger("mau.puppet")
+    log: TraceLogger = util.ChildLogger(base_log, lambda puppet: str(puppet.id))
     az: AppService
     mx: 'MatrixHandler'
     loop: asyncio.AbstractEventLoop
@@ -54,6 +56,16 @@ class Puppet(BasePuppet):
 
     cache: Dict[TelegramID, 'Puppet'] = {}
     by_custom_mxid: Dict[UserID, 'Puppet'] = {}
+    # The IDs of all puppets in the database, if they were preloaded at startup.
+    # Puppets themselves are only loaded when they're first used.
+    known_ids: Optional[Set[TelegramID]] = None
+    # IDs that were looked up, but don't have a puppet in the database.
+    missing_ids: Set[TelegramID] = set()
+    # Secondary indexes for mention resolution, kept up to date by the property setters below.
+    # Usernames are case-insensitive, displaynames are matched exactly. Displaynames aren't
+    # unique, so each one maps to all the cached puppets that have it.
+    by_username: Dict[str, 'Puppet'] = {}
+    by_displayname: Dict[str, Dict[TelegramID, 'Puppet']] = {}
 
     id: TelegramID
     access_token: Optional[str]
@@ -62,8 +74,8 @@ class Puppet(BasePuppet):
     base_url: Optional[URL]
     default_mxid: UserID
 
-    username: Optional[str]
-    displayname: Optional[str]
+    _username: Optional[str]
+    _displayname: Optional[str]
     displayname_source: Optional[TelegramID]
     displayname_contact: bool
     photo_id: Optional[str]
@@ -71,12 +83,16 @@ class Puppet(BasePuppet):
     is_registered: bool
     disable_updates: bool
 
-    default_mxid_intent: IntentAPI
-    intent: IntentAPI
+    # Most puppets are only loaded to look up their info, so the intents and the logger are only
+    # created when they're first needed.
+    _default_mxid_intent: Optional[IntentAPI]
+    _intent: Optional[IntentAPI]
+    _log: Optional[TraceLogger]
 
     sync_task: Optional[asyncio.Future]
 
     _db_instance: Optional[DBPuppet]
+    _last_used: float
 
     def __init__(self,
                  id: TelegramID,
@@ -100,6 +116,8 @@ class Puppet(BasePuppet):
         self.base_url = URL(base_url) if base_url else None
         self.default_mxid = self.get_mxid_from_id(self.id)
 
+        self._username = None
+        self._displayname = None
         self.username = username
         self.displayname = displayname
         self.displayname_source = displayname_source
@@ -110,24 +128,73 @@ class Puppet(BasePuppet):
         self.disable_updates = disable_updates
         self._db_instance = db_instance
 
-        self.default_mxid_intent = self.az.intent.user(self.default_mxid)
-        self.intent = self._fresh_intent()
+        self._default_mxid_intent = None
+        self._intent = None
+        self._log = None
         self.sync_task = None
+        self._last_used = time.monotonic()
 
         self.cache[id] = self
+        self.missing_ids.discard(id)
+        if self.known_ids is not None:
+            self.known_ids.add(id)
         if self.custom_mxid:
             self.by_custom_mxid[self.custom_mxid] = self
 
-        self.log = self.log.getChild(str(self.id))
-
     @property
     def tgid(self) -> TelegramID:
         return self.id
 
+    @property
+    def default_mxid_intent(self) -> IntentAPI:
+        if not self._default_mxid_intent:
+            self._default_mxid_intent = self.az.intent.user(self.default_mxid)
+        return self._default_mxid_intent
+
+    @property
+    def intent(self) -> IntentAPI:
+        if not self._intent:
+            self._intent = self._fresh_intent()
+        return self._intent
+
+    @intent.setter
+    def intent(self, value: IntentAPI) -> None:
+        self._intent = value
+
     @property
     def peer(self) -> PeerUser:
         return PeerUser(user_id=self.tgid)
 
+    @property
+    def username(self) -> Optional[str]:
+        return self._username
+
+    @username.setter
+    def username(self, value: Optional[str]) -> None:
+        if self._username and self.by_username.get(self._username.lower()) is self:
+            del self.by_username[self._username.lower()]
+        self._username = value
+        if value:
+            self.by_username[value.lower()] = self
+
+    @property
+    def displayname(self) -> Optional[str]:
+        return self._displayname
+
+    @displayname.setter
+    def displayname(self, value: Optional[str]) -> None:
+        self._remove_displayname_index()
+        self._displayname = value
+        if value:
+            self.by_displayname.setdefault(value, {})[self.id] = self
+
+    def _remove_displayname_index(self) -> None:
+        puppets = self.by_displayname.get(self._displayname) if self._displayname else None
+        if puppets and puppets.get(self.id) is self:
+            del puppets[self.id]
+            if not puppets:
+                del self.by_displayname[self._displayname]
+
     @property
     def next_batch(self) -> SyncToken:
         return self._next_batch
@@ -331,17 +398,20 @@ class Puppet(BasePuppet):
                     self.photo_id = ""
                 return True
 
-            loc = InputPeerPhotoFileLocation(
-                peer=await self.get_input_entity(source),
-                local_id=photo.photo_big.local_id,
-                volume_id=photo.photo_big.volume_id,
-                big=True
-            )
-            file = await util.transfer_file_to_matrix(source.client, self.default_mxid_intent, loc)
-            if file:
+            mxc = util.get_known_avatar(photo_id)
+            if not mxc:
+                loc = InputPeerPhotoFileLocation(
+                    peer=await self.get_input_entity(source),
+                    local_id=photo.photo_big.local_id,
+                    volume_id=photo.photo_big.volume_id,
+                    big=True
+                )
+                mxc = await util.transfer_avatar_to_matrix(source.client,
+                                                           self.default_mxid_intent, photo_id, loc)
+            if mxc:
                 self.photo_id = photo_id
                 try:
-                    await self.default_mxid_intent.set_avatar_url(file.mxc)
+                    await self.default_mxid_intent.set_avatar_url(mxc)
                 except MatrixRequestError:
                     self.log.exception("Failed to set avatar")
                     self.photo_id = ""
@@ -355,16 +425,53 @@ class Puppet(BasePuppet):
     # endregion
     # region Getters
 
+    @classmethod
+    def _may_exist_in_db(cls, tgid: TelegramID) -> bool:
+        return tgid not in cls.missing_ids and (cls.known_ids is None or tgid in cls.known_ids)
+
+    @classmethod
+    def preload_ids(cls) -> int:
+        cls.known_ids = set(DBPuppet.all_ids())
+        cls.missing_ids.clear()
+        return len(cls.known_ids)
+
+    @property
+    def in_use(self) -> bool:
+        return bool(self.custom_mxid or self.sync_task)
+
+    def remove_from_cache(self) -> None:
+        # The ID stays in known_ids, since the puppet is still in the database.
+        if self.cache.get(self.id) is self:
+            del self.cache[self.id]
+        if self.custom_mxid and self.by_custom_mxid.get(self.custom_mxid) is self:
+            del self.by_custom_mxid[self.custom_mxid]
+        if self._username and self.by_username.get(self._username.lower()) is self:
+            del self.by_username[self._username.lower()]
+        self._remove_displayname_index()
+
+    @classmethod
+    def evict_inactive(cls, max_size: int, min_idle: float, referenced: Set[TelegramID]) -> int:
+        # Puppets that are referenced elsewhere (e.g. in the contact lists of users) are kept, so
+        # that there's never more than one instance of the same puppet.
+        return util.evict_lru("puppet", list(cls.cache.values()), max_size, min_idle,
+                              lambda puppet: puppet.in_use or puppet.id in referenced,
+                              lambda puppet: puppet.remove_from_cache())
+
     @classmethod
     def get(cls, tgid: TelegramID, create: bool = True) -> Optional['Puppet']:
         try:
-            return cls.cache[tgid]
+            puppet = cls.cache[tgid]
         except KeyError:
             pass
+        else:
+            puppet._last_used = time.monotonic()
+            return puppet
 
-        puppet = DBPuppet.get_by_tgid(tgid)
-        if puppet:
-            return cls.from_db(puppet)
+        if cls._may_exist_in_db(tgid):
+            puppet = DBPuppet.get_by_tgid(tgid)
+            if puppet:
+                return cls.from_db(puppet)
+            cls.missing_ids.add(tgid)
 
         if create:
             puppet = cls(tgid)
@@ -373,6 +480,32 @@ class Puppet(BasePuppet):
 
         return None
 
+    @classmethod
+    def get_many(cls, tgids: Iterable[TelegramID], create: bool = True
+                 ) -> Dict[TelegramID, 'Puppet']:
+        puppets = {}
+        missing = []
+        now = time.monotonic()
+        for tgid in tgids:
+            try:
+                puppet = puppets[tgid] = cls.cache[tgid]
+            except KeyError:
+                missing.append(tgid)
+            else:
+                puppet._last_used = now
+        if not missing:
+            return puppets
+
+        for db_puppet in DBPuppet.get_many_by_tgid([tgid for tgid in missing
+                                                    if cls._may_exist_in_db(tgid)]):
+            puppets[db_puppet.id] = cls.cache.get(db_puppet.id) or cls.from_db(db_puppet)
+
+        if create:
+            new_puppets = [cls(tgid) for tgid in missing if tgid not in puppets]
+            DBPuppet.bulk_insert(puppet.db_instance for puppet in new_puppets)
+            puppets.update((puppet.tgid, puppet) for puppet in new_puppets)
+        return puppets
+
     @classmethod
     def deprecated_sync_get_by_mxid(cls, mxid: UserID, create: bool = True) -> Optional['Puppet']:
         tgid = cls.get_id_from_mxid(mxid)
@@ -428,13 +561,14 @@ class Puppet(BasePuppet):
 
         username = username.lower()
 
-        for _, puppet in cls.cache.items():
-            if puppet.username and puppet.username.lower() == username:
-                return puppet
+        try:
+            return cls.by_username[username]
+        except KeyError:
+            pass
 
         dbpuppet = DBPuppet.get_by_username(username)
         if dbpuppet:
-            return cls.from_db(dbpuppet)
+            return cls.cache.get(dbpuppet.id) or cls.from_db(dbpuppet)
 
         return None
 
@@ -443,13 +577,14 @@ class Puppet(BasePuppet):
         if not displayname:
             return None
 
-        for _, puppet in cls.cache.items():
-            if puppet.displayname and puppet.displayname == displayname:
-                return puppet
+        try:
+            return next(iter(cls.by_displayname[displayname].values()))
+        except KeyError:
+            pass
 
         dbpuppet = DBPuppet.get_by_displayname(displayname)
         if dbpuppet:
-            return cls.from_db(dbpuppet)
+            return cls.cache.get(dbpuppet.id) or cls.from_db(dbpuppet)
 
         return None
     # endregion
@@ -474,4 +609,6 @@ def init(context: 'Context') -> Iterable[Awaitable[Any]]:
                                       in config["bridge.login_shared_secret_map"].items()}
     Puppet.login_device_name = "Telegram Bridge"
 
+    util.init_avatar_transfer(config["bridge.max_parallel_avatar_transfers"])
+
     return (puppet.try_start() for puppet in Puppet.all_with_custom_mxid())
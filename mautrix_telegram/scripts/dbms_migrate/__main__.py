@@ -27,7 +27,7 @@ def connect(to):
     from mautrix.util.db import Base
     from mautrix.client.state_store.sqlalchemy import RoomState, UserProfile
     from mautrix_telegram.db import (Portal, Message, UserPortal, User, Contact, Puppet, BotChat,
-                                     TelegramFile)
+                                     TelegramFile, PortalParticipants)
 
     db_engine = sql.create_engine(to)
     db_factory = orm.sessionmaker(bind=db_engine)
@@ -56,6 +56,7 @@ def connect(to):
         "Contact": Contact,
         "BotChat": BotChat,
         "TelegramFile": TelegramFile,
+        "PortalParticipants": PortalParticipants,
     }
 
 
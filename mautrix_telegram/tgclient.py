@@ -13,15 +13,21 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import List, Union, Optional
+from typing import Dict, Iterable, List, Union, Optional
+import asyncio
+
+from sqlalchemy import and_, select
 
 from telethon import TelegramClient, utils
 from telethon.tl.functions.messages import SendMediaRequest
 from telethon.tl.types import (InputMediaUploadedDocument, InputMediaUploadedPhoto,
                                TypeDocumentAttribute, TypeInputMedia, TypeInputPeer,
-                               TypeMessageEntity, TypeMessageMedia, TypePeer)
+                               TypeMessageEntity, TypeMessageMedia, TypePeer, InputPeerUser)
 from telethon.tl.patched import Message
 from telethon.sessions.abstract import Session
+from alchemysession.orm import AlchemySession
+
+from .db.telethon_session import CachedSession
 
 
 class MautrixTelegramClient(TelegramClient):
@@ -53,3 +59,40 @@ class MautrixTelegramClient(TelegramClient):
         request = SendMediaRequest(entity, media, message=caption or "", entities=entities or [],
                                    reply_to_msg_id=reply_to)
         return self._get_response_message(request, await self(request), entity)
+
+    def _get_session_input_users(self, user_ids: List[int]) -> Dict[int, TypeInputPeer]:
+        if isinstance(self.session, CachedSession):
+            return {user_id: InputPeerUser(user_id, access_hash) for user_id, access_hash
+                    in self.session.get_input_user_hashes(user_ids).items()}
+        elif not isinstance(self.session, AlchemySession):
+            return {}
+        table = self.session.Entity.__table__
+        query = select([table.c.id, table.c.hash]).where(
+            and_(table.c.session_id == self.session.session_id, table.c.id.in_(user_ids)))
+        rows = self.session.engine.execute(query)
+        return {user_id: InputPeerUser(user_id, access_hash) for user_id, access_hash in rows}
+
+    async def get_input_users(self, user_ids: Iterable[int]) -> Dict[int, TypeInputPeer]:
+        user_ids = set(user_ids)
+        input_users = {}
+        missing = []
+        for user_id in user_ids:
+            try:
+                input_users[user_id] = self._entity_cache[user_id]
+            except KeyError:
+                missing.append(user_id)
+        if missing:
+            # Read all the access hashes that are in the session database with one query instead
+            # of letting get_input_entity look up each user separately.
+            input_users.update(self._get_session_input_users(missing))
+            missing = [user_id for user_id in missing if user_id not in input_users]
+        if missing:
+            results = await asyncio.gather(*[self.get_input_entity(user_id)
+                                             for user_id in missing], return_exceptions=True)
+            for user_id, result in zip(missing, results):
+                if isinstance(result, (ValueError, TypeError)):
+                    continue
+                elif isinstance(result, Exception):
+                    raise result
+                input_users[user_id] = result
+        return input_users
@@ -13,11 +13,12 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import (Awaitable, Dict, List, Iterable, NamedTuple, Optional, Tuple, Any, cast,
-                    TYPE_CHECKING)
+from typing import (Awaitable, Dict, List, Iterable, NamedTuple, Optional, Set, Tuple, Any,
+                    cast, TYPE_CHECKING)
 from collections import defaultdict
 import logging
 import asyncio
+import time
 
 from telethon.tl.types import (TypeUpdate, UpdateNewMessage, UpdateNewChannelMessage, PeerUser,
                                UpdateShortChatMessage, UpdateShortMessage, User as TLUser, Chat,
@@ -37,7 +38,7 @@ from mautrix.util.opt_prometheus import Gauge
 from .types import TelegramID
 from .db import User as DBUser, Portal as DBPortal
 from .abstract_user import AbstractUser
-from . import portal as po, puppet as pu
+from . import portal as po, puppet as pu, util
 
 if TYPE_CHECKING:
     from .config import Config
@@ -49,45 +50,79 @@ SearchResult = NamedTuple('SearchResult', puppet='pu.Puppet', similarity=int)
 
 METRIC_LOGGED_IN = Gauge('bridge_logged_in', 'Users logged into bridge')
 METRIC_CONNECTED = Gauge('bridge_connected', 'Users connected to Telegram')
+METRIC_STARTUP_TIME = Gauge('bridge_user_startup_seconds',
+                            'Time it took to connect and sync all users at startup')
 
 
 class User(AbstractUser, BaseUser):
     log: TraceLogger = logging.getLogger("mau.user")
     by_mxid: Dict[str, 'User'] = {}
     by_tgid: Dict[int, 'User'] = {}
+    # Whether all users in the database are loaded into the caches above
+    all_loaded: bool = False
+    # Lowercased username -> user, kept up to date by the username property setter
+    by_username: Dict[str, 'User'] = {}
+    # Set when the clients of all users have been started (or skipped) and their initial syncs
+    # have finished after the bridge starts
+    startup_complete: Optional[asyncio.Event] = None
+    # Limits the number of initial syncs running at once while the bridge is starting
+    _startup_sync_slots: Optional[asyncio.Semaphore] = None
+    _startup_users: List['User'] = []
+    _startup_ts: float = 0
 
     phone: Optional[str]
+    last_activity: int
     contacts: List['pu.Puppet']
     saved_contacts: int
     portals: Dict[Tuple[TelegramID, TelegramID], 'po.Portal']
     command_status: Optional[Dict[str, Any]]
 
     _db_instance: Optional[DBUser]
+    _db_contact_ids: Set[TelegramID]
+    _db_portal_ids: Set[Tuple[TelegramID, TelegramID]]
+    _db_rows_tgid: Optional[TelegramID]
     _ensure_started_lock: asyncio.Lock
     _track_connection_task: Optional[asyncio.Task]
+    _post_login_task: Optional[asyncio.Task]
+    _last_matrix_activity: float
+    _hibernating: bool
+    _last_used: float
 
     def __init__(self, mxid: UserID, tgid: Optional[TelegramID] = None,
                  username: Optional[str] = None, phone: Optional[str] = None,
                  db_contacts: Optional[Iterable[TelegramID]] = None,
                  saved_contacts: int = 0, is_bot: bool = False,
                  db_portals: Optional[Iterable[Tuple[TelegramID, TelegramID]]] = None,
-                 db_instance: Optional[DBUser] = None) -> None:
+                 last_activity: int = 0, db_instance: Optional[DBUser] = None) -> None:
         super().__init__()
+        db_contacts = list(db_contacts or [])
+        db_portals = list(db_portals or [])
         self.mxid = mxid
         self.tgid = tgid
         self.is_bot = is_bot
+        self._username = None
         self.username = username
         self.phone = phone
+        self.last_activity = last_activity
         self.contacts = []
         self.saved_contacts = saved_contacts
         self.db_contacts = db_contacts
         self.portals = {}
-        self.db_portals = db_portals or []
+        self.db_portals = db_portals
         self._db_instance = db_instance
+        # The contact and user_portal rows that are in the database, so that saving only has to
+        # write the changes.
+        self._db_contact_ids = set(db_contacts)
+        self._db_portal_ids = set(db_portals)
+        self._db_rows_tgid = tgid
         self._ensure_started_lock = asyncio.Lock()
         self.dm_update_lock = asyncio.Lock()
         self._metric_value = defaultdict(lambda: False)
         self._track_connection_task = None
+        self._post_login_task = None
+        self._last_matrix_activity = time.monotonic()
+        self._hibernating = False
+        self._last_used = time.monotonic()
 
         self.command_status = None
 
@@ -108,6 +143,18 @@ class User(AbstractUser, BaseUser):
     def name(self) -> str:
         return self.mxid
 
+    @property
+    def username(self) -> Optional[str]:
+        return self._username
+
+    @username.setter
+    def username(self, value: Optional[str]) -> None:
+        if self._username and self.by_username.get(self._username.lower()) is self:
+            del self.by_username[self._username.lower()]
+        self._username = value
+        if value:
+            self.by_username[value.lower()] = self
+
     @property
     def mxid_localpart(self) -> str:
         localpart, server = Client.parse_user_id(self.mxid)
@@ -158,23 +205,48 @@ class User(AbstractUser, BaseUser):
         return self._db_instance
 
     def new_db_instance(self) -> DBUser:
+        # Make the next save check what's actually in the database.
+        self._db_rows_tgid = None
         return DBUser(mxid=self.mxid, tgid=self.tgid, tg_username=self.username,
-                      saved_contacts=self.saved_contacts, portals=self.db_portals)
+                      saved_contacts=self.saved_contacts, last_activity=self.last_activity,
+                      portals=self.db_portals)
 
     async def save(self, contacts: bool = False, portals: bool = False) -> None:
         self.db_instance.edit(tgid=self.tgid, tg_username=self.username, tg_phone=self.phone,
-                              saved_contacts=self.saved_contacts)
+                              saved_contacts=self.saved_contacts,
+                              last_activity=self.last_activity)
+        if (contacts or portals) and self._db_rows_tgid != self.tgid:
+            # The rows are stored by Telegram ID, so we don't know what's in the database for a
+            # different account.
+            self._db_contact_ids = set(self.db_instance.contacts)
+            self._db_portal_ids = set(self.db_instance.portals)
+            self._db_rows_tgid = self.tgid
         if contacts:
-            self.db_instance.contacts = self.db_contacts
+            contact_ids = set(self.db_contacts)
+            self.db_instance.update_contacts(add=contact_ids - self._db_contact_ids,
+                                             remove=self._db_contact_ids - contact_ids)
+            self._db_contact_ids = contact_ids
         if portals:
-            self.db_instance.portals = self.db_portals
+            portal_ids = set(self.db_portals)
+            self.db_instance.update_portals(add=portal_ids - self._db_portal_ids,
+                                            remove=self._db_portal_ids - portal_ids)
+            self._db_portal_ids = portal_ids
 
-    def delete(self, delete_db: bool = True) -> None:
-        try:
+    @property
+    def in_use(self) -> bool:
+        return bool(self.tgid or self.client or self.command_status
+                    or self._ensure_started_lock.locked() or self.dm_update_lock.locked())
+
+    def remove_from_cache(self) -> None:
+        if self.by_mxid.get(self.mxid) is self:
             del self.by_mxid[self.mxid]
+        if self.tgid and self.by_tgid.get(self.tgid) is self:
             del self.by_tgid[self.tgid]
-        except KeyError:
-            pass
+        if self._username and self.by_username.get(self._username.lower()) is self:
+            del self.by_username[self._username.lower()]
+
+    def delete(self, delete_db: bool = True) -> None:
+        self.remove_from_cache()
         if delete_db and self._db_instance:
             self._db_instance.delete()
 
@@ -182,17 +254,116 @@ class User(AbstractUser, BaseUser):
     def from_db(cls, db_user: DBUser) -> 'User':
         return User(db_user.mxid, db_user.tgid, db_user.tg_username, db_user.tg_phone,
                     db_user.contacts, db_user.saved_contacts, False, db_user.portals,
-                    db_instance=db_user)
+                    last_activity=db_user.last_activity, db_instance=db_user)
 
     # endregion
     # region Telegram connection management
 
+    def mark_active(self) -> None:
+        self._last_matrix_activity = time.monotonic()
+        now = int(time.time())
+        # The timestamp is only used to order and skip users at startup, so it doesn't need to be
+        # written more often than once an hour.
+        if now - self.last_activity > 60 * 60:
+            self.last_activity = now
+            self.db_instance.edit(last_activity=now)
+
     async def try_ensure_started(self) -> None:
         try:
             await self.ensure_started()
         except Exception:
             self.log.exception("Exception in ensure_started")
 
+    # Connects the clients of all users. This is part of the bridge startup, so it doesn't wait
+    # for the initial syncs, which are limited by _startup_sync_slots instead and waited for by
+    # finish_startup in the background.
+    @classmethod
+    async def start_all(cls, users: Iterable['User']) -> None:
+        start_ts = cls._startup_ts = time.time()
+        loop = asyncio.get_event_loop()
+        users = list(users)
+        idle_days = config["bridge.startup_idle_days"]
+        if idle_days > 0:
+            # Users who haven't done anything for a long time will be started when they next send
+            # something to the bridge. Users with no known activity are always started.
+            idle_cutoff = start_ts - idle_days * 24 * 60 * 60
+            idle_count = len(users)
+            users = [user for user in users
+                     if not user.last_activity or user.last_activity > idle_cutoff]
+            idle_count -= len(users)
+        else:
+            idle_count = 0
+        users.sort(key=lambda user: user.last_activity, reverse=True)
+        cls.log.info(f"Starting {len(users)} users, skipping {idle_count} idle users")
+
+        concurrency = max(config["bridge.startup_concurrency"], 1)
+        semaphore = asyncio.Semaphore(concurrency)
+        cls._startup_sync_slots = asyncio.Semaphore(concurrency)
+        cls._startup_users = users
+        delay = config["bridge.startup_delay"]
+        next_start = loop.time()
+
+        async def start(user: User) -> None:
+            nonlocal next_start
+            async with semaphore:
+                # Space out connections so that they don't all hit Telegram at the same moment.
+                now = loop.time()
+                wait = next_start - now
+                next_start = max(now, next_start) + delay
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                await user.try_ensure_started()
+
+        await asyncio.gather(*[start(user) for user in users])
+        cls.log.info(f"Connected {len(users)} users in {round(time.time() - start_ts, 2)} "
+                     "seconds, waiting for initial syncs in the background")
+
+    @classmethod
+    async def finish_startup(cls) -> None:
+        users, cls._startup_users = cls._startup_users, []
+        await asyncio.gather(*[user._post_login_task for user in users if user._post_login_task],
+                             return_exceptions=True)
+        cls._startup_sync_slots = None
+        duration = time.time() - cls._startup_ts
+        METRIC_STARTUP_TIME.set(duration)
+        cls.startup_complete.set()
+        cls.log.info(f"Finished starting {len(users)} users in {round(duration, 2)} seconds")
+
+        if config["bridge.hibernate_idle_hours"] > 0:
+            asyncio.ensure_future(cls._hibernate_idle_loop())
+
+    @classmethod
+    async def _hibernate_idle_loop(cls) -> None:
+        max_idle = config["bridge.hibernate_idle_hours"] * 60 * 60
+        while True:
+            await asyncio.sleep(60)
+            now = time.monotonic()
+            idle_users = [user for user in cls.by_tgid.values()
+                          if (user.connected and not user.is_bot
+                              and now - user._last_matrix_activity > max_idle)]
+            for user in idle_users:
+                try:
+                    await user.hibernate()
+                except Exception:
+                    user.log.exception("Failed to hibernate idle client")
+
+    async def hibernate(self) -> None:
+        self.log.debug("Disconnecting idle client, it'll be reconnected on the next Matrix event")
+        self._hibernating = True
+        # Don't leave the initial sync running against a disconnected client.
+        if self._post_login_task and not self._post_login_task.done():
+            self._post_login_task.cancel()
+            try:
+                await self._post_login_task
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                self.log.debug("Post-login task failed before hibernating", exc_info=True)
+        self._post_login_task = None
+        await self.stop()
+        # Drop the cached session data too, it'll be reloaded when the client is started again.
+        self.session = None
+
     async def ensure_started(self, even_if_no_session=False) -> 'User':
         if not self.puppet_whitelisted or self.connected:
             return self
@@ -203,13 +374,23 @@ class User(AbstractUser, BaseUser):
         await super().start()
         if await self.is_logged_in():
             self.log.debug(f"Ensuring post_login() for {self.name}")
-            self.loop.create_task(self.post_login())
+            self._post_login_task = self.loop.create_task(
+                self._run_post_login(catch_up=self._hibernating))
+            self._hibernating = False
         elif delete_unless_authenticated:
             self.log.debug(f"Unauthenticated user {self.name} start()ed, deleting session...")
             await self.client.disconnect()
             self.client.session.delete()
         return self
 
+    async def _run_post_login(self, catch_up: bool) -> None:
+        slots = self._startup_sync_slots
+        if not slots:
+            await self.post_login(catch_up=catch_up)
+            return
+        async with slots:
+            await self.post_login(catch_up=catch_up)
+
     async def _track_connection(self) -> None:
         self.log.debug("Starting loop to track connection state")
         while True:
@@ -225,7 +406,8 @@ class User(AbstractUser, BaseUser):
             self._track_connection_task = None
         self._track_metric(METRIC_CONNECTED, False)
 
-    async def post_login(self, info: TLUser = None, first_login: bool = False) -> None:
+    async def post_login(self, info: TLUser = None, first_login: bool = False,
+                         catch_up: bool = False) -> None:
         if config["metrics.enabled"] and not self._track_connection_task:
             self._track_connection_task = self.loop.create_task(self._track_connection())
 
@@ -245,13 +427,33 @@ class User(AbstractUser, BaseUser):
         except Exception:
             self.log.exception("Failed to automatically enable custom puppet")
 
-        if not self.is_bot and config["bridge.startup_sync"]:
+        if catch_up:
+            # The client was disconnected for being idle, so only fetch what was missed instead
+            # of doing a full sync.
+            try:
+                await self.client.catch_up()
+            except Exception:
+                self.log.exception("Failed to catch up after hibernation")
+            # Telethon only catches up on the common update state, which doesn't include
+            # supergroups and channels. Their missed updates only show up as
+            # UpdateChannelTooLong, so the messages are backfilled instead.
+            await self._backfill_channels()
+        elif not self.is_bot and config["bridge.startup_sync"]:
             try:
                 await self.sync_dialogs()
                 await self.sync_contacts()
             except Exception:
                 self.log.exception("Failed to run post-login sync")
 
+    async def _backfill_channels(self) -> None:
+        for portal in list(self.portals.values()):
+            if not portal.mxid or portal.peer_type != "channel":
+                continue
+            try:
+                await portal.backfill(self)
+            except Exception:
+                self.log.exception(f"Failed to backfill {portal.tgid_log} after hibernation")
+
     async def update(self, update: TypeUpdate) -> bool:
         if not self.is_bot:
             return False
@@ -467,12 +669,17 @@ class User(AbstractUser, BaseUser):
         if not mxid:
             raise ValueError("Matrix ID can't be empty")
 
+        # Like the other cache getters, this doesn't await anything, which is what keeps
+        # concurrent lookups from creating the user twice.
         try:
-            return cls.by_mxid[mxid]
+            user = cls.by_mxid[mxid]
         except KeyError:
             pass
+        else:
+            user._last_used = time.monotonic()
+            return user
 
-        if check_db:
+        if check_db and not cls.all_loaded:
             user = DBUser.get_by_mxid(mxid)
             if user:
                 user = cls.from_db(user)
@@ -488,17 +695,59 @@ class User(AbstractUser, BaseUser):
     @classmethod
     def get_by_tgid(cls, tgid: TelegramID) -> Optional['User']:
         try:
-            return cls.by_tgid[tgid]
+            user = cls.by_tgid[tgid]
         except KeyError:
             pass
-
-        user = DBUser.get_by_tgid(tgid)
-        if user:
-            user = cls.from_db(user)
+        else:
+            user._last_used = time.monotonic()
             return user
 
+        if not cls.all_loaded:
+            user = DBUser.get_by_tgid(tgid)
+            if user:
+                user = cls.from_db(user)
+                return user
+
         return None
 
+    @classmethod
+    def evict_inactive(cls, max_size: int, min_idle: float) -> int:
+        # Logged in users and users who are in the middle of logging in are never evicted.
+        count = util.evict_lru("user", list(cls.by_mxid.values()), max_size, min_idle,
+                               lambda user: user.in_use, lambda user: user.remove_from_cache())
+        if count:
+            cls.all_loaded = False
+        return count
+
+    @classmethod
+    def preload_all(cls) -> int:
+        contacts = DBUser.all_contacts()
+        portals = DBUser.all_portals()
+        count = 0
+        for db_user in DBUser.all():
+            if db_user.mxid not in cls.by_mxid:
+                User(db_user.mxid, db_user.tgid, db_user.tg_username, db_user.tg_phone,
+                     contacts.get(db_user.tgid, []), db_user.saved_contacts, False,
+                     portals.get(db_user.tgid, []), last_activity=db_user.last_activity,
+                     db_instance=db_user)
+            count += 1
+        cls.all_loaded = True
+        return count
+
+    @classmethod
+    def get_many_by_tgid(cls, tgids: Iterable[TelegramID]) -> Dict[TelegramID, 'User']:
+        users = {}
+        missing = []
+        for tgid in tgids:
+            try:
+                users[tgid] = cls.by_tgid[tgid]
+            except KeyError:
+                missing.append(tgid)
+        if missing and not cls.all_loaded:
+            for db_user in DBUser.get_many_by_tgid(missing):
+                users[db_user.tgid] = cls.by_tgid.get(db_user.tgid) or cls.from_db(db_user)
+        return users
+
     @classmethod
     def find_by_username(cls, username: str) -> Optional['User']:
         if not username:
@@ -506,22 +755,25 @@ class User(AbstractUser, BaseUser):
 
         username = username.lower()
 
-        for _, user in cls.by_tgid.items():
-            if user.username and user.username.lower() == username:
-                return user
+        try:
+            return cls.by_username[username]
+        except KeyError:
+            pass
 
-        puppet = DBUser.get_by_username(username)
-        if puppet:
-            return cls.from_db(puppet)
+        if not cls.all_loaded:
+            db_user = DBUser.get_by_username(username)
+            if db_user:
+                return cls.by_tgid.get(db_user.tgid) or cls.from_db(db_user)
 
         return None
     # endregion
 
 
-def init(context: 'Context') -> Iterable[Awaitable['User']]:
+def init(context: 'Context') -> Awaitable[None]:
     global config
     config = context.config
     User.bridge = context.bridge
+    User.startup_complete = asyncio.Event()
 
-    return (User.from_db(db_user).try_ensure_started()
-            for db_user in DBUser.all_with_tgid())
+    return User.start_all(User.by_tgid.get(db_user.tgid) or User.from_db(db_user)
+                          for db_user in DBUser.all_with_tgid())
@@ -1,5 +1,13 @@
 from .file_transfer import transfer_file_to_matrix, convert_image
 from .parallel_file_transfer import parallel_transfer_to_telegram
+from .avatar_transfer import (transfer_avatar_to_matrix, prefetch_avatars, get_known_avatar,
+                              init as init_avatar_transfer)
+from .recent_events import add_recent_event, get_recent_event, remove_recent_event
+from .coalescer import StateCoalescer
+from .batcher import WindowBatcher
+from .ordered_dispatcher import OrderedDispatcher
+from .instance_cache import evict_lru
+from .child_logger import ChildLogger
 from .format_duration import format_duration
 from .recursive_dict import recursive_del, recursive_set, recursive_get
 from .color_log import ColorFormatter
@@ -0,0 +1,148 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Iterable, Optional, Tuple
+from collections import OrderedDict
+import logging
+import asyncio
+import time
+
+from sqlalchemy.exc import IntegrityError, InvalidRequestError
+
+from mautrix.appservice import IntentAPI
+from mautrix.types import ContentURI
+
+from ..tgclient import MautrixTelegramClient
+from ..db import TelegramFile as DBTelegramFile
+from .file_transfer import transfer_file_to_matrix, TypeLocation
+
+log: logging.Logger = logging.getLogger("mau.util.avatar")
+
+# Avatars are keyed by the Telegram photo ID rather than the file location, because the same
+# photo can be reachable through many different peer locations (e.g. a user's profile photo is
+# seen through every chat they're in). Only the most recently used ones are kept in memory, the
+# rest can still be found in the database.
+known_avatars: 'OrderedDict[str, ContentURI]' = OrderedDict()
+max_known_avatars: int = 10000
+_pending_transfers: Dict[str, asyncio.Future] = {}
+_transfer_semaphore: Optional[asyncio.Semaphore] = None
+max_parallel_transfers: int = 8
+
+
+def init(max_parallel: int) -> None:
+    global _transfer_semaphore, max_parallel_transfers
+    max_parallel_transfers = max(max_parallel, 1)
+    _transfer_semaphore = asyncio.Semaphore(max_parallel_transfers)
+
+
+def _avatar_file_id(photo_id: str) -> str:
+    return f"avatar-{photo_id}"
+
+
+def _add_known_avatar(photo_id: str, mxc: ContentURI) -> None:
+    known_avatars[photo_id] = mxc
+    if len(known_avatars) > max_known_avatars:
+        known_avatars.popitem(last=False)
+
+
+def get_known_avatar(photo_id: str) -> Optional[ContentURI]:
+    try:
+        mxc = known_avatars[photo_id]
+    except KeyError:
+        pass
+    else:
+        known_avatars.move_to_end(photo_id)
+        return mxc
+    db_file = DBTelegramFile.get(_avatar_file_id(photo_id))
+    if db_file:
+        _add_known_avatar(photo_id, db_file.mxc)
+        return db_file.mxc
+    return None
+
+
+def _store_known_avatar(photo_id: str, file: DBTelegramFile) -> None:
+    _add_known_avatar(photo_id, file.mxc)
+    alias = DBTelegramFile(id=_avatar_file_id(photo_id), mxc=file.mxc, mime_type=file.mime_type,
+                           was_converted=file.was_converted, timestamp=int(time.time()),
+                           size=file.size, width=file.width, height=file.height)
+    try:
+        alias.insert()
+    except (IntegrityError, InvalidRequestError):
+        log.debug(f"Avatar {photo_id} was already stored")
+
+
+async def _transfer_avatar(client: MautrixTelegramClient, intent: IntentAPI, photo_id: str,
+                           location: TypeLocation) -> Optional[ContentURI]:
+    global _transfer_semaphore
+    if _transfer_semaphore is None:
+        _transfer_semaphore = asyncio.Semaphore(max_parallel_transfers)
+    async with _transfer_semaphore:
+        file = await transfer_file_to_matrix(client, intent, location)
+    if not file:
+        return None
+    _store_known_avatar(photo_id, file)
+    return file.mxc
+
+
+async def transfer_avatar_to_matrix(client: MautrixTelegramClient, intent: IntentAPI,
+                                    photo_id: str, location: TypeLocation
+                                    ) -> Optional[ContentURI]:
+    mxc = get_known_avatar(photo_id)
+    if mxc:
+        return mxc
+
+    pending = _pending_transfers.get(photo_id)
+    if pending:
+        # Someone else is already transferring this photo, just wait for their result.
+        try:
+            return await asyncio.shield(pending)
+        except asyncio.CancelledError:
+            if not pending.cancelled():
+                raise
+        # The other transfer was cancelled rather than this task, so try again.
+        return await transfer_avatar_to_matrix(client, intent, photo_id, location)
+
+    fut = asyncio.get_event_loop().create_future()
+    _pending_transfers[photo_id] = fut
+    try:
+        mxc = await _transfer_avatar(client, intent, photo_id, location)
+    except Exception as e:
+        fut.set_exception(e)
+        # Mark the exception as retrieved in case nobody else was waiting for it.
+        fut.exception()
+        raise
+    else:
+        fut.set_result(mxc)
+        return mxc
+    finally:
+        # Don't leave the waiters hanging if the transfer was cancelled.
+        if not fut.done():
+            fut.cancel()
+        del _pending_transfers[photo_id]
+
+
+async def prefetch_avatars(client: MautrixTelegramClient, intent: IntentAPI,
+                           avatars: Iterable[Tuple[str, TypeLocation]]) -> None:
+    to_fetch = {photo_id: location for photo_id, location in avatars
+                if photo_id and not get_known_avatar(photo_id)}
+    if not to_fetch:
+        return
+    log.debug(f"Prefetching {len(to_fetch)} avatars")
+    results = await asyncio.gather(*[transfer_avatar_to_matrix(client, intent, photo_id, location)
+                                     for photo_id, location in to_fetch.items()],
+                                   return_exceptions=True)
+    for photo_id, result in zip(to_fetch.keys(), results):
+        if isinstance(result, Exception):
+            log.warning(f"Failed to prefetch avatar {photo_id}: {result}")
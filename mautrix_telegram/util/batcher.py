@@ -0,0 +1,55 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Awaitable, Callable, Dict, Generic, Hashable, List, Optional, TypeVar
+import asyncio
+import logging
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+FlushFunc = Callable[[Dict[K, List[V]]], Awaitable[None]]
+
+
+# Collects values for keys during a short window and then passes all of them to the flush
+# function at once, so that it can batch its work (e.g. database lookups) and only act on the
+# newest value of each key.
+class WindowBatcher(Generic[K, V]):
+    log: logging.Logger = logging.getLogger("mau.batcher")
+
+    window: float
+    flush: FlushFunc
+    _pending: Dict[K, List[V]]
+    _task: Optional[asyncio.Future]
+
+    def __init__(self, window: float, flush: FlushFunc) -> None:
+        self.window = window
+        self.flush = flush
+        self._pending = {}
+        self._task = None
+
+    def add(self, key: K, value: V) -> None:
+        self._pending.setdefault(key, []).append(value)
+        if not self._task:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self) -> None:
+        await asyncio.sleep(self.window)
+        batch, self._pending = self._pending, {}
+        self._task = None
+        try:
+            await self.flush(batch)
+        except Exception:
+            self.log.exception("Failed to flush batch")
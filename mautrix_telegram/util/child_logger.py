@@ -0,0 +1,41 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Callable, Optional, Type
+import logging
+
+
+# A log attribute that is the base logger when accessed through the class and a child logger
+# named after the instance when accessed through an instance. Loggers are never freed, so the
+# child is only created when the instance first logs something. It's stored in the _log attribute
+# of the instance, and can be replaced by assigning to the attribute as usual.
+class ChildLogger:
+    base: logging.Logger
+    get_name: Callable[[Any], str]
+
+    def __init__(self, base: logging.Logger, get_name: Callable[[Any], str]) -> None:
+        self.base = base
+        self.get_name = get_name
+
+    def __get__(self, instance: Any, owner: Optional[Type] = None) -> logging.Logger:
+        if instance is None:
+            return self.base
+        log = instance._log
+        if log is None:
+            log = instance._log = self.base.getChild(self.get_name(instance))
+        return log
+
+    def __set__(self, instance: Any, value: logging.Logger) -> None:
+        instance._log = value
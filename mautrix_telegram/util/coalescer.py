@@ -0,0 +1,116 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Awaitable, Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+from collections import OrderedDict
+import asyncio
+import logging
+import time
+
+from mautrix.util.opt_prometheus import Counter
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+SendFunc = Callable[[V], Awaitable[Any]]
+
+COALESCED_SENT = Counter("bridge_coalesced_state_sent",
+                         "Number of coalesced state updates that were sent", ("state",))
+COALESCED_SUPPRESSED = Counter("bridge_coalesced_state_suppressed",
+                               "Number of state updates that were dropped as duplicates or "
+                               "replaced by a newer value before being sent", ("state",))
+
+
+# Sends the latest value of some state (e.g. typing or presence) for each key at most once per
+# min_interval seconds. Values submitted while a send is pending replace the pending value, and
+# values equal to the last sent one are dropped unless refresh_interval has passed. If
+# max_concurrency is set, at most that many sends are in progress at once. Keys are forgotten
+# once both intervals have passed since their last send.
+class StateCoalescer(Generic[K, V]):
+    log: logging.Logger = logging.getLogger("mau.coalescer")
+
+    name: str
+    min_interval: float
+    refresh_interval: float
+    max_concurrency: int
+    # Ordered by send time, oldest first
+    _sent: 'OrderedDict[K, Tuple[V, float]]'
+    _pending: Dict[K, Tuple[V, SendFunc]]
+    _semaphore: Optional[asyncio.Semaphore]
+
+    def __init__(self, name: str, min_interval: float, refresh_interval: float,
+                 max_concurrency: int = 0) -> None:
+        self.name = name
+        self.min_interval = min_interval
+        self.refresh_interval = refresh_interval
+        self.max_concurrency = max_concurrency
+        self._sent = OrderedDict()
+        self._pending = {}
+        self._semaphore = None
+
+    def _is_duplicate(self, key: K, value: V, now: float) -> bool:
+        try:
+            last_value, last_sent = self._sent[key]
+        except KeyError:
+            return False
+        return last_value == value and now - last_sent < self.refresh_interval
+
+    def submit(self, key: K, value: V, send: SendFunc) -> None:
+        if key in self._pending:
+            self._pending[key] = (value, send)
+            COALESCED_SUPPRESSED.labels(state=self.name).inc()
+            return
+        now = time.monotonic()
+        if self._is_duplicate(key, value, now):
+            COALESCED_SUPPRESSED.labels(state=self.name).inc()
+            return
+        try:
+            _, last_sent = self._sent[key]
+            delay = max(last_sent + self.min_interval - now, 0)
+        except KeyError:
+            delay = 0
+        self._pending[key] = (value, send)
+        asyncio.ensure_future(self._flush(key, delay))
+
+    async def _flush(self, key: K, delay: float) -> None:
+        if delay > 0:
+            await asyncio.sleep(delay)
+        value, send = self._pending.pop(key)
+        now = time.monotonic()
+        if self._is_duplicate(key, value, now):
+            COALESCED_SUPPRESSED.labels(state=self.name).inc()
+            return
+        self._sent[key] = (value, now)
+        self._sent.move_to_end(key)
+        self._prune(now)
+        COALESCED_SENT.labels(state=self.name).inc()
+        try:
+            if self.max_concurrency > 0:
+                if not self._semaphore:
+                    self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                async with self._semaphore:
+                    await send(value)
+            else:
+                await send(value)
+        except Exception:
+            self.log.exception(f"Failed to send coalesced {self.name} {value} for {key}")
+
+    def _prune(self, now: float) -> None:
+        max_age = max(self.min_interval, self.refresh_interval)
+        while self._sent:
+            _, (_, sent) = next(iter(self._sent.items()))
+            if now - sent < max_age:
+                break
+            self._sent.popitem(last=False)
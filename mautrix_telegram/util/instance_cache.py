@@ -0,0 +1,50 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Callable, Collection, TypeVar
+import heapq
+import time
+
+from mautrix.util.opt_prometheus import Counter, Gauge
+
+T = TypeVar("T")
+
+CACHED_INSTANCES = Gauge("bridge_cached_instances",
+                         "Number of portals, puppets or users loaded into memory", ("type",))
+EVICTED_INSTANCES = Counter("bridge_evicted_instances",
+                            "Number of inactive portals, puppets or users removed from memory",
+                            ("type",))
+
+
+# Removes the least recently used instances from an instance cache until there are at most
+# max_size left. Pinned instances and instances that were used in the last min_idle seconds are
+# never removed, even if that leaves the cache over the limit. The instances must have a
+# _last_used attribute with the time.monotonic() timestamp of when they were last used.
+def evict_lru(name: str, instances: Collection[T], max_size: int, min_idle: float,
+              is_pinned: Callable[[T], bool], evict: Callable[[T], None]) -> int:
+    excess = len(instances) - max_size
+    if max_size <= 0 or excess <= 0:
+        CACHED_INSTANCES.labels(type=name).set(len(instances))
+        return 0
+    idle_before = time.monotonic() - min_idle
+    candidates = heapq.nsmallest(excess, (instance for instance in instances
+                                          if (instance._last_used < idle_before
+                                              and not is_pinned(instance))),
+                                 key=lambda instance: instance._last_used)
+    for instance in candidates:
+        evict(instance)
+    CACHED_INSTANCES.labels(type=name).set(len(instances) - len(candidates))
+    EVICTED_INSTANCES.labels(type=name).inc(len(candidates))
+    return len(candidates)
@@ -0,0 +1,101 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Awaitable, Callable, Dict, Generic, Hashable, Optional, TypeVar
+import asyncio
+import logging
+
+from mautrix.util.opt_prometheus import Gauge
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+HandlerFunc = Callable[[V], Awaitable[None]]
+
+DISPATCH_QUEUE_DEPTH = Gauge("bridge_dispatch_queue_depth",
+                             "Number of items waiting in ordered dispatch queues", ("queue",))
+DISPATCH_QUEUE_KEYS = Gauge("bridge_dispatch_queue_keys",
+                            "Number of keys (e.g. rooms) with items in ordered dispatch queues",
+                            ("queue",))
+
+
+# Handles items in the order they were dispatched for each key, and in parallel across keys.
+# Each key gets its own bounded queue and worker task while it has items. dispatch() waits if the
+# queue of the key is full, and wait_for_capacity() waits until the total number of queued items
+# is below max_pending, so callers can slow down whatever is producing the items.
+class OrderedDispatcher(Generic[K, V]):
+    log: logging.Logger = logging.getLogger("mau.dispatcher")
+
+    name: str
+    handler: HandlerFunc
+    max_queue_size: int
+    max_pending: int
+    pending: int
+    _queues: Dict[K, 'asyncio.Queue[V]']
+    _counts: Dict[K, int]
+    _capacity: Optional[asyncio.Event]
+
+    def __init__(self, name: str, handler: HandlerFunc, max_queue_size: int,
+                 max_pending: int) -> None:
+        self.name = name
+        self.handler = handler
+        self.max_queue_size = max_queue_size
+        self.max_pending = max_pending
+        self.pending = 0
+        self._queues = {}
+        self._counts = {}
+        self._capacity = None
+
+    async def dispatch(self, key: K, item: V) -> None:
+        try:
+            queue = self._queues[key]
+        except KeyError:
+            queue = self._queues[key] = asyncio.Queue(self.max_queue_size)
+            self._counts[key] = 0
+            DISPATCH_QUEUE_KEYS.labels(queue=self.name).inc()
+            asyncio.ensure_future(self._work(key, queue))
+        # The count includes items that are still waiting for space in the queue, so that the
+        # worker doesn't stop while there are items coming.
+        self._counts[key] += 1
+        self._add_pending(1)
+        await queue.put(item)
+
+    def _add_pending(self, count: int) -> None:
+        self.pending += count
+        DISPATCH_QUEUE_DEPTH.labels(queue=self.name).inc(count)
+        if self._capacity and self.pending < self.max_pending:
+            self._capacity.set()
+
+    async def wait_for_capacity(self) -> None:
+        while self.pending >= self.max_pending:
+            if not self._capacity or self._capacity.is_set():
+                self._capacity = asyncio.Event()
+            await self._capacity.wait()
+
+    async def _work(self, key: K, queue: 'asyncio.Queue[V]') -> None:
+        # The queue is removed as soon as everything dispatched to it has been handled. There's
+        # no await between the check and the removal, so nothing can be added to it in between.
+        while self._counts[key] > 0:
+            item = await queue.get()
+            try:
+                await self.handler(item)
+            except Exception:
+                self.log.exception(f"Failed to handle {self.name} item for {key}")
+            finally:
+                self._counts[key] -= 1
+                self._add_pending(-1)
+        del self._queues[key]
+        del self._counts[key]
+        DISPATCH_QUEUE_KEYS.labels(queue=self.name).dec()
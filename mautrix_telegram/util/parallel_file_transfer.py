@@ -13,7 +13,8 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, List, AsyncGenerator, Union, Awaitable, DefaultDict, Tuple, cast
+from typing import (Optional, List, AsyncGenerator, AsyncIterable, Union, Awaitable, DefaultDict,
+                    Tuple, cast)
 from collections import defaultdict
 import hashlib
 import asyncio
@@ -21,8 +22,6 @@ import logging
 import time
 import math
 
-from aiohttp import ClientResponse
-
 from telethon.tl.types import (Document, InputFileLocation, InputDocumentFileLocation,
                                InputPhotoFileLocation, InputPeerPhotoFileLocation, TypeInputFile,
                                InputFileBig, InputFile)
@@ -34,6 +33,7 @@ from telethon.crypto import AuthKey
 from telethon import utils, helpers
 
 from mautrix.appservice import IntentAPI
+from mautrix.errors import DecryptionError
 from mautrix.types import ContentURI, EncryptedFile
 from mautrix.util.logging import TraceLogger
 
@@ -45,6 +45,14 @@ try:
 except ImportError:
     async_encrypt_attachment = None
 
+try:
+    from Crypto.Cipher import AES
+    from Crypto.Hash import SHA256
+    from Crypto.Util import Counter
+    import unpaddedbase64
+except ImportError:
+    AES = SHA256 = Counter = unpaddedbase64 = None
+
 log: TraceLogger = cast(TraceLogger, logging.getLogger("mau.util"))
 
 TypeLocation = Union[Document, InputDocumentFileLocation, InputPeerPhotoFileLocation,
@@ -278,33 +286,57 @@ async def parallel_transfer_to_matrix(client: MautrixTelegramClient, intent: Int
                           width=None, height=None, decryption_info=decryption_info)
 
 
-async def _internal_transfer_to_telegram(client: MautrixTelegramClient, response: ClientResponse
+async def async_decrypt_attachment(data: AsyncIterable[bytes], file: EncryptedFile
+                                   ) -> AsyncGenerator[bytes, None]:
+    # AES-CTR is a stream cipher, so chunks can be decrypted as soon as they arrive. The hash can
+    # only be checked after the last chunk, so a mismatch is raised at the end of the stream.
+    if not AES:
+        raise DecryptionError("pycryptodome is not installed")
+    try:
+        key = unpaddedbase64.decode_base64(file.key.key)
+        # The last 8 bytes of the IV are the counter, which always starts from zero
+        iv = unpaddedbase64.decode_base64(file.iv)[:8]
+        expected_hash = unpaddedbase64.decode_base64(file.hashes["sha256"])
+    except (ValueError, TypeError, KeyError) as e:
+        raise DecryptionError("Invalid decryption info") from e
+    cipher = AES.new(key, AES.MODE_CTR, counter=Counter.new(64, prefix=iv, initial_value=0))
+    sha256 = SHA256.new()
+    async for chunk in data:
+        sha256.update(chunk)
+        yield cipher.decrypt(chunk)
+    if sha256.digest() != expected_hash:
+        raise DecryptionError("Mismatched SHA-256 digest")
+
+
+async def _internal_transfer_to_telegram(client: MautrixTelegramClient,
+                                         stream: AsyncIterable[bytes], file_size: int
                                          ) -> Tuple[TypeInputFile, int]:
     file_id = helpers.generate_random_long()
-    file_size = response.content_length
 
     hash_md5 = hashlib.md5()
     uploader = ParallelTransferrer(client)
     part_size, part_count, is_large = await uploader.init_upload(file_id, file_size)
     buffer = bytearray()
-    async for data in response.content:
-        if not is_large:
-            hash_md5.update(data)
-        if len(buffer) == 0 and len(data) == part_size:
-            await uploader.upload(data)
-            continue
-        new_len = len(buffer) + len(data)
-        if new_len >= part_size:
-            cutoff = part_size - len(buffer)
-            buffer.extend(data[:cutoff])
+    try:
+        async for data in stream:
+            if not is_large:
+                hash_md5.update(data)
+            if len(buffer) == 0 and len(data) == part_size:
+                await uploader.upload(data)
+                continue
+            new_len = len(buffer) + len(data)
+            if new_len >= part_size:
+                cutoff = part_size - len(buffer)
+                buffer.extend(data[:cutoff])
+                await uploader.upload(bytes(buffer))
+                buffer.clear()
+                buffer.extend(data[cutoff:])
+            else:
+                buffer.extend(data)
+        if len(buffer) > 0:
             await uploader.upload(bytes(buffer))
-            buffer.clear()
-            buffer.extend(data[cutoff:])
-        else:
-            buffer.extend(data)
-    if len(buffer) > 0:
-        await uploader.upload(bytes(buffer))
-    await uploader.finish_upload()
+    finally:
+        await uploader.finish_upload()
     if is_large:
         return InputFileBig(file_id, part_count, "upload"), file_size
     else:
@@ -312,9 +344,14 @@ async def _internal_transfer_to_telegram(client: MautrixTelegramClient, response
 
 
 async def parallel_transfer_to_telegram(client: MautrixTelegramClient, intent: IntentAPI,
-                                        uri: ContentURI, parallel_id: int
+                                        uri: ContentURI, parallel_id: int,
+                                        decryption_info: Optional[EncryptedFile] = None
                                         ) -> Tuple[TypeInputFile, int]:
     url = intent.api.get_download_url(uri)
     async with parallel_transfer_locks[parallel_id]:
         async with intent.api.session.get(url) as response:
-            return await _internal_transfer_to_telegram(client, response)
+            stream = response.content
+            if decryption_info:
+                # AES-CTR doesn't change the length, so the ciphertext size is the file size
+                stream = async_decrypt_attachment(stream, decryption_info)
+            return await _internal_transfer_to_telegram(client, stream, response.content_length)
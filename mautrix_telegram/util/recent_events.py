@@ -0,0 +1,82 @@
+# mautrix-telegram - A Matrix-Telegram puppeting bridge
+# Copyright (C) 2021 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import NamedTuple, Optional
+from collections import OrderedDict
+
+from mautrix.types import (RoomID, EventID, UserID, EventType, MessageType, MessageEvent,
+                           MessageEventContent, TextMessageEventContent, BaseMessageEventContent,
+                           MediaMessageEventContent, Format)
+
+
+class RecentEvent(NamedTuple):
+    room_id: RoomID
+    sender: UserID
+    msgtype: MessageType
+    body: str
+    formatted_body: Optional[str]
+
+
+# The bodies of recently bridged messages, so that reply fallbacks for replies to them can be
+# built without fetching the replied-to event from the homeserver.
+recent_events: 'OrderedDict[EventID, RecentEvent]' = OrderedDict()
+max_recent_events: int = 1000
+
+
+def add_recent_event(room_id: RoomID, event_id: EventID, sender: UserID,
+                     content: MessageEventContent, trim_reply_fallback: bool = True) -> None:
+    if not isinstance(content, BaseMessageEventContent) or not content.msgtype:
+        return
+    elif content.get_edit():
+        # Edits are fetched as their m.new_content, just let get_event handle those.
+        return
+    body = content.body
+    formatted_body = None
+    if isinstance(content, TextMessageEventContent):
+        if trim_reply_fallback and content.get_reply_to():
+            # Don't mutate the original content, it's probably still being used.
+            content = TextMessageEventContent(msgtype=content.msgtype, body=content.body,
+                                              format=content.format,
+                                              formatted_body=content.formatted_body,
+                                              relates_to=content.relates_to)
+            content.trim_reply_fallback()
+            body = content.body
+        if content.format == Format.HTML:
+            formatted_body = content.formatted_body
+    recent_events[event_id] = RecentEvent(room_id=room_id, sender=sender, msgtype=content.msgtype,
+                                          body=body, formatted_body=formatted_body)
+    if len(recent_events) > max_recent_events:
+        recent_events.popitem(last=False)
+
+
+def get_recent_event(event_id: EventID) -> Optional[MessageEvent]:
+    try:
+        evt = recent_events[event_id]
+    except KeyError:
+        return None
+    recent_events.move_to_end(event_id)
+    if evt.msgtype.is_text:
+        content = TextMessageEventContent(msgtype=evt.msgtype, body=evt.body)
+        if evt.formatted_body:
+            content.format = Format.HTML
+            content.formatted_body = evt.formatted_body
+    else:
+        content = MediaMessageEventContent(msgtype=evt.msgtype, body=evt.body)
+    return MessageEvent(type=EventType.ROOM_MESSAGE, room_id=evt.room_id, event_id=event_id,
+                        sender=evt.sender, timestamp=0, content=content)
+
+
+def remove_recent_event(event_id: EventID) -> None:
+    recent_events.pop(event_id, None)
@@ -163,7 +163,7 @@ class ProvisioningAPI(AuthAPI):
                                                "Telegram chat is already bridged to another "
                                                "Matrix room.")
 
-        async with portal._room_create_lock:
+        async with portal.room_create_lock:
             entity: Optional[TypeChat] = None
             try:
                 entity = await acting_user.client.get_entity(portal.peer)
@@ -363,6 +363,7 @@ class ProvisioningAPI(AuthAPI):
         return web.json_response({
             "relaybot_username": (self.context.bot.username
                                   if self.context.bot is not None else None),
+            "startup_complete": bool(User.startup_complete and User.startup_complete.is_set()),
         }, status=200)
 
     @staticmethod
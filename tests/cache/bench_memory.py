@@ -0,0 +1,81 @@
+# Memory benchmark for dormant portals and puppets.
+# Run with `python -m tests.cache.bench_memory` from the repository root.
+from typing import Callable, List, Tuple
+from unittest.mock import MagicMock, patch
+import asyncio
+import gc
+import logging
+import tracemalloc
+
+from mautrix.appservice import AppServiceAPI
+from mautrix.util.simple_template import SimpleTemplate
+
+from mautrix_telegram.types import TelegramID
+import mautrix_telegram.user as u
+import mautrix_telegram.portal as po
+import mautrix_telegram.puppet as pu
+
+COUNT = 100_000
+
+
+class FakeAppService:
+    def __init__(self) -> None:
+        self.intent = AppServiceAPI(base_url="http://localhost:8008",
+                                    bot_mxid="@telegrambot:example.com", token="as_token",
+                                    log=logging.getLogger("mau.as"),
+                                    client_session=MagicMock()).bot_intent()
+
+
+def make_portal(tgid: int) -> po.Portal:
+    return po.Portal(TelegramID(tgid), peer_type="channel", mxid=f"!room{tgid}:example.com",
+                     username=f"chat{tgid}", title=f"Chat {tgid}")
+
+
+def make_puppet(tgid: int) -> pu.Puppet:
+    return pu.Puppet(TelegramID(tgid), username=f"user{tgid}", displayname=f"User {tgid}")
+
+
+def use_portal(portal: po.Portal) -> None:
+    # Touch everything that used to be created in the constructor.
+    _ = (portal.log, portal.dedup, portal.send_lock, portal.backfill_lock,
+         portal.backfill_method_lock)
+
+
+def use_puppet(puppet: pu.Puppet) -> None:
+    _ = (puppet.log, puppet.default_mxid_intent, puppet.intent)
+
+
+def measure(make: Callable[[int], object], use: Callable[[object], None]) -> Tuple[float, float]:
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    objects: List[object] = [make(index + 1) for index in range(COUNT)]
+    gc.collect()
+    dormant = tracemalloc.get_traced_memory()[0] - start
+    for obj in objects:
+        use(obj)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return dormant / COUNT, used / COUNT
+
+
+def main() -> None:
+    # The locks are created lazily, but older Python versions need a current event loop for them.
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    template = SimpleTemplate("@telegram_{userid}:example.com", "userid", type=int)
+    print(f"{'object':<10} {'dormant':>12} {'in use':>12}")
+    with patch.object(po.Portal, "by_tgid", {}), patch.object(po.Portal, "by_mxid", {}), \
+            patch.object(po.Portal, "by_username", {}), patch.object(pu.Puppet, "cache", {}), \
+            patch.object(pu.Puppet, "by_username", {}), \
+            patch.object(pu.Puppet, "by_displayname", {}), \
+            patch.object(pu.Puppet, "az", FakeAppService(), create=True), \
+            patch.object(pu.Puppet, "mxid_template", template, create=True):
+        for name, make, use in (("portal", make_portal, use_portal),
+                                ("puppet", make_puppet, use_puppet)):
+            dormant, used = measure(make, use)
+            print(f"{name:<10} {dormant:>8.0f} B/obj {used:>8.0f} B/obj")
+
+
+if __name__ == "__main__":
+    main()
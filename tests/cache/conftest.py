@@ -0,0 +1,39 @@
+from unittest.mock import MagicMock
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+import pytest
+
+from mautrix.util.simple_template import SimpleTemplate
+
+from mautrix_telegram.config import Config
+import mautrix_telegram.user as u
+import mautrix_telegram.portal as po
+import mautrix_telegram.puppet as pu
+from mautrix_telegram import db
+
+
+@pytest.fixture
+def caches(mocker) -> Engine:
+    engine = create_engine("sqlite://")
+    for table in (db.Portal, db.User, db.UserPortal, db.Contact, db.Puppet):
+        table.bind(engine)
+        table.__table__.create(engine)
+
+    config = Config("", "", "")
+    config["bridge.permissions"] = {"*": "full"}
+    mocker.patch("mautrix_telegram.user.config", config)
+    for cls, attrs in ((po.Portal, ("by_tgid", "by_mxid", "by_username")),
+                       (u.User, ("by_mxid", "by_tgid", "by_username")),
+                       (pu.Puppet, ("cache", "by_custom_mxid", "by_username", "by_displayname"))):
+        for attr in attrs:
+            mocker.patch.object(cls, attr, {})
+    mocker.patch.object(po.Portal, "all_loaded", False)
+    mocker.patch.object(u.User, "all_loaded", False)
+    mocker.patch.object(pu.Puppet, "missing_ids", set())
+    mocker.patch.object(pu.Puppet, "known_ids", None)
+    mocker.patch.object(pu.Puppet, "az", MagicMock(), create=True)
+    mocker.patch.object(pu.Puppet, "mxid_template",
+                        SimpleTemplate("@telegram_{userid}:example.com", "userid", type=int),
+                        create=True)
+    return engine
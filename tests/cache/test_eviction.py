@@ -0,0 +1,144 @@
+import asyncio
+
+import pytest
+
+from mautrix.types import UserID
+
+from mautrix_telegram.types import TelegramID
+import mautrix_telegram.user as u
+import mautrix_telegram.portal as po
+import mautrix_telegram.puppet as pu
+from mautrix_telegram import db
+
+
+@pytest.fixture(autouse=True)
+def loaded_caches(caches, mocker) -> None:
+    mocker.patch.object(po.Portal, "all_loaded", True)
+    mocker.patch.object(u.User, "all_loaded", True)
+
+
+def _make_portals(count: int) -> list:
+    portals = [po.Portal.get_by_tgid(TelegramID(tgid), peer_type="chat")
+               for tgid in range(1, count + 1)]
+    for index, portal in enumerate(portals):
+        portal._last_used = index
+    return portals
+
+
+def test_portal_eviction_removes_least_recently_used() -> None:
+    portals = _make_portals(5)
+    portals[0].username = "first"
+    portals[0]._last_used = 10
+
+    assert po.Portal.evict_inactive(3, 0, set()) == 2
+    assert set(po.Portal.by_tgid) == {(1, 1), (4, 4), (5, 5)}
+    assert not po.Portal.all_loaded
+    assert po.Portal.find_by_username("first") is portals[0]
+
+    # Evicted portals are loaded from the database again
+    reloaded = po.Portal.get_by_tgid(TelegramID(2))
+    assert reloaded is not portals[1]
+    assert reloaded.tgid == 2
+
+
+def test_portal_eviction_keeps_pinned() -> None:
+    portals = _make_portals(4)
+    portals[0].backfill_leave = set()
+
+    async def evict_with_send_lock():
+        async with portals[1].send_lock(TelegramID(10)):
+            return po.Portal.evict_inactive(1, 0, {portals[2].tgid_full})
+
+    assert asyncio.run(evict_with_send_lock()) == 1
+    assert set(po.Portal.by_tgid) == {(1, 1), (2, 2), (3, 3)}
+
+
+def test_portal_eviction_keeps_recently_used() -> None:
+    for portal in _make_portals(3):
+        po.Portal.get_by_tgid(portal.tgid)
+    assert po.Portal.evict_inactive(1, 60, set()) == 0
+    assert len(po.Portal.by_tgid) == 3
+    assert po.Portal.all_loaded
+
+
+def test_puppet_eviction_cleans_indexes() -> None:
+    puppets = [pu.Puppet(TelegramID(tgid), username=f"user{tgid}", displayname=f"User {tgid}")
+               for tgid in range(1, 5)]
+    puppets[3].custom_mxid = UserID("@user:example.com")
+    for index, puppet in enumerate(puppets):
+        puppet._last_used = index
+
+    assert pu.Puppet.evict_inactive(1, 0, {TelegramID(3)}) == 2
+    assert set(pu.Puppet.cache) == {3, 4}
+    assert set(pu.Puppet.by_username) == {"user3", "user4"}
+    assert set(pu.Puppet.by_displayname) == {"User 3", "User 4"}
+
+
+def test_puppet_displayname_index_collision() -> None:
+    first = pu.Puppet(TelegramID(1), displayname="Bob")
+    second = pu.Puppet(TelegramID(2), displayname="Bob")
+    second.displayname = "Robert"
+    assert pu.Puppet.find_by_displayname("Bob") is first
+    assert pu.Puppet.find_by_displayname("Robert") is second
+    first.remove_from_cache()
+    assert "Bob" not in pu.Puppet.by_displayname
+
+
+def test_find_by_username_returns_cached_instance() -> None:
+    portal = po.Portal.get_by_tgid(TelegramID(1), peer_type="channel")
+    portal.username = "chat"
+    portal.db_instance.edit(username="chat")
+    del po.Portal.by_username["chat"]
+    po.Portal.all_loaded = False
+    assert po.Portal.find_by_username("chat") is portal
+
+    puppet = pu.Puppet.get(TelegramID(1))
+    puppet.username = "bob"
+    puppet.displayname = "Bob"
+    puppet.db_instance.edit(username="bob", displayname="Bob")
+    pu.Puppet.by_username.clear()
+    pu.Puppet.by_displayname.clear()
+    assert pu.Puppet.find_by_username("bob") is puppet
+    assert pu.Puppet.find_by_displayname("Bob") is puppet
+
+
+def test_user_eviction_keeps_logged_in() -> None:
+    users = [u.User(UserID(f"@user{index}:example.com")) for index in range(4)]
+    users[0].tgid = TelegramID(100)
+    users[1].command_status = {"action": "Login"}
+    for user in users:
+        user._last_used = 0
+
+    assert u.User.evict_inactive(1, 0) == 2
+    assert set(u.User.by_mxid) == {"@user0:example.com", "@user1:example.com"}
+    assert not u.User.all_loaded
+
+
+def test_get_page_with_mxid() -> None:
+    for tgid, tg_receiver, mxid in ((1, 1, "!a:example.com"), (2, 5, "!b:example.com"),
+                                    (2, 7, None), (2, 9, "!c:example.com"),
+                                    (3, 3, "!d:example.com")):
+        db.Portal(tgid=tgid, tg_receiver=tg_receiver, peer_type="user", mxid=mxid).insert()
+
+    def keys(page):
+        return [(portal.tgid, portal.tg_receiver) for portal in page]
+
+    assert keys(db.Portal.get_page_with_mxid(None, 2)) == [(1, 1), (2, 5)]
+    assert keys(db.Portal.get_page_with_mxid((2, 5), 2)) == [(2, 9), (3, 3)]
+    assert keys(db.Portal.get_page_with_mxid((3, 3), 2)) == []
+
+
+def test_borrow_from_db() -> None:
+    po.Portal.all_loaded = False
+    cached = po.Portal.get_by_tgid(TelegramID(1), peer_type="chat")
+    po.Portal.get_by_tgid(TelegramID(2), peer_type="chat").remove_from_cache()
+    po.Portal.get_by_tgid(TelegramID(3), peer_type="chat").remove_from_cache()
+
+    with po.Portal.borrow_from_db(db.Portal.get_by_tgid(1, 1)) as portal:
+        assert portal is cached
+    with po.Portal.borrow_from_db(db.Portal.get_by_tgid(2, 2)) as portal:
+        assert po.Portal.by_tgid[(2, 2)] is portal
+    with po.Portal.borrow_from_db(db.Portal.get_by_tgid(3, 3)) as portal:
+        # Someone else got the portal while it was borrowed, so it has to stay cached.
+        assert po.Portal.get_by_tgid(TelegramID(3)) is portal
+    assert set(po.Portal.by_tgid) == {(1, 1), (3, 3)}
@@ -0,0 +1,87 @@
+from typing import List
+import asyncio
+import random
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import pytest
+
+from mautrix.types import UserID
+
+from mautrix_telegram.types import TelegramID
+import mautrix_telegram.user as u
+import mautrix_telegram.portal as po
+from mautrix_telegram import db
+
+
+@pytest.fixture
+def inserts(caches: Engine) -> List[str]:
+    statements = []
+
+    def before_execute(conn, cursor, statement, *args) -> None:
+        if statement.startswith("INSERT"):
+            statements.append(statement.split(" ")[2])
+
+    event.listen(caches, "before_cursor_execute", before_execute)
+    return statements
+
+
+async def _concurrently(func, count: int = 50) -> list:
+    async def call():
+        await asyncio.sleep(random.random() / 100)
+        return func()
+
+    return await asyncio.gather(*[call() for _ in range(count)])
+
+
+def test_portal_get_by_tgid_concurrent_misses(inserts: List[str]) -> None:
+    portals = asyncio.run(_concurrently(
+        lambda: po.Portal.get_by_tgid(TelegramID(123), peer_type="chat")))
+    assert all(portal is portals[0] for portal in portals)
+    assert inserts == ["portal"]
+
+
+def test_portal_get_by_tgid_loads_once(inserts: List[str], mocker) -> None:
+    po.Portal.get_by_tgid(TelegramID(123), peer_type="chat")
+    po.Portal.by_tgid.clear()
+    get_by_tgid = mocker.spy(db.Portal, "get_by_tgid")
+    portals = asyncio.run(_concurrently(lambda: po.Portal.get_by_tgid(TelegramID(123))))
+    assert all(portal is portals[0] for portal in portals)
+    assert get_by_tgid.call_count == 1
+    assert inserts == ["portal"]
+
+
+def test_user_get_by_mxid_concurrent_misses(inserts: List[str]) -> None:
+    users = asyncio.run(_concurrently(
+        lambda: u.User.get_by_mxid(UserID("@user:example.com"))))
+    assert all(user is users[0] for user in users)
+    assert inserts == ["user"]
+
+
+def test_create_matrix_room_concurrent(inserts: List[str], mocker) -> None:
+    portal = po.Portal.get_by_tgid(TelegramID(123), peer_type="user", tg_receiver=TelegramID(5))
+    calls = 0
+
+    class RoomCreated(Exception):
+        pass
+
+    async def get_entity(user):
+        # Stands in for the whole room creation: the first caller creates the room, everyone else
+        # should see it when they get the lock.
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        portal.mxid = "!room:example.com"
+        raise RoomCreated()
+
+    mocker.patch.object(portal, "get_entity", get_entity)
+
+    async def create():
+        # The lock has to be created inside the event loop on older Python versions.
+        portal._room_create_lock = asyncio.Lock()
+        return await asyncio.gather(*[portal.create_matrix_room(None, update_if_exists=False)
+                                      for _ in range(20)])
+
+    room_ids = asyncio.run(create())
+    assert calls == 1
+    assert room_ids[1:] == ["!room:example.com"] * 19
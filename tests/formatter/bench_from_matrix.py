@@ -0,0 +1,64 @@
+# Microbenchmarks for the Matrix -> Telegram formatter.
+# Run with `python -m tests.formatter.bench_from_matrix` from the repository root.
+from typing import Callable, List, Tuple
+from unittest.mock import patch
+import timeit
+
+from telethon.helpers import add_surrogate, del_surrogate
+
+import mautrix_telegram.user as u
+import mautrix_telegram.puppet as pu
+from mautrix_telegram.formatter import from_matrix
+from mautrix_telegram.formatter.from_matrix.parser import MatrixParser, ParsedMessage
+
+PLAIN = "Hey, are we still meeting at 5? I'll bring the slides."
+INLINE = ("Hey <b>everyone</b>, the <a href='https://example.com/release'>new release</a> is out."
+          " Run <code>pip install -U thing</code> to <em>upgrade</em> &amp; enjoy.")
+BLOCK = ("<p>Changelog:</p><ul><li><b>Added</b> things</li><li><del>Removed</del> others</li>"
+         "</ul><pre><code class='language-python'>print('hi')</code></pre>")
+LONG_INLINE = " ".join([INLINE] * 20)
+
+
+def dom_html_to_telegram(html: str) -> ParsedMessage:
+    # The conversion as it was done before the plain text fast path and the streaming parser.
+    html = from_matrix.command_regex.sub(r"<command>\1</command>", html)
+    html = html.replace("\t", " " * 4)
+    html = from_matrix.not_command_regex.sub(r"\1", html)
+    msg = MatrixParser.parse(add_surrogate(html))
+    return from_matrix._cut_long_message(del_surrogate(msg.text.strip()),
+                                         msg.telegram_entities)
+
+
+def dom_text_to_telegram(text: str) -> ParsedMessage:
+    text = from_matrix.command_regex.sub(r"/\1", text)
+    text = text.replace("\t", " " * 4)
+    text = from_matrix.not_command_regex.sub(r"\1", text)
+    return text, []
+
+
+Converter = Callable[[str], ParsedMessage]
+
+BENCHMARKS: List[Tuple[str, Converter, Converter, str]] = [
+    ("text: plain", dom_text_to_telegram, from_matrix._matrix_text_to_telegram, PLAIN),
+    ("text: command", dom_text_to_telegram, from_matrix._matrix_text_to_telegram, "!ping me"),
+    ("html: plain", dom_html_to_telegram, from_matrix._matrix_html_to_telegram, PLAIN),
+    ("html: inline", dom_html_to_telegram, from_matrix._matrix_html_to_telegram, INLINE),
+    ("html: long inline", dom_html_to_telegram, from_matrix._matrix_html_to_telegram,
+     LONG_INLINE),
+    ("html: block", dom_html_to_telegram, from_matrix._matrix_html_to_telegram, BLOCK),
+]
+
+
+def main() -> None:
+    print(f"{'benchmark':<20} {'before':>12} {'after':>12} {'speedup':>8}")
+    with patch.object(pu.Puppet, "deprecated_sync_get_by_mxid", return_value=None), \
+            patch.object(u.User, "get_by_mxid", return_value=None):
+        for name, old_func, new_func, data in BENCHMARKS:
+            number = 200 if len(data) > 1000 else 2000
+            old = min(timeit.repeat(lambda: old_func(data), number=number, repeat=5)) / number
+            new = min(timeit.repeat(lambda: new_func(data), number=number, repeat=5)) / number
+            print(f"{name:<20} {old * 1e6:>10.1f}us {new * 1e6:>10.1f}us {old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
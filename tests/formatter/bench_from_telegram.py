@@ -0,0 +1,78 @@
+# Benchmark of the Telegram entity -> HTML converter against the old recursive implementation.
+# Run with `python -m tests.formatter.bench_from_telegram` from the repository root.
+from typing import List
+from html import escape
+import random
+import timeit
+
+from telethon.tl.types import (MessageEntityBold, MessageEntityItalic, MessageEntityCode,
+                               MessageEntityUnderline, MessageEntityStrike, TypeMessageEntity)
+
+import mautrix_telegram.user  # noqa: F401
+from mautrix_telegram.formatter import from_telegram
+
+
+def recursive_entities_to_matrix(text: str, entities: List[TypeMessageEntity],
+                                 offset: int = 0, length: int = None) -> str:
+    if not entities:
+        return escape(text)
+    if length is None:
+        length = len(text)
+    html = []
+    last_offset = 0
+    for i, entity in enumerate(entities):
+        if entity.offset > offset + length:
+            break
+        relative_offset = entity.offset - offset
+        if relative_offset > last_offset:
+            html.append(escape(text[last_offset:relative_offset]))
+        elif relative_offset < last_offset:
+            continue
+
+        entity_text = recursive_entities_to_matrix(
+            text=text[relative_offset:relative_offset + entity.length],
+            entities=entities[i + 1:], offset=entity.offset, length=entity.length)
+        skip_entity = from_telegram._entity_to_html(html, entity, entity_text)
+        last_offset = relative_offset + (0 if skip_entity else entity.length)
+    html.append(escape(text[last_offset:]))
+
+    return "".join(html)
+
+
+ENTITY_TYPES = (MessageEntityBold, MessageEntityItalic, MessageEntityCode,
+                MessageEntityUnderline, MessageEntityStrike)
+
+
+def make_message(entity_count: int, nested: bool) -> (str, List[TypeMessageEntity]):
+    rand = random.Random(entity_count)
+    words = [f"word{i} <&>" for i in range(entity_count)]
+    text = " ".join(words)
+    entities = []
+    offset = 0
+    for word in words:
+        entities.append(rand.choice(ENTITY_TYPES)(offset, len(word)))
+        if nested:
+            entities.append(MessageEntityBold(offset, 4))
+        offset += len(word) + 1
+    return text, entities
+
+
+def main() -> None:
+    print(f"{'entities':>8} {'nested':>6} {'recursive':>12} {'single pass':>12} {'speedup':>8}")
+    for count in (10, 100, 500, 1000):
+        for nested in (False, True):
+            text, entities = make_message(count, nested)
+            assert (recursive_entities_to_matrix(text, entities)
+                    == from_telegram._telegram_entities_to_matrix(text, entities))
+            number = max(10000 // count, 5)
+            old = min(timeit.repeat(lambda: recursive_entities_to_matrix(text, entities),
+                                    number=number, repeat=3)) / number
+            new = min(timeit.repeat(
+                lambda: from_telegram._telegram_entities_to_matrix(text, entities),
+                number=number, repeat=3)) / number
+            print(f"{len(entities):>8} {str(nested):>6} {old * 1000:>10.3f}ms "
+                  f"{new * 1000:>10.3f}ms {old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+from typing import Tuple
+from unittest.mock import Mock
+
+import pytest
+from pytest_mock import MockFixture
+
+import mautrix_telegram.user as u
+import mautrix_telegram.puppet as pu
+import mautrix_telegram.portal as po
+from mautrix_telegram.formatter import from_matrix
+from mautrix_telegram.formatter.from_matrix.parser import (MatrixParser, StreamingMatrixParser,
+                                                           UnsupportedHTML)
+
+INLINE_CASES = [
+    "hello",
+    " hello\nworld ",
+    "a &lt;b&gt; &amp; c",
+    "a <b>bold</b> c",
+    "<b> hi <i>there </i></b> x\nz",
+    "<b>  </b>x",
+    "<del>d</del><s>s</s><u>u</u><ins>i</ins><strong>b</strong><em>e</em>",
+    "<code>a\nb</code>",
+    "<code>  a < b  </code>",
+    "<a href='https://matrix.to/#/@alice:example.com'>Alice</a>: hi",
+    "<a href='https://matrix.to/#/@bob:example.com'>Bob</a>: hi",
+    "<a href='https://matrix.to/#/@nobody:example.com'>Nobody</a>: hi",
+    "<a href='https://matrix.to/#/#group:example.com'>group</a>",
+    "<a href='mailto:a@b.c'>mail</a>",
+    "<a href='https://example.com'>https://example.com</a>",
+    "<a href='https://example.com'>link</a>",
+    "<a>no href</a>",
+    "<a href='https://example.com' data-mautrix-no-link>x</a>",
+    "<b/>x<br/>y<br>z",
+    "<b>unclosed",
+    "<i>a</b>b</i>",
+    "<span data-mx-color='red'>red</span> <font color='red'>f</font>",
+    "\U0001f600 <b>\U0001f600x</b>",
+    "<command>ping</command>",
+]
+
+BLOCK_CASES = [
+    "<p>paragraph</p>",
+    "<pre><code class='language-python'>x</code></pre>",
+    "<blockquote>quote</blockquote>",
+    "<ul><li>a</li></ul>",
+    "<h1>title</h1>",
+    "<mx-reply>reply</mx-reply>text",
+    "<code>a<b>x</b>c</code>",
+    "<img src='mxc://example.com/abc'>",
+]
+
+
+@pytest.fixture(autouse=True)
+def lookups(mocker: MockFixture) -> None:
+    users = {
+        "@alice:example.com": Mock(username="alice", tgid=1, plain_displayname="Alice"),
+        "@bob:example.com": Mock(username=None, tgid=2, plain_displayname="Bob"),
+    }
+    group = Mock(username="group")
+    mocker.patch.object(pu.Puppet, "deprecated_sync_get_by_mxid", side_effect=users.get)
+    mocker.patch.object(u.User, "get_by_mxid", return_value=None)
+    mocker.patch.object(po.Portal, "get_username_from_mx_alias",
+                        side_effect=lambda alias: alias[1:].split(":")[0])
+    mocker.patch.object(po.Portal, "find_by_username",
+                        side_effect=lambda username: group if username == "group" else None)
+
+
+def _normalize(msg) -> Tuple[str, list]:
+    return msg.text, [entity.to_dict() for entity in msg.telegram_entities]
+
+
+@pytest.mark.parametrize("html", INLINE_CASES)
+def test_streaming_parser_matches_dom_parser(html: str) -> None:
+    assert _normalize(StreamingMatrixParser.parse(html)) == _normalize(MatrixParser.parse(html))
+
+
+@pytest.mark.parametrize("html", BLOCK_CASES)
+def test_streaming_parser_rejects_block_html(html: str) -> None:
+    with pytest.raises(UnsupportedHTML):
+        StreamingMatrixParser.parse(html)
+
+
+def test_plain_text_fast_path() -> None:
+    assert from_matrix._matrix_text_to_telegram("hello\tworld") == ("hello    world", [])
+    assert from_matrix._matrix_html_to_telegram(" hello\nworld ") == ("helloworld", [])
+
+
+def test_commands() -> None:
+    text, entities = from_matrix._matrix_text_to_telegram("!ping me")
+    assert text == "/ping me"
+    assert entities == []
+    assert from_matrix._matrix_text_to_telegram("\\!ping me") == ("!ping me", [])
+    assert from_matrix._matrix_html_to_telegram("\\!ping <b>me</b>")[0] == "!ping me"
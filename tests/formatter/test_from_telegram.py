@@ -0,0 +1,148 @@
+from typing import List, Tuple
+from unittest.mock import Mock
+
+import pytest
+from pytest_mock import MockFixture
+
+from telethon.helpers import add_surrogate, del_surrogate
+from telethon.tl.types import (MessageEntityBold, MessageEntityItalic, MessageEntityUnderline,
+                               MessageEntityStrike, MessageEntityCode, MessageEntityPre,
+                               MessageEntityBlockquote, MessageEntityEmail, MessageEntityUrl,
+                               MessageEntityTextUrl, MessageEntityBotCommand,
+                               MessageEntityHashtag, MessageEntityCashtag, MessageEntityPhone,
+                               MessageEntityMention, MessageEntityMentionName,
+                               MessageEntityUnknown, TypeMessageEntity)
+
+import mautrix_telegram.user as u
+import mautrix_telegram.puppet as pu
+import mautrix_telegram.portal as po
+from mautrix_telegram.formatter import from_telegram
+
+# Golden corpus of (text, entities, expected HTML). The expected output was generated with the
+# previous recursive implementation of _telegram_entities_to_matrix.
+GOLDEN_CASES: List[Tuple[str, List[TypeMessageEntity], str]] = [
+    ("plain <text> & stuff", [MessageEntityBold(100, 2)],
+     "plain &lt;text&gt; &amp; stuff"),
+    ("hello world", [MessageEntityBold(0, 5)],
+     "<strong>hello</strong> world"),
+    ("hello world", [MessageEntityBold(0, 5), MessageEntityItalic(6, 5)],
+     "<strong>hello</strong> <em>world</em>"),
+    ("hello world", [MessageEntityBold(0, 11), MessageEntityItalic(6, 5)],
+     "<strong>hello <em>world</em></strong>"),
+    ("hello world", [MessageEntityBold(0, 11), MessageEntityItalic(0, 5)],
+     "<strong><em>hello</em> world</strong>"),
+    ("hello world", [MessageEntityBold(0, 11), MessageEntityItalic(2, 3),
+                     MessageEntityUnderline(3, 1)],
+     "<strong>he<em>l<u>l</u>o</em> world</strong>"),
+    ("hello world", [MessageEntityBold(0, 5), MessageEntityItalic(3, 5)],
+     "<strong>hel<em>lo</em></strong> world"),
+    ("hello world", [MessageEntityItalic(0, 5), MessageEntityBold(0, 11)],
+     "<em><strong>hello</strong></em> world"),
+    ("a <b> & 'c'", [MessageEntityStrike(0, 11), MessageEntityCode(2, 3)],
+     "<del>a <code>&lt;b&gt;</code> &amp; &#x27;c&#x27;</del>"),
+    ("x\ny = 1\nz", [MessageEntityCode(0, 9)],
+     "<pre><code>x\ny = 1\nz</code></pre>"),
+    ("x = 1", [MessageEntityCode(0, 5)],
+     "<code>x = 1</code>"),
+    ("def f():\n    pass", [MessageEntityPre(0, 17, "python")],
+     "<pre><code class='language-python'>def f():\n    pass</code></pre>"),
+    ("def f():\n    pass", [MessageEntityPre(0, 17, "")],
+     "<pre><code>def f():\n    pass</code></pre>"),
+    ("quote me", [MessageEntityBlockquote(0, 8), MessageEntityBold(6, 2)],
+     "<blockquote>quote <strong>me</strong></blockquote>"),
+    ("mail a@b.c now", [MessageEntityEmail(5, 5)],
+     "mail <a href='mailto:a@b.c'>a@b.c</a> now"),
+    ("see example.com", [MessageEntityUrl(4, 11)],
+     "see <a href='http://example.com'>example.com</a>"),
+    ("see https://example.com/?a=1&b=2", [MessageEntityUrl(4, 28)],
+     "see <a href='https://example.com/?a=1&amp;b=2'>https://example.com/?a=1&amp;b=2</a>"),
+    ("click here", [MessageEntityTextUrl(6, 4, "https://example.com/?a=<1>&b='2'")],
+     "click <a href='https://example.com/?a=&lt;1&gt;&amp;b=&#x27;2&#x27;'>here</a>"),
+    ("click here", [MessageEntityTextUrl(0, 10, "https://t.me/somegroup/123"),
+                    MessageEntityBold(6, 4)],
+     "<a href='https://matrix.to/#/!room:example.com/$event:example.com'>"
+     "click <strong>here</strong></a>"),
+    ("run /start now", [MessageEntityBotCommand(4, 6)],
+     "run <font color='blue'>!start</font> now"),
+    ("#tag $USD +123456", [MessageEntityHashtag(0, 4), MessageEntityCashtag(5, 4),
+                           MessageEntityPhone(10, 7)],
+     "<font color='blue'>#tag</font> <font color='blue'>$USD</font> "
+     "<font color='blue'>+123456</font>"),
+    ("hi @alice and @nobody", [MessageEntityMention(3, 6), MessageEntityMention(14, 7)],
+     "hi <a href='https://matrix.to/#/@alice:example.com'>@alice</a> and @nobody"),
+    ("hi @somegroup", [MessageEntityMention(3, 10)],
+     "hi <a href='https://matrix.to/#/#telegram_somegroup:example.com'>@somegroup</a>"),
+    ("hi Bob and Eve", [MessageEntityMentionName(3, 3, 2), MessageEntityMentionName(11, 3, 999)],
+     "hi <a href='https://matrix.to/#/@bob:example.com'>Bob</a> and Eve"),
+    ("hi @nobody there", [MessageEntityMention(3, 7), MessageEntityBold(4, 2)],
+     "hi @<strong>no</strong>body there"),
+    ("hi @nobody there", [MessageEntityMention(3, 7), MessageEntityBold(4, 12)],
+     "hi @<strong>nobody there</strong>"),
+    ("hi @nobody there", [MessageEntityBold(0, 16), MessageEntityMention(3, 7),
+                          MessageEntityItalic(4, 12), MessageEntityUnderline(11, 2)],
+     "<strong>hi @<em>nobody <u>th</u>ere</em></strong>"),
+    ("unknown entity", [MessageEntityUnknown(0, 9), MessageEntityItalic(5, 9)],
+     "unkno<em>wn entity</em>"),
+    ("unknown entity", [MessageEntityUnknown(0, 7), MessageEntityItalic(8, 6)],
+     "unknown <em>entity</em>"),
+    ("unknown entity", [MessageEntityUnknown(0, 14), MessageEntityItalic(8, 6)],
+     "unknown <em>entity</em>"),
+    ("emoji \U0001f600\U0001f600 bold", [MessageEntityBold(6, 4), MessageEntityItalic(11, 4)],
+     "emoji <strong>\U0001f600\U0001f600</strong> <em>bold</em>"),
+    ("abc", [MessageEntityBold(1, 0)],
+     "a<strong></strong>bc"),
+    ("abc", [MessageEntityBold(3, 0)],
+     "abc<strong></strong>"),
+    ("abc", [MessageEntityBold(0, 10)],
+     "<strong>abc</strong>"),
+    ("nested deeply here", [MessageEntityBold(0, 18), MessageEntityItalic(0, 18),
+                            MessageEntityUnderline(7, 6), MessageEntityStrike(7, 6),
+                            MessageEntityCode(14, 4)],
+     "<strong><em>nested <u><del>deeply</del></u> <code>here</code></em></strong>"),
+    ("one two three four", [MessageEntityBold(0, 3), MessageEntityItalic(4, 3),
+                            MessageEntityUnderline(8, 5), MessageEntityStrike(14, 4)],
+     "<strong>one</strong> <em>two</em> <u>three</u> <del>four</del>"),
+    ("", [MessageEntityBold(0, 0)],
+     "<strong></strong>"),
+    # The recursive implementation also emitted an empty copy of an entity inside the entity
+    # right before it when they were directly adjacent (e.g. <strong>hello<em></em></strong>).
+    ("helloworld", [MessageEntityBold(0, 5), MessageEntityItalic(5, 5)],
+     "<strong>hello</strong><em>world</em>"),
+]
+
+
+@pytest.fixture(autouse=True)
+def lookups(mocker: MockFixture) -> None:
+    alice = Mock(mxid="@alice:example.com")
+    bob = Mock(mxid="@bob:example.com")
+    group = Mock(alias="#telegram_somegroup:example.com", mxid="!room:example.com", tgid=1001)
+    mocker.patch.object(u.User, "find_by_username",
+                        side_effect=lambda username: alice if username == "alice" else None)
+    mocker.patch.object(u.User, "get_by_tgid", side_effect=lambda tgid: bob if tgid == 2 else None)
+    mocker.patch.object(pu.Puppet, "find_by_username", return_value=None)
+    mocker.patch.object(pu.Puppet, "get", return_value=None)
+    mocker.patch.object(po.Portal, "find_by_username",
+                        side_effect=lambda username: group if username == "somegroup" else None)
+    mocker.patch.object(from_telegram.DBMessage, "get_one_by_tgid",
+                        return_value=Mock(mxid="$event:example.com"))
+
+
+@pytest.mark.parametrize("text,entities,expected", GOLDEN_CASES)
+def test_telegram_entities_to_matrix(text: str, entities: List[TypeMessageEntity],
+                                     expected: str) -> None:
+    html = from_telegram._telegram_entities_to_matrix(add_surrogate(text), entities)
+    assert del_surrogate(html) == expected
+
+
+def test_telegram_entities_to_matrix_many_entities() -> None:
+    words = [f"word{i}" for i in range(1000)]
+    text = " ".join(words)
+    entities = []
+    offset = 0
+    for i, word in enumerate(words):
+        entity_type = MessageEntityBold if i % 2 == 0 else MessageEntityItalic
+        entities.append(entity_type(offset, len(word)))
+        offset += len(word) + 1
+    expected = " ".join(f"<strong>{word}</strong>" if i % 2 == 0 else f"<em>{word}</em>"
+                        for i, word in enumerate(words))
+    assert from_telegram._telegram_entities_to_matrix(text, entities) == expected
@@ -0,0 +1,58 @@
+from typing import AsyncIterator, List, Tuple
+import asyncio
+import os
+
+import pytest
+
+from mautrix.errors import DecryptionError
+from mautrix.types import EncryptedFile, JSONWebKey
+
+from mautrix_telegram.util.parallel_file_transfer import async_decrypt_attachment
+
+# Attachment encryption uses the optional pycryptodome and unpaddedbase64 dependencies.
+AES = pytest.importorskip("Crypto.Cipher.AES")
+SHA256 = pytest.importorskip("Crypto.Hash.SHA256")
+Counter = pytest.importorskip("Crypto.Util.Counter")
+unpaddedbase64 = pytest.importorskip("unpaddedbase64")
+
+
+def _encrypt_attachment(plaintext: bytes) -> Tuple[bytes, EncryptedFile]:
+    # Same format as mautrix.crypto.attachments, which needs python-olm to be imported.
+    key = os.urandom(32)
+    iv = os.urandom(8)
+    cipher = AES.new(key, AES.MODE_CTR, counter=Counter.new(64, prefix=iv, initial_value=0))
+    ciphertext = cipher.encrypt(plaintext)
+    return ciphertext, EncryptedFile(
+        key=JSONWebKey(key_type="oct", key_ops=["encrypt", "decrypt"], algorithm="A256CTR",
+                       key=unpaddedbase64.encode_base64(key, urlsafe=True), extractable=True),
+        iv=unpaddedbase64.encode_base64(iv + b"\x00" * 8),
+        hashes={"sha256": unpaddedbase64.encode_base64(SHA256.new(ciphertext).digest())},
+        version="v2")
+
+
+async def _stream(data: bytes, chunk_size: int) -> AsyncIterator[bytes]:
+    for i in range(0, len(data), chunk_size):
+        yield data[i:i + chunk_size]
+
+
+async def _collect(stream: AsyncIterator[bytes]) -> List[bytes]:
+    return [chunk async for chunk in stream]
+
+
+@pytest.mark.parametrize("size,chunk_size", [(0, 16), (100, 1000), (100_000, 4096),
+                                             (100_000, 1337)])
+def test_decrypt_round_trip(size: int, chunk_size: int) -> None:
+    plaintext = os.urandom(size)
+    ciphertext, info = _encrypt_attachment(plaintext)
+    chunks = asyncio.run(_collect(async_decrypt_attachment(_stream(ciphertext, chunk_size),
+                                                           info)))
+    assert len(chunks) == -(-size // chunk_size)
+    assert b"".join(chunks) == plaintext
+
+
+def test_decrypt_hash_mismatch() -> None:
+    ciphertext, info = _encrypt_attachment(os.urandom(10_000))
+    tampered = bytearray(ciphertext)
+    tampered[5000] ^= 1
+    with pytest.raises(DecryptionError):
+        asyncio.run(_collect(async_decrypt_attachment(_stream(bytes(tampered), 1024), info)))